@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+
+Замеры производительности этапов поиска свободных для движения регионов
+на картах диспаритета.
+"""
+import numpy as np
+import argparse
+import tempfile
+import shutil
+import time
+import glob
+import sys
+import cv2
+import os
+import find_traversable as ft
+import ground_line
+
+
+def timeit(func, repeat):
+    """Возвращает минимальное время выполнения func() (с) из repeat запусков"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def raw_obstacle_mask(disp, u_disp_threshold=3):
+    """
+    Возвращает маску препятствий split_disp до морфологической обработки.
+    """
+    (u_disp, _, disp_bins, _) = ft.compute_uv_disp(disp)
+
+    u_disp_lut = np.zeros((u_disp.shape[0]+1, u_disp.shape[1]), dtype=np.uint8)
+    u_disp_lut[:-1][u_disp > u_disp_threshold] = 255
+
+    return u_disp_lut[disp_bins, np.arange(disp.shape[1])]
+
+def skimage_clean_mask(mask, kernel, small_obj_size=500, connectivity=1):
+    """Прежняя цепочка обработки маски на основе scikit-image"""
+    from skimage.morphology import remove_small_holes, remove_small_objects
+
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=1)
+    mask = mask.astype(bool)
+    mask = remove_small_holes(mask, small_obj_size, connectivity)
+    mask = remove_small_objects(mask, small_obj_size, connectivity)
+
+    return mask.astype(np.uint8)*255
+
+def bench_cleanup(disps, repeat, morph_disk_radius=9, small_obj_size=500,
+                  connectivity=1):
+    """Сравнивает clean_mask с цепочкой scikit-image"""
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(morph_disk_radius,
+                                                          morph_disk_radius))
+    print("INFO: mask cleanup (skimage chain vs clean_mask), per frame")
+    total = np.zeros(2)
+    for (name, disp) in disps:
+        mask = raw_obstacle_mask(disp)
+
+        t_skimage = timeit(lambda: skimage_clean_mask(mask, kernel,
+                                                      small_obj_size,
+                                                      connectivity), repeat)
+        t_fused = timeit(lambda: ft.clean_mask(mask.copy(), kernel,
+                                               small_obj_size,
+                                               connectivity), repeat)
+        total += (t_skimage, t_fused)
+        print("....: {}: {:.1f}ms -> {:.1f}ms (x{:.1f})".format(
+              name, t_skimage*1e3, t_fused*1e3, t_skimage/t_fused))
+    print("....: total: {:.1f}ms -> {:.1f}ms (x{:.1f})".format(
+          total[0]*1e3, total[1]*1e3, total[0]/total[1]))
+
+def bench_lines(disps, repeat, v_disp_threshold=3):
+    """
+    Сравнивает оценщики линии земли с полным преобразованием Хафа по
+    времени и по отклонению параметров rho/theta
+    """
+    print("INFO: ground line engines vs full Hough, per frame")
+    for (name, disp) in disps:
+        (_, _, v_disp, _) = ft.split_disp(disp, return_v_disp=True)
+        v_disp_bin = (v_disp > v_disp_threshold).astype(np.uint8)
+
+        reference = ground_line.hough_line(v_disp_bin, v_disp)
+        print("....:", name)
+        for engine in sorted(ground_line.ENGINES):
+            estimate = ground_line.get_engine(engine)
+            t = timeit(lambda: estimate(v_disp_bin, v_disp), repeat)
+            line = estimate(v_disp_bin, v_disp)
+            if line is None or reference is None:
+                agreement = "no line" if line is None else "no reference"
+            else:
+                agreement = "d_rho={:.1f}, d_theta={:.2f}deg".format(
+                    abs(line[0] - reference[0]),
+                    np.degrees(abs(line[1] - reference[1])))
+            print("....:     {:<18} {:6.1f}ms  {}".format(engine, t*1e3,
+                                                        agreement))
+
+def f_measure(mask, road, valid=None):
+    """
+    Возвращает F-меру маски относительно эталонной маски дороги road
+    (по пикселям valid, если задано)
+    """
+    (mask, road) = (mask > 0, road > 0)
+    if valid is not None:
+        (mask, road) = (mask[valid], road[valid])
+    tp = np.count_nonzero(mask & road)
+    total = np.count_nonzero(mask) + np.count_nonzero(road)
+
+    return 2*tp/total if total else 1.0
+
+def read_gt(gtdirpath, name):
+    """
+    Считывает эталонную разметку KITTI-ROAD (um_000000.png ->
+    um_road_000000.png) и возвращает маски дороги и валидной области или
+    None, если файла нет
+    """
+    tags = name.split('_')
+    if len(tags) == 2:
+        name = tags[0] + '_road_' + tags[1]
+    gt = cv2.imread(os.path.join(gtdirpath, name), cv2.IMREAD_UNCHANGED)
+    if gt is None:
+        return None
+
+    return (gt[:,:,0] > 0, gt[:,:,2] > 0)
+
+def bench_pyramid(disps, repeat, gtdirpath=None, levels=(1, 2)):
+    """
+    Сравнивает пирамидальный режим (с уточнением границы и без) с полным
+    разрешением по времени и по F-мере. F-мера считается относительно
+    эталонной разметки из gtdirpath или, без нее, относительно маски
+    полного разрешения.
+    """
+    print("INFO: pyramid levels vs full resolution, per frame")
+    row = "....:     level {}{:<8} {:6.1f}ms  F={:.3f} ({:+.3f})"
+    modes = [(0, False)] + [(level, refine) for level in levels
+                            for refine in (False, True)]
+    total = np.zeros((len(modes), 2))
+    for (name, disp) in disps:
+        gt = None if gtdirpath is None else read_gt(gtdirpath, name)
+        print("....:", name)
+        for (i, (level, refine)) in enumerate(modes):
+            if level == 0:
+                detector = ft.TraversableDetector(disp.shape)
+            else:
+                detector = ft.PyramidDetector(disp.shape, level, refine)
+            t = timeit(lambda: detector.process(disp), repeat)
+            mask = detector.process(disp)
+
+            if level == 0:
+                reference = mask
+            if gt is None:
+                score = f_measure(mask, reference)
+            else:
+                score = f_measure(mask, *gt)
+            if level == 0:
+                base = score
+            total[i] += (t, score)
+
+            print(row.format(level, " refine" if refine else "", t*1e3, score,
+                             score - base))
+
+    total /= len(disps)
+    print("....: mean")
+    for (i, (level, refine)) in enumerate(modes):
+        print(row.format(level, " refine" if refine else "", total[i,0]*1e3,
+                         total[i,1], total[i,1] - total[0,1]))
+
+def bench_batch(disps, repeat, batch_size=8):
+    """
+    Сравнивает покадровые split_disp и detect_traversable_regions с
+    пакетными вариантами на стопках кадров одного размера
+    """
+    print("INFO: per-frame calls vs batched calls, per frame")
+    outdirpath = tempfile.mkdtemp()
+    filenames = [f"frame_{i}.png" for i in range(batch_size)]
+    shapes = {}
+    for (name, disp) in disps:
+        shapes.setdefault(disp.shape, []).append(disp)
+
+    for (shape, frames) in sorted(shapes.items()):
+        # Стопка из batch_size кадров (кадры повторяются по кругу)
+        stack = np.stack([frames[i % len(frames)] for i in range(batch_size)])
+
+        def per_frame():
+            for (filename, disp) in zip(filenames, stack):
+                (_, non_obst, v_disp, index2d) = ft.split_disp(
+                    disp, return_v_disp=True)
+                ft.detect_traversable_regions(filename, outdirpath, non_obst,
+                                              v_disp=v_disp, index2d=index2d)
+
+        def batched():
+            (_, non_obst, v_disps, index2ds) = ft.split_disp_batch(
+                stack, return_v_disp=True)
+            ft.detect_traversable_regions_batch(filenames, outdirpath,
+                                                non_obst, v_disps=v_disps,
+                                                index2ds=index2ds)
+
+        t_frame = timeit(per_frame, repeat)/batch_size
+        t_batch = timeit(batched, repeat)/batch_size
+        print("....: {}x{} (N={}): {:.1f}ms -> {:.1f}ms (x{:.1f})".format(
+              shape[0], shape[1], batch_size, t_frame*1e3, t_batch*1e3,
+              t_frame/t_batch))
+    shutil.rmtree(outdirpath)
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python benchmark.py',
+                                 description="Benchmark detection stages.",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('stage',
+                        choices=['cleanup', 'lines', 'pyramid', 'batch'],
+                        help="stage to benchmark",
+                        metavar="STAGE")
+    parser.add_argument('disp',
+                        help="path to input disparity map(s)",
+                        metavar="DISP")
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        default=5,
+                        help="number of runs per frame (best is reported)")
+    parser.add_argument('-n', '--batch-size',
+                        type=int,
+                        default=8,
+                        help="frames per stack (batch stage)")
+    parser.add_argument('--gt',
+                        metavar="GT_DIR",
+                        help="""KITTI ground truth directory for F-measure
+                                (pyramid stage); without it the full
+                                resolution mask is the reference""")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+
+    disppath = os.path.abspath(args.disp)
+    if os.path.isfile(disppath):
+        disppaths = [disppath]
+    elif os.path.isdir(disppath):
+        disppaths = sorted(glob.glob(f"{disppath}/*.png"))
+    else:
+        print("INFO: UNSUCCESS")
+        print("....: invalid path to input disparity map(s)")
+        sys.exit(1)
+
+    disps = [(os.path.basename(path),
+              ft.read_disp(os.path.basename(path), os.path.dirname(path),
+                           fixed_point=True))
+             for path in disppaths]
+
+    if args.stage == 'cleanup':
+        bench_cleanup(disps, args.repeat)
+    elif args.stage == 'lines':
+        bench_lines(disps, args.repeat)
+    elif args.stage == 'pyramid':
+        bench_pyramid(disps, args.repeat, args.gt)
+    elif args.stage == 'batch':
+        bench_batch(disps, args.repeat, args.batch_size)
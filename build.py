@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+build.py
+
+Инкрементальный запуск цепочки demonstrate.sh: пересчитываются только
+устаревшие результаты.
+
+Этапы (скрипты репозитория, каталоги ODIR как в demonstrate.sh):
+
+    disp    - imgs2disp.py: стереопары -> disp_sgbm;
+    mask    - find_traversable.py: disp_sgbm -> sgbm_tr_regs_persp;
+    overlay - overlay_img_with_tr_regs.py: изображения и маски -> visimg;
+    bev     - transform2BEV.py: маски -> sgbm_tr_regs_bev;
+    gt_bev  - transform2BEV.py: разметка -> sgbm_tr_regs_bev/gt_image_2;
+    eval    - eval_performance.py: вид сверху -> eval.txt.
+
+Для каждого выходного файла в манифесте ODIR/.manifest.json хранятся
+этап, сигнатура этапа (аргументы скрипта и хэши исходных файлов, от
+которых зависит результат) и хэши содержимого входных файлов. Файл
+устарел, если его нет, изменилась сигнатура или содержимое любого входа.
+Если пересчитанный файл совпал с прежним, следующие этапы его не
+пересчитывают. Хэши кэшируются по размеру и времени изменения файла.
+
+Устаревшие файлы этапа пересчитываются одним запуском скрипта этапа на
+временном каталоге символических ссылок на их входы, поэтому, например,
+при изменении параметров поиска регионов карты диспаритета и вид сверху
+разметки не пересчитываются.
+"""
+import subprocess
+import argparse
+import tempfile
+import hashlib
+import shutil
+import shlex
+import json
+import time
+import glob
+import sys
+import os
+import frame_io
+import kitti
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEVKIT_DIR = os.path.join(REPO_DIR, 'devkit_road', 'python')
+
+MANIFEST_FILENAME = '.manifest.json'
+
+# Исходные файлы этапов (относительно каталога репозитория)
+STAGE_SOURCES = {
+    'disp': ('imgs2disp.py', 'frame_io.py', 'folder_watch.py'),
+    'mask': ('find_traversable.py', 'ground_line.py', 'kitti.py',
+             'freespace.py', 'frame_io.py', 'folder_watch.py'),
+    'overlay': ('overlay_img_with_tr_regs.py', 'frame_io.py'),
+    'bev': ('devkit_road/python/transform2BEV.py',
+            'devkit_road/python/BirdsEyeView.py', 'frame_io.py'),
+    'gt_bev': ('devkit_road/python/transform2BEV.py',
+               'devkit_road/python/BirdsEyeView.py', 'frame_io.py'),
+    'eval': ('devkit_road/python/eval_performance.py',
+             'devkit_road/python/evaluateRoad.py',
+             'devkit_road/python/helper.py'),
+}
+
+# Опции скриптов, допустимые в аргументах этапов (опция -> кол. значений).
+# Остальные опции (например, --sequence, --output, --watch) и позиционные
+# аргументы меняют набор обрабатываемых кадров или имена выходных файлов и
+# не соответствуют правилам отдельных файлов.
+STAGE_OPTIONS = {
+    'disp': {'--threads': 1, '--inflight': 1, '--prefetch': 1,
+             '--write-threads': 1},
+    'mask': {'--float': 0, '--line-engine': 1, '--pyramid-level': 1,
+             '--refine': 0, '--band-memory': 1, '--disp-bins': 1,
+             '--max-disp': 1, '--calib': 1, '--jobs': 1, '--chunk-size': 1,
+             '--prefetch': 1, '--write-threads': 1},
+    'overlay': {'--prefetch': 1, '--write-threads': 1},
+}
+
+
+def road_filename(filename):
+    """Имя маски для изображения (um_000000.png -> um_road_000000.png)"""
+    tags = filename.split('_')
+    return tags[0] + '_road_' + tags[1] if len(tags) == 2 else filename
+
+def check_stage_args(stage, args):
+    """ValueError, если args содержит опцию, недопустимую для этапа stage"""
+    options = STAGE_OPTIONS[stage]
+    i = 0
+    while i < len(args):
+        (option, separator, _) = args[i].partition('=')
+        if option not in options:
+            raise ValueError(f"{args[i]} is not supported in the {stage} "
+                             f"stage arguments (supported: "
+                             f"{', '.join(sorted(options))})")
+        i += 1 if separator else 1 + options[option]
+
+def file_digest(filename):
+    """Хэш содержимого файла (sha1)"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest(object):
+    """
+    Манифест сборки: для выходных файлов - этап, сигнатура и хэши входов
+    (outputs), для всех файлов - кэш хэшей по размеру и времени изменения
+    (digests).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.outputs = {}
+        self.digests = {}
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.outputs = manifest['outputs']
+            self.digests = manifest['digests']
+
+    def digest(self, filename):
+        """Хэш файла (None, если файла нет)"""
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = self.digests.get(filename)
+        if cached is None or cached[:2] != key:
+            cached = key + [file_digest(filename)]
+            self.digests[filename] = cached
+        return cached[2]
+
+    def is_stale(self, output, signature, inputs, changed=()):
+        """
+        Проверяет, устарел ли выходной файл; changed - входы, которые
+        будут пересчитаны (для --dry-run)
+        """
+        record = self.outputs.get(output)
+        return (record is None or not os.path.exists(output)
+                or record['signature'] != signature
+                or any(filename in changed for filename in inputs)
+                or record['inputs'] != {filename: self.digest(filename)
+                                        for filename in inputs})
+
+    def record(self, output, stage, signature, inputs):
+        self.outputs[output] = {'stage': stage, 'signature': signature,
+                                'inputs': {filename: self.digest(filename)
+                                           for filename in inputs}}
+        self.digest(output)
+
+    def forget(self, output):
+        self.outputs.pop(output, None)
+        self.digests.pop(output, None)
+
+    def save(self):
+        frame_io.atomic_write(self.filename, json.dumps(
+            {'outputs': self.outputs, 'digests': self.digests},
+            indent=1, sort_keys=True).encode())
+
+class Rule(object):
+    """
+    Правило выходного файла: входы inputs; links - пары (подкаталог
+    временного каталога, файл), которые передаются скрипту этапа
+    """
+
+    def __init__(self, output, inputs, links=()):
+        self.output = output
+        self.inputs = inputs
+        self.links = links
+
+class Stage(object):
+    """
+    Этап сборки: правила выходных файлов и команда argv(tmpdirpath)
+    скрипта этапа (без интерпретатора), пересчитывающая все файлы,
+    ссылки на входы которых помещены во временный каталог tmpdirpath.
+    При aggregate=True скрипт пересчитывает единственный выходной файл по
+    всем входам (без временного каталога), stdout сохраняется в файл.
+    """
+
+    def __init__(self, name, rules, argv, args=(), cwd=REPO_DIR,
+                 aggregate=False):
+        self.name = name
+        self.rules = rules
+        self.argv = argv
+        self.args = list(args)
+        self.cwd = cwd
+        self.aggregate = aggregate
+
+    def signature(self, manifest):
+        """Хэш аргументов скрипта и исходных файлов этапа"""
+        sources = {filename: manifest.digest(os.path.join(REPO_DIR,
+                                                          filename))
+                   for filename in STAGE_SOURCES[self.name]}
+        return hashlib.sha1(json.dumps([self.args, sources],
+                                       sort_keys=True).encode()).hexdigest()
+
+    def run(self, rules, python):
+        """
+        Пересчитывает выходные файлы правил rules; прежние файлы удаляются
+        до запуска скрипта, поэтому незаписанный файл не принимается за
+        пересчитанный. Возвращает правила записанных файлов и сообщение
+        об ошибке (None, если скрипт завершился успешно и записал все
+        файлы).
+        """
+        for rule in rules:
+            if os.path.exists(rule.output):
+                os.remove(rule.output)
+
+        tmpdirpath = tempfile.mkdtemp(prefix=f"build_{self.name}_")
+        try:
+            for rule in rules:
+                for (subdir, filename) in rule.links:
+                    os.makedirs(os.path.join(tmpdirpath, subdir),
+                                exist_ok=True)
+                    os.symlink(filename, os.path.join(
+                        tmpdirpath, subdir, os.path.basename(filename)))
+                os.makedirs(os.path.dirname(rule.output), exist_ok=True)
+
+            result = subprocess.run(python + self.argv(tmpdirpath)
+                                    + self.args, cwd=self.cwd,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        finally:
+            shutil.rmtree(tmpdirpath)
+
+        if self.aggregate and result.returncode == 0:
+            frame_io.atomic_write(rules[0].output, result.stdout.encode())
+
+        written = [rule for rule in rules if os.path.exists(rule.output)]
+        if result.returncode != 0 or len(written) < len(rules):
+            print(result.stdout)
+            return (written, f"stage {self.name} failed (exit code "
+                             f"{result.returncode}, "
+                             f"{len(rules) - len(written)} outputs missing)")
+        return (written, None)
+
+def pipeline_stages(imgLdirpath, imgRdirpath, calibdirpath, gtdirpath,
+                    outdirpath, disp_args=(), detect_args=(),
+                    overlay_args=()):
+    """
+    Этапы цепочки demonstrate.sh (см. описание модуля); ValueError, если
+    аргументы этапа недопустимы (см. STAGE_OPTIONS)
+    """
+    for (stage, args) in (('disp', disp_args), ('mask', detect_args),
+                          ('overlay', overlay_args)):
+        check_stage_args(stage, args)
+
+    dispdirpath = os.path.join(outdirpath, 'disp_sgbm')
+    maskdirpath = os.path.join(outdirpath, 'sgbm_tr_regs_persp')
+    visdirpath = os.path.join(outdirpath, 'visimg')
+    bevdirpath = os.path.join(outdirpath, 'sgbm_tr_regs_bev')
+    gtbevdirpath = os.path.join(bevdirpath, 'gt_image_2')
+
+    names = [os.path.basename(path)
+             for path in sorted(glob.glob(f"{imgLdirpath}/*.png"))
+             if os.path.isfile(os.path.join(imgRdirpath,
+                                            os.path.basename(path)))]
+    names = [name for name in names
+             if kitti.calib_filename(calibdirpath, name) is not None]
+
+    def calib(name):
+        return kitti.calib_filename(calibdirpath, name)
+
+    stages = []
+
+    rules = []
+    for name in names:
+        (imgL, imgR) = (os.path.join(imgLdirpath, name),
+                        os.path.join(imgRdirpath, name))
+        rules.append(Rule(os.path.join(dispdirpath, name), [imgL, imgR],
+                          [('L', imgL), ('R', imgR)]))
+    stages.append(Stage('disp', rules, lambda tmp: [
+        'imgs2disp.py', f"{tmp}/L", f"{tmp}/R", dispdirpath], disp_args))
+
+    # Калибровка - вход этапа поиска регионов только с --calib
+    with_calib = any(arg.partition('=')[0] == '--calib'
+                     for arg in detect_args)
+    rules = []
+    for name in names:
+        disp = os.path.join(dispdirpath, name)
+        inputs = [disp] + ([calib(name)] if with_calib else [])
+        rules.append(Rule(os.path.join(maskdirpath, road_filename(name)),
+                          inputs, [('disp', disp)]))
+    stages.append(Stage('mask', rules, lambda tmp: [
+        'find_traversable.py', f"{tmp}/disp", maskdirpath], detect_args))
+
+    rules = []
+    for name in names:
+        (imgL, mask) = (os.path.join(imgLdirpath, name),
+                        os.path.join(maskdirpath, road_filename(name)))
+        rules.append(Rule(os.path.join(visdirpath, road_filename(name)),
+                          [imgL, mask], [('L', imgL), ('mask', mask)]))
+    stages.append(Stage('overlay', rules, lambda tmp: [
+        'overlay_img_with_tr_regs.py', f"{tmp}/L", f"{tmp}/mask",
+        visdirpath], overlay_args))
+
+    rules = []
+    for name in names:
+        mask = os.path.join(maskdirpath, road_filename(name))
+        rules.append(Rule(os.path.join(bevdirpath, road_filename(name)),
+                          [mask, calib(name)], [('in', mask)]))
+    stages.append(Stage('bev', rules, lambda tmp: [
+        os.path.join(DEVKIT_DIR, 'transform2BEV.py'), f"{tmp}/in/*.png",
+        calibdirpath, bevdirpath], cwd=DEVKIT_DIR))
+
+    rules = []
+    for path in sorted(glob.glob(f"{gtdirpath}/*.png")):
+        name = os.path.basename(path)
+        if calib(name) is not None:
+            rules.append(Rule(os.path.join(gtbevdirpath, name),
+                              [path, calib(name)], [('in', path)]))
+    stages.append(Stage('gt_bev', rules, lambda tmp: [
+        os.path.join(DEVKIT_DIR, 'transform2BEV.py'), f"{tmp}/in/*.png",
+        calibdirpath, gtbevdirpath], cwd=DEVKIT_DIR))
+
+    bev_outputs = [rule.output for stage in stages[-2:]
+                   for rule in stage.rules]
+    stages.append(Stage('eval', [Rule(os.path.join(outdirpath, 'eval.txt'),
+                                      bev_outputs)],
+                        lambda tmp: [os.path.join(DEVKIT_DIR,
+                                                  'eval_performance.py'),
+                                     bevdirpath],
+                        cwd=DEVKIT_DIR, aggregate=True))
+
+    return stages
+
+def build(stages, manifest, python, dry_run=False):
+    """
+    Пересчитывает устаревшие выходные файлы этапов по порядку и удаляет
+    созданные ранее файлы, для которых больше нет правил. Возвращает
+    кол. пересчитанных файлов по этапам.
+    """
+    outputs = {rule.output for stage in stages for rule in stage.rules}
+    for output in sorted(set(manifest.outputs) - outputs):
+        print("....: removing", output)
+        if not dry_run:
+            if os.path.exists(output):
+                os.remove(output)
+            manifest.forget(output)
+
+    changed = set()  # выходы, пересчитываемые при --dry-run
+    rebuilt = {}
+    for stage in stages:
+        start = time.perf_counter()
+        signature = stage.signature(manifest)
+        stale = [rule for rule in stage.rules
+                 if manifest.is_stale(rule.output, signature, rule.inputs,
+                                      changed)]
+        rebuilt[stage.name] = len(stale)
+
+        if stale and dry_run:
+            changed.update(rule.output for rule in stale)
+        elif stale:
+            (written, error) = stage.run(stale, python)
+            for rule in stale:
+                manifest.forget(rule.output)
+            for rule in written:
+                manifest.record(rule.output, stage.name, signature,
+                                rule.inputs)
+            manifest.save()
+            if error is not None:
+                raise RuntimeError(error)
+        print("....: {}: {} of {} files {}, {:.1f}s.".format(
+              stage.name, len(stale), len(stage.rules),
+              "stale" if dry_run else "rebuilt",
+              time.perf_counter() - start))
+
+    return rebuilt
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python build.py',
+                                 description="""Incrementally rebuild the
+                                                demonstrate.sh results: only
+                                                outputs whose inputs, stage
+                                                arguments or stage code
+                                                changed are recomputed.""",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('imgl',
+                        help="path to the left images",
+                        metavar="IMG_L")
+    parser.add_argument('imgr',
+                        help="path to the right images",
+                        metavar="IMG_R")
+    parser.add_argument('calib',
+                        help="path to KITTI calibration directory",
+                        metavar="CALIB_DIR")
+    parser.add_argument('gt',
+                        help="path to perspective ground truth (gt_image_2)",
+                        metavar="GT_DIR")
+    parser.add_argument('odir',
+                        help="path to output directory",
+                        metavar="ODIR")
+    parser.add_argument('--disp-args',
+                        default='',
+                        metavar="ARGS",
+                        help="""extra imgs2disp.py arguments, e.g.
+                                --disp-args='--threads 4'""")
+    parser.add_argument('--detect-args',
+                        default='',
+                        metavar="ARGS",
+                        help="""extra find_traversable.py arguments, e.g.
+                                --detect-args='--line-engine ransac'""")
+    parser.add_argument('--overlay-args',
+                        default='',
+                        metavar="ARGS",
+                        help="extra overlay_img_with_tr_regs.py arguments")
+    parser.add_argument('--python',
+                        default=sys.executable,
+                        metavar="CMD",
+                        help="interpreter command for the stage scripts")
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help="only report stale outputs")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+
+    paths = [os.path.abspath(path) for path in (args.imgl, args.imgr,
+                                                args.calib, args.gt)]
+    outdirpath = os.path.abspath(args.odir)
+    if not all(os.path.isdir(path) for path in paths):
+        print("INFO: UNSUCCESS")
+        print("....: invalid path to input directories")
+        sys.exit(1)
+    os.makedirs(outdirpath, exist_ok=True)
+
+    try:
+        stages = pipeline_stages(*paths, outdirpath,
+                                 disp_args=shlex.split(args.disp_args),
+                                 detect_args=shlex.split(args.detect_args),
+                                 overlay_args=shlex.split(args.overlay_args))
+    except ValueError as error:
+        parser.error(str(error))
+    manifest = Manifest(os.path.join(outdirpath, MANIFEST_FILENAME))
+
+    print("INFO: Building...")
+    try:
+        build(stages, manifest, shlex.split(args.python), args.dry_run)
+    except RuntimeError as error:
+        print("INFO: UNSUCCESS")
+        print("....:", error)
+        sys.exit(1)
+
+    eval_file = os.path.join(outdirpath, 'eval.txt')
+    if not args.dry_run and os.path.exists(eval_file):
+        print("....: evaluation:", eval_file)
+    print("INFO: SUCCESS")
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
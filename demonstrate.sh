@@ -19,3 +19,20 @@ python eval_performance.py ../../results/sgbm_tr_regs_bev
 cd ../../
 
 # Все результаты сохраняются в папку ./result/
+
+# То же в памяти одной командой (промежуточные файлы - только по --save)
+# python pipeline.py ./data/data_road/training/image_2 ./data/data_road_right/training/image_3 ./data/data_road/training/calib --gt ./data/data_road/training/gt_image_2 --odir ./results --save mask overlay
+
+# Потоковая обработка кадров всеми этапами (orchestrator.py)
+# python orchestrator.py ./data/data_road/training/image_2 ./data/data_road_right/training/image_3 ./data/data_road/training/calib ./results --gt ./data/data_road/training/gt_image_2 --save mask overlay bev
+
+# Сервер поиска регионов на сокете Unix и нагрузочный тест (detect_server.py)
+# python detect_server.py /tmp/detect.sock --calib ./data/data_road/training/calib &
+# python loadgen.py /tmp/detect.sock ./results/disp --requests 100 --mode shm
+
+# Непрерывная обработка новых стереопар по мере записи (--watch)
+# python imgs2disp.py ./data/data_road/training/image_2 ./data/data_road_right/training/image_3 ./results/disp --watch &
+# python find_traversable.py ./results/disp ./results/mask --watch
+
+# Инкрементальная пересборка результатов (только устаревшие файлы)
+# python build.py ./data/data_road/training/image_2 ./data/data_road_right/training/image_3 ./data/data_road/training/calib ./data/data_road/training/gt_image_2 ./results --detect-args='--line-engine hough'
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+detect_client.py
+
+Протокол и клиент сервера поиска регионов, доступных для движения
+(detect_server.py), по локальному сокету Unix.
+
+Запрос: заголовок REQUEST_HEADER (сигнатура, операция, флаги, длина
+имени кадра), имя кадра (utf-8, для калибровки; может быть пустым) и
+массивы. Ответ: заголовок REPLY_HEADER (сигнатура, статус, время
+вычислений на сервере, с) и массивы (или сообщение об ошибке в utf-8 при
+статусе STATUS_ERROR). Массивы: кол. массивов, затем для каждого
+заголовок ARRAY_HEADER (индекс типа, размерность, форма, размер данных) и
+данные.
+
+Операции:
+
+    OP_DISP - карта диспаритета (uint16 с фиксированной точкой или
+              float32) -> маска (uint8, 0/255);
+    OP_PAIR - стереопара -> маска (SGBM на сервере);
+    OP_SHM  - карта диспаритета и маска в разделяемой памяти клиента:
+              запрос содержит имена и формы, сервер записывает маску в
+              разделяемую память, ответ без массивов.
+
+С флагом FLAG_BEV ответ OP_DISP и OP_PAIR содержит также маску вида
+сверху (нужна калибровка кадра на сервере).
+"""
+import numpy as np
+import struct
+import socket
+
+MAGIC = b'TRD1'
+REQUEST_HEADER = struct.Struct('<4sBBH')
+REPLY_HEADER = struct.Struct('<4sBd')
+ARRAY_HEADER = struct.Struct('<BB3IQ')
+SHM_HEADER = struct.Struct('<BB3IH')  # тип, размерность, форма, длина имени
+
+(OP_DISP, OP_PAIR, OP_SHM) = (1, 2, 3)
+FLAG_BEV = 1
+(STATUS_OK, STATUS_ERROR) = (0, 1)
+
+# Допустимые типы массивов (передается индекс)
+DTYPES = (np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.int16),
+          np.dtype(np.float32))
+
+
+def recv_exactly(sock, size):
+    """Принимает ровно size байт (bytearray); ConnectionError при обрыве"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("connection closed")
+        received += count
+    return buffer
+
+def _array_header(array):
+    shape = tuple(array.shape) + (0,)*(3 - array.ndim)
+    return ARRAY_HEADER.pack(DTYPES.index(array.dtype), array.ndim, *shape,
+                             array.nbytes)
+
+def send_message(sock, header, arrays=(), extra=b''):
+    """
+    Отправляет заголовок, дополнительные байты и массивы одним вызовом
+    sendall на каждый массив (данные массивов не копируются)
+    """
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    sock.sendall(header + extra + bytes([len(arrays)])
+                 + b''.join(_array_header(array) for array in arrays))
+    for array in arrays:
+        sock.sendall(memoryview(array).cast('B'))
+
+def recv_arrays(sock):
+    """Принимает массивы сообщения (см. send_message)"""
+    (count,) = recv_exactly(sock, 1)
+    headers = [ARRAY_HEADER.unpack(recv_exactly(sock, ARRAY_HEADER.size))
+               for _ in range(count)]
+
+    arrays = []
+    for (code, ndim, d0, d1, d2, nbytes) in headers:
+        shape = (d0, d1, d2)[:ndim]
+        arrays.append(np.frombuffer(recv_exactly(sock, nbytes),
+                                    dtype=DTYPES[code]).reshape(shape))
+    return arrays
+
+def shm_spec(name, shape, dtype):
+    """Описание массива в разделяемой памяти для OP_SHM"""
+    dims = tuple(shape) + (0,)*(3 - len(shape))
+    name = name.encode()
+    return SHM_HEADER.pack(DTYPES.index(np.dtype(dtype)), len(shape), *dims,
+                           len(name)) + name
+
+def parse_shm_spec(buffer, offset=0):
+    """
+    Разбирает описание shm_spec; возвращает ((имя, форма, тип), смещение
+    следующего описания)
+    """
+    (code, ndim, d0, d1, d2, size) = SHM_HEADER.unpack_from(buffer, offset)
+    offset += SHM_HEADER.size
+    name = bytes(buffer[offset:offset+size]).decode()
+    return ((name, (d0, d1, d2)[:ndim], DTYPES[code]), offset + size)
+
+class DetectionClient(object):
+    """
+    Клиент сервера detect_server.py (одно соединение, запросы
+    последовательные). После каждого запроса compute_time - время
+    вычислений на сервере (с).
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.compute_time = None
+
+    def _request(self, op, arrays=(), name=None, flags=0, extra=b''):
+        name = (name or '').encode()
+        send_message(self.sock,
+                     REQUEST_HEADER.pack(MAGIC, op, flags, len(name)) + name,
+                     arrays, extra)
+
+        (magic, status, self.compute_time) = REPLY_HEADER.unpack(
+            recv_exactly(self.sock, REPLY_HEADER.size))
+        if magic != MAGIC:
+            raise ConnectionError("unexpected reply")
+        arrays = recv_arrays(self.sock)
+        if status != STATUS_OK:
+            raise RuntimeError("server error: "
+                               + bytes(arrays[0]).decode(errors='replace'))
+        return arrays
+
+    def detect(self, disp, name=None, bev=False):
+        """
+        Возвращает маску регионов, доступных для движения, для карты
+        диспаритета (и маску вида сверху при bev=True). name - имя файла
+        кадра KITTI (для калибровки).
+        """
+        arrays = self._request(OP_DISP, [disp], name, FLAG_BEV if bev else 0)
+        return tuple(arrays) if bev else arrays[0]
+
+    def detect_pair(self, imgL, imgR, name=None, bev=False):
+        """Как detect, но для стереопары (SGBM на сервере)"""
+        arrays = self._request(OP_PAIR, [imgL, imgR], name,
+                               FLAG_BEV if bev else 0)
+        return tuple(arrays) if bev else arrays[0]
+
+    def detect_shared(self, disp_shm, disp_shape, disp_dtype, mask_shm,
+                      name=None):
+        """
+        Поиск регионов для карты диспаритета в разделяемой памяти disp_shm
+        (SharedMemory или имя) с записью маски (uint8) в mask_shm без
+        передачи данных через сокет.
+        """
+        names = [getattr(shm, 'name', shm) for shm in (disp_shm, mask_shm)]
+        self._request(OP_SHM, name=name,
+                      extra=shm_spec(names[0], disp_shape, disp_dtype)
+                            + shm_spec(names[1], disp_shape[:2], np.uint8))
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
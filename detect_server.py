@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+detect_server.py
+
+Долгоживущий сервер поиска регионов, доступных для движения, на локальном
+сокете Unix (протокол и клиент - detect_client.py).
+
+Импорты, детекторы (TraversableDetector), объекты StereoSGBM и таблицы
+преобразования в вид сверху создаются один раз и используются для всех
+запросов, поэтому задержка запроса складывается из вычислений и передачи
+данных по сокету (или только вычислений для разделяемой памяти).
+Запросы обрабатываются в потоках соединений; workers наборов состояния
+(детекторы и т.д.) выдаются запросам из пула, поэтому одновременно
+обрабатывается не больше workers запросов.
+"""
+from multiprocessing import shared_memory
+import collections
+import socketserver
+import argparse
+import signal
+import queue
+import time
+import sys
+import os
+import numpy as np
+import find_traversable as ft
+import detect_client as proto
+import ground_line
+import imgs2disp
+import kitti
+
+# Наибольшее кол. подключенных сегментов разделяемой памяти клиентов на
+# набор состояния
+MAX_SHARED = 16
+
+
+def attach_shared(name):
+    """
+    Подключает разделяемую память клиента; память принадлежит клиенту,
+    поэтому она не регистрируется в resource_tracker сервера (иначе при
+    завершении сервера сегмент был бы удален)
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class DetectionState(object):
+    """
+    Набор состояния для обработки запросов одним потоком: детекторы (по
+    одному на размер кадра и диапазон строк), объект StereoSGBM, таблицы
+    вида сверху (на файл калибровки и размер кадра) и подключенная
+    разделяемая память клиентов.
+
+    При заданном calibdirpath обрабатываются только строки ниже горизонта
+    (как find_traversable.py --calib), если для кадра есть калибровка.
+    """
+
+    def __init__(self, calibdirpath=None, line_engine='hough'):
+        self.calibdirpath = calibdirpath
+        self.line_engine = line_engine
+        self.detectors = {}
+        self.row_ranges = {}
+        self.bevs = {}
+        self.shared = collections.OrderedDict()
+        self._sgbm_obj = None
+
+    def _calib_file(self, name):
+        if not (self.calibdirpath and name):
+            return None
+        return kitti.calib_filename(self.calibdirpath, name)
+
+    def detect(self, disp, name=None, out=None):
+        """Маска регионов, доступных для движения (в out, если задан)"""
+        row_range = None
+        calib_file = self._calib_file(name)
+        if calib_file is not None:
+            if (calib_file, disp.shape) not in self.row_ranges:
+                self.row_ranges[calib_file, disp.shape] = \
+                    kitti.valid_row_range(kitti.read_calib(calib_file),
+                                          disp.shape)
+            row_range = self.row_ranges[calib_file, disp.shape]
+
+        key = (disp.shape, row_range)
+        if key not in self.detectors:
+            self.detectors[key] = ft.TraversableDetector(
+                disp.shape, u_disp_threshold=3, v_disp_threshold=3,
+                line_width=20, morph_disk_radius=9, small_obj_size=500,
+                connectivity=1, line_engine=self.line_engine,
+                row_range=row_range)
+        return self.detectors[key].process(disp, out=out)
+
+    def disp(self, imgL, imgR):
+        """Карта диспаритета стереопары (uint16)"""
+        if self._sgbm_obj is None:
+            self._sgbm_obj = imgs2disp.create_sgbm()
+        return imgs2disp.stereo_disp(self._sgbm_obj, imgL, imgR)
+
+    def bev(self, mask_tr_regions, name):
+        """
+        Маска вида сверху; таблица преобразования вычисляется один раз на
+        калибровку и размер кадра
+        """
+        calib_file = self._calib_file(name)
+        if calib_file is None:
+            raise ValueError(f"no calibration for frame: {name}")
+
+        key = (calib_file, mask_tr_regions.shape)
+        if key not in self.bevs:
+            self.bevs[key] = kitti.BevTransform(calib_file,
+                                                mask_tr_regions.shape)
+        return self.bevs[key](mask_tr_regions)
+
+    def shared_array(self, name, shape, dtype):
+        """Массив в разделяемой памяти клиента name"""
+        if name not in self.shared:
+            self.shared[name] = attach_shared(name)
+            if len(self.shared) > MAX_SHARED:
+                self.shared.popitem(last=False)[1].close()
+        self.shared.move_to_end(name)
+        return np.ndarray(shape, dtype=dtype, buffer=self.shared[name].buf)
+
+    def process(self, op, flags, name, arrays, extra):
+        """Выполняет запрос и возвращает массивы ответа"""
+        if op == proto.OP_SHM:
+            ((disp_name, shape, dtype), offset) = proto.parse_shm_spec(extra)
+            ((mask_name, mask_shape, _), _) = proto.parse_shm_spec(extra,
+                                                                   offset)
+            disp = self.shared_array(disp_name, shape, dtype)
+            mask_tr_regions = self.shared_array(mask_name, mask_shape,
+                                                np.uint8)
+            self.detect(disp, name, out=mask_tr_regions)
+            del disp, mask_tr_regions
+            return []
+
+        if op == proto.OP_DISP:
+            (disp,) = arrays
+        elif op == proto.OP_PAIR:
+            disp = self.disp(*arrays)
+        else:
+            raise ValueError(f"unknown operation: {op}")
+
+        mask_tr_regions = self.detect(disp, name)
+        if flags & proto.FLAG_BEV:
+            return [mask_tr_regions, self.bev(mask_tr_regions, name)]
+        return [mask_tr_regions]
+
+class DetectionHandler(socketserver.BaseRequestHandler):
+    """Обработка запросов одного соединения до его закрытия"""
+
+    def handle(self):
+        sock = self.request
+        while True:
+            try:
+                header = proto.recv_exactly(sock, proto.REQUEST_HEADER.size)
+            except ConnectionError:
+                return
+            (magic, op, flags, name_size) = proto.REQUEST_HEADER.unpack(
+                header)
+            if magic != proto.MAGIC:
+                return
+            name = bytes(proto.recv_exactly(sock, name_size)).decode()
+
+            extra = b''
+            if op == proto.OP_SHM:
+                # Два описания массивов в разделяемой памяти
+                for _ in range(2):
+                    spec = proto.recv_exactly(sock, proto.SHM_HEADER.size)
+                    size = proto.SHM_HEADER.unpack(spec)[-1]
+                    extra += bytes(spec + proto.recv_exactly(sock, size))
+            arrays = proto.recv_arrays(sock)
+
+            state = self.server.states.get()
+            start = time.perf_counter()
+            try:
+                reply = state.process(op, flags, name, arrays, extra)
+                status = proto.STATUS_OK
+            except Exception as error:
+                reply = [np.frombuffer(repr(error).encode(), dtype=np.uint8)]
+                status = proto.STATUS_ERROR
+            finally:
+                compute_time = time.perf_counter() - start
+                self.server.states.put(state)
+
+            proto.send_message(sock, proto.REPLY_HEADER.pack(
+                proto.MAGIC, status, compute_time), reply)
+
+class DetectionServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """
+    Сервер на сокете Unix socket_path с пулом из workers наборов
+    состояния (DetectionState)
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers=1, calibdirpath=None,
+                 line_engine='hough'):
+        self.states = queue.Queue()
+        for _ in range(workers):
+            self.states.put(DetectionState(calibdirpath, line_engine))
+        super().__init__(socket_path, DetectionHandler)
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python detect_server.py',
+                                 description="""Traversable region detection
+                                                server on a Unix domain
+                                                socket.""",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('socket',
+                        help="path to the Unix domain socket",
+                        metavar="SOCKET")
+    parser.add_argument('--calib',
+                        metavar="CALIB_DIR",
+                        help="""path to KITTI calibration directory (rows
+                                below the horizon, bird's-eye view)""")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help="number of requests processed concurrently")
+    parser.add_argument('--line-engine',
+                        choices=sorted(ground_line.ENGINES),
+                        default='hough',
+                        help="ground correlation line estimator")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+
+    socket_path = os.path.abspath(args.socket)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = DetectionServer(socket_path, args.workers, args.calib,
+                             args.line_engine)
+    # Завершение по SIGTERM так же, как по Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print("INFO: Serving on", socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        print("INFO: SUCCESS")
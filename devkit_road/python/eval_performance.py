@@ -19,7 +19,7 @@ import os
 # Скипт
 # =============================================================================
 if __name__ == "__main__":
-    start_time = time.clock()
+    start_time = time.perf_counter()
 
     # Анализ аргументов командной строки
     parser = argparse.ArgumentParser(prog='python eval_performance.py',
@@ -48,4 +48,5 @@ if __name__ == "__main__":
     evaluateRoad.main(resultpath, resultpath)
 
     print("INFO: SUCCESS")
-    print("....: execution time: {:.1f}s.".format(time.clock() - start_time))
\ No newline at end of file
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
\ No newline at end of file
@@ -17,19 +17,51 @@
 
 from BirdsEyeView import BirdsEyeView
 from glob import glob
+from collections import deque
 import os,sys
-import cv2 # OpenCV
+
+# Asynchronous frame I/O shared with the repository scripts (frame_io.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import frame_io
+
+#########################################################################
+# progress of the outputs written behind
+#########################################################################
+def print_written(pending, wait = False):
+    '''
+    Prints progress for the outputs whose writes have completed (in order)
+    :param pending: deque of (file_key, future) from WriteBehind.submit
+    :param wait: wait for all pending writes (OPTIONAL)
+    '''
+    while pending and (wait or pending[0][1].done()):
+        file_key, future = pending.popleft()
+        if future.result():
+            print("done ... (%s)" %file_key)
+
+def read_data(aFile):
+    '''
+    Reads an input image
+    :param aFile: image filename
+    :return: the image, None if it cannot be read
+    '''
+    try:
+        return frame_io.read_image(aFile)
+    except (IOError, OSError):
+        return None
 
 #########################################################################
 # function that does the transformation: Image --> BirdsEyeView
 #########################################################################
-def main(dataFiles, pathToCalib, outputPath, calib_end  = '.txt'):
+def main(dataFiles, pathToCalib, outputPath, calib_end  = '.txt',
+         prefetch = frame_io.PREFETCH_DEPTH, write_threads = frame_io.WRITE_THREADS):
     '''
     Main method of transform2BEV
     :param dataFiles: the files you want to transform to BirdsEyeView, e.g., /home/elvis/kitti_road/data/*.png
     :param pathToCalib: containing calib data as txt-files, e.g., /home/elvis/kitti_road/calib/
     :param outputPath: where the BirdsEyeView data will be saved, e.g., /home/elvis/kitti_road/data_bev
     :param calib_end: file extension of calib-files (OPTIONAL)
+    :param prefetch: number of input images decoded ahead in background threads, 0 = synchronous (OPTIONAL)
+    :param write_threads: number of background threads encoding and writing outputs, 0 = synchronous (OPTIONAL)
     '''
     
     
@@ -49,44 +81,54 @@ def main(dataFiles, pathToCalib, outputPath, calib_end  = '.txt'):
     fileList_data = glob(dataFiles)
     assert len(fileList_data), 'Could not find files in: %s' %pathToData
     
-    # Loop over all files
-    for aFile in fileList_data:
-        assert os.path.isfile(aFile), '%s is not a file' %aFile
+    # Input images are decoded ahead, outputs are written behind; a frame
+    # is reported done once its output is written
+    reader = frame_io.PrefetchReader(fileList_data, read_data, prefetch)
+    pending = deque()
+
+    try:
+        with frame_io.WriteBehind(write_threads) as writer:
+            # Loop over all files
+            for aFile, data in reader:
+                assert os.path.isfile(aFile), '%s is not a file' %aFile
         
-        file_key = aFile.split('/')[-1].split('.')[0]
-        print("Transforming file %s to Birds Eye View " %file_key) 
-        tags = file_key.split('_')
-        data_end = aFile.split(file_key)[-1]
+                file_key = aFile.split('/')[-1].split('.')[0]
+                print("Transforming file %s to Birds Eye View " %file_key) 
+                tags = file_key.split('_')
+                data_end = aFile.split(file_key)[-1]
         
-        #calibration filename
-        calib_file = os.path.join(pathToCalib, file_key + calib_end)
+                #calibration filename
+                calib_file = os.path.join(pathToCalib, file_key + calib_end)
         
-        if not os.path.isfile(calib_file) and len(tags)==3:
-            # exclude lane or road from filename!
-            calib_file = os.path.join(pathToCalib, tags[0]+ '_' + tags[2] + calib_end)
+                if not os.path.isfile(calib_file) and len(tags)==3:
+                    # exclude lane or road from filename!
+                    calib_file = os.path.join(pathToCalib, tags[0]+ '_' + tags[2] + calib_end)
         
-        # Check if calb file exist!
-        if not os.path.isfile(calib_file):
-            print("Cannot find calib file: %s" %calib_file)
-            print("Attention: It is assumed that input data and calib files have the same name (only different extension)!") 
-            sys.exit(1)
+                # Check if calb file exist!
+                if not os.path.isfile(calib_file):
+                    print("Cannot find calib file: %s" %calib_file)
+                    print("Attention: It is assumed that input data and calib files have the same name (only different extension)!") 
+                    sys.exit(1)
             
-        # Update calibration for Birds Eye View
-        bev.setup(calib_file)
-        
-        # Read image
-        data = cv2.imread(aFile, cv2.CV_LOAD_IMAGE_UNCHANGED if hasattr(cv2, 'CV_LOAD_IMAGE_UNCHANGED') else cv2.IMREAD_UNCHANGED)
+                # Check if input could be read!
+                if data is None:
+                    print("Cannot read file: %s" %aFile)
+                    sys.exit(1)
+            
+                # Update calibration for Birds Eye View
+                bev.setup(calib_file)
         
-        # Compute Birds Eye View
-        data_bev = bev.compute(data)
+                # Compute Birds Eye View
+                data_bev = bev.compute(data)
         
-        # Write output (BEV)
-        fn_out = os.path.join(outputPath,file_key + data_end)
-        if (cv2.imwrite(fn_out, data_bev)):
-            print("done ...")
-        else:
-            print("saving to %s failed ... (permissions?)"%outputPath)
-            return
+                # Write output (BEV)
+                fn_out = os.path.join(outputPath,file_key + data_end)
+                pending.append((file_key, writer.submit(fn_out, frame_io.encode_image, data_bev)))
+                print_written(pending)
+    except (IOError, OSError):
+        print("saving to %s failed ... (permissions?)"%outputPath)
+        return
+    print_written(pending, wait = True)
        
     print("BirdsEyeView was stored in: %s" %outputPath)
     
@@ -10,23 +10,54 @@ find_traversable.py
     IEEE, 2013. - С. 5785-5790.
 """
 import numpy as np
+import multiprocessing
 import argparse
 import time
 import glob
 import sys
 import cv2
 import os
-from skimage.morphology import remove_small_holes, remove_small_objects
+import ground_line
+import kitti
+import freespace
+import frame_io
+import folder_watch
 #from matplotlib import pyplot as plt
 
+# Представление карты диспаритета с фиксированной точкой (uint16)
+DISP_SCALE = 16  # диспаритет хранится как disp*DISP_SCALE
+INVALID_DISP = 65535  # значение для невалидных пикселей
 
-def read_disp(dispname, dispdirpath):
-    """Считывает и возвращает карту диспаритета из файла *.png"""
+# Наибольший диспаритет (numDisparities в imgs2disp.py): верхняя граница
+# фиксированной оси диспаритета при квантовании (см. quantize_disp)
+MAX_DISP = 112
+
+# Кол. бинов фиксированной оси в режиме последовательности (1/2 пикселя):
+# линия земли отслеживается между кадрами в координатах столбцов
+# v-диспаритета, поэтому ось должна быть одинаковой для всех кадров
+SEQUENCE_DISP_BINS = 224
+
+# Оценка объема временных массивов на пиксель полосы (байт) при полосной
+# обработке: индексы бинов, плоские индексы гистограмм, метки компонент,
+# маски
+BAND_BYTES_PER_PIXEL = 64
+
+
+def read_disp(dispname, dispdirpath, fixed_point=False):
+    """
+    Считывает и возвращает карту диспаритета из файла *.png
+
+    При fixed_point=True карта возвращается без преобразования в float32:
+    uint16 с фиксированной точкой (см. DISP_SCALE), невалидные пиксели
+    равны INVALID_DISP.
+    """
 
     disp = cv2.imread(f"{dispdirpath}/{dispname}", cv2.IMREAD_UNCHANGED)
+    if fixed_point:
+        return disp
 
-    mask_invalid = (disp == 65535)  # маска для невалидных значений
-    disp = disp.astype(np.float32) / 16  # конвертация в формат float32
+    mask_invalid = (disp == INVALID_DISP)  # маска для невалидных значений
+    disp = disp.astype(np.float32) / DISP_SCALE  # конвертация в float32
     disp[mask_invalid] = np.nan  # невалидные значения  обозначены как NaN
 
 #    # Рисуем карту диспаритета
@@ -37,92 +68,284 @@ def read_disp(dispname, dispdirpath):
 
     return disp
 
-def compute_u_disp(disp):
-    """Вычисляет u-диспаритет для карты диспарантности"""
+def is_fixed_point(disp):
+    """Проверяет, задана ли карта диспаритета с фиксированной точкой"""
+    return disp.dtype == np.uint16
+
+def invalid_value(disp):
+    """Возвращает значение невалидного пикселя для карты диспаритета"""
+    return INVALID_DISP if is_fixed_point(disp) else np.nan
+
+def valid_disp_mask(disp):
+    """Возвращает маску валидных пикселей карты диспаритета"""
+    if is_fixed_point(disp):
+        return disp != INVALID_DISP
+    return np.logical_not(np.isnan(disp))
+
+def quantize_disp(disp, num_disp_bins, max_disp=MAX_DISP):
+    """
+    Квантует карту диспаритета в num_disp_bins бинов равной ширины на
+    фиксированной оси [0, max_disp): бин k содержит диспаритеты
+    [k*max_disp/num_disp_bins, (k+1)*max_disp/num_disp_bins), большие
+    диспаритеты попадают в последний бин.
+
+    Возвращает карту индексов бинов (int32, -1 для невалидных пикселей).
+    """
+    step = max_disp/num_disp_bins
+    if is_fixed_point(disp):
+        # Таблица бинов для всех кодов с фиксированной точкой
+        code2index = np.minimum(np.arange(INVALID_DISP+1)/(DISP_SCALE*step),
+                                num_disp_bins-1).astype(np.int32)
+        code2index[INVALID_DISP] = -1
+        return code2index[disp]
+
+    mask_valid = valid_disp_mask(disp)
+    disp_bins = np.full(disp.shape, -1, dtype=np.int32)
+    disp_bins[mask_valid] = np.clip(disp[mask_valid]/step, 0, num_disp_bins-1)
+
+    return disp_bins
+
+def disp_axis(num_disp_bins, max_disp=MAX_DISP, fixed_point=False):
+    """
+    Возвращает фиксированную ось диспаритета квантования (см. quantize_disp):
+    нижние границы бинов (float64) в представлении карты диспаритета
+    (для fixed_point=True - в единицах 1/DISP_SCALE).
+    """
+    index2d = np.arange(num_disp_bins)*(max_disp/num_disp_bins)
+    if fixed_point:
+        index2d *= DISP_SCALE
+
+    return index2d
+
+def bin_disp(disp, num_disp_bins=None, max_disp=MAX_DISP):
+    """
+    Разбивает карту диспаритета на бины (по одному на уникальное значение).
+
+    Возвращает карту индексов бинов disp_bins (-1 для невалидных пикселей) и
+    массив index2d, в котором index2d[m] - значение диспаритета m-го бина
+    (в представлении входной карты: float или uint16 с фиксированной точкой).
+
+    При заданном num_disp_bins карта квантуется на фиксированную ось
+    (см. quantize_disp), и index2d - нижние границы всех бинов оси
+    (см. disp_axis), включая пустые.
+    """
+    if num_disp_bins is not None:
+        return (quantize_disp(disp, num_disp_bins, max_disp),
+                disp_axis(num_disp_bins, max_disp, is_fixed_point(disp)))
+
+    if is_fixed_point(disp):
+        # Целочисленные коды служат прямыми индексами таблицы бинов
+        counts = np.bincount(disp.ravel(), minlength=INVALID_DISP+1)
+        counts[INVALID_DISP] = 0
+        index2d = np.flatnonzero(counts).astype(np.uint16)
+
+        code2index = np.full(INVALID_DISP+1, -1, dtype=np.int32)
+        code2index[index2d] = np.arange(index2d.size, dtype=np.int32)
+
+        return (code2index[disp], index2d)
+
+    mask_valid = valid_disp_mask(disp)
+    (index2d, d_index) = np.unique(disp[mask_valid], return_inverse=True)
+
+    disp_bins = np.full(disp.shape, -1, dtype=np.int32)
+    disp_bins[mask_valid] = d_index.ravel()
+
+    return (disp_bins, index2d)
+
+def lookup_disp_bins(disp, index2d):
+    """
+    Возвращает индексы бинов index2d для пикселей карты диспаритета.
+
+    Невалидным пикселям соответствует индекс index2d.size (NaN и
+    INVALID_DISP больше любого валидного значения).
+    """
+    return np.searchsorted(index2d, disp)
+
+def count_disp_bins(disp_bins, num_bins, mask=None):
+    """
+    Вычисляет карты u- и v-диспаритета по карте индексов бинов за один проход.
+
+    Если задана маска, учитываются только пиксели внутри нее.
+    """
+    mask_valid = disp_bins >= 0
+    if mask is not None:
+        mask_valid &= mask.astype(bool)
+
+    (v, u) = np.nonzero(mask_valid)
+    d_index = disp_bins[v, u]
+
+    # Гистограммы по парам (бин, столбец) и (строка, бин)
+    (m, n) = disp_bins.shape
+    u_disp = np.bincount(d_index*n + u, minlength=num_bins*n)
+    u_disp = u_disp.reshape((num_bins, n)).astype(np.float64)
+    v_disp = np.bincount(v*num_bins + d_index, minlength=m*num_bins)
+    v_disp = v_disp.reshape((m, num_bins)).astype(np.float64)
+
+    return (u_disp, v_disp)
+
+def compute_uv_disp(disp, num_disp_bins=None, max_disp=MAX_DISP):
+    """
+    Вычисляет u- и v-диспаритет по общему разбиению диспаритета на бины.
+
+    Возвращает (u_disp, v_disp, disp_bins, index2d), где disp_bins и index2d -
+    результат bin_disp (num_disp_bins и max_disp задают квантование).
+    """
+    (disp_bins, index2d) = bin_disp(disp, num_disp_bins, max_disp)
+    (u_disp, v_disp) = count_disp_bins(disp_bins, index2d.size)
+
+    return (u_disp, v_disp, disp_bins, index2d)
+
+def compute_u_disp(disp, num_disp_bins=None, max_disp=MAX_DISP):
+    """
+    Вычисляет u-диспаритет для карты диспарантности.
+
+    Возвращает карту u-диспаритета и массив index2d, в котором index2d[m] -
+    значение диспаритета, соответствующее m-й строке карты. При заданном
+    num_disp_bins карта имеет num_disp_bins строк (см. bin_disp).
+    """
+    (u_disp, _, _, index2d) = compute_uv_disp(disp, num_disp_bins, max_disp)
+
+    return (u_disp, index2d)
+
+def compute_v_disp(disp, num_disp_bins=None, max_disp=MAX_DISP):
+    """
+    Вычисляет v-диспаритет для карты диспарантности.
+
+    Возвращает карту v-диспаритета и массив index2d, в котором index2d[n] -
+    значение диспаритета, соответствующее n-му столбцу карты. При заданном
+    num_disp_bins карта имеет num_disp_bins столбцов (см. bin_disp).
+    """
+    (_, v_disp, _, index2d) = compute_uv_disp(disp, num_disp_bins, max_disp)
 
-    # Нахождение уникальных значений диспаритета
-    mask_valid = np.logical_not(np.isnan(disp))
-    d_unique = np.unique(disp[mask_valid])
-    # Запись биекции значений диспаритета и индекса ввиде словарей
-    d2index_dict = dict( zip(d_unique, range(d_unique.size)) )
-    index2d_dict = dict( zip(range(d_unique.size), d_unique) )
+    return (v_disp, index2d)
 
-    # Подсчет кол-ва пикселей вдоль вертикальных направлений с одинаковым
-    # диспаритетом и формирование карты u-диспаритета
-    m = d_unique.size
-    n = disp.shape[1]
-    u_disp = np.zeros((m, n))
+def subtract_v_disp(v_disp, index2d, disp_bins, mask, drop_empty=True):
+    """
+    Вычитает из карты v-диспаритета вклад пикселей внутри маски.
+
+    Столбцы, оставшиеся пустыми, удаляются (если drop_empty=True, для
+    фиксированной оси квантования - нет), поэтому результат совпадает с
+    compute_v_disp для карты диспаритета без этих пикселей.
+    """
+    (_, v_disp_mask) = count_disp_bins(disp_bins, index2d.size, mask)
+    v_disp = v_disp - v_disp_mask
+    if not drop_empty:
+        return (v_disp, index2d)
 
-    for u in range(n):
-        unique, counts = np.unique(disp[:,u][mask_valid[:,u]],
-                                   return_counts=True)
-        u_disp[[d2index_dict[d] for d in unique], u] = counts
+    non_empty = v_disp.any(axis=0)
 
-    return (u_disp, index2d_dict)
+    return (v_disp[:, non_empty], index2d[non_empty])
 
-def compute_v_disp(disp):
-    """Вычисляет v-диспаритет для карты диспарантности"""
+def remove_small_components(mask, min_size, connectivity=1, labels=None,
+                            is_small=None):
+    """
+    Удаляет связные компоненты маски uint8 площадью меньше min_size.
+
+    Маска изменяется на месте. connectivity задается как в scikit-image:
+    1 - 4-связность, 2 - 8-связность. labels и is_small - необязательные
+    буферы размера маски (int32 для меток компонент и bool для пикселей
+    удаляемых компонент).
+    """
+    (_, labels, stats, _) = cv2.connectedComponentsWithStats(
+        mask, labels=labels, connectivity=(4 if connectivity == 1 else 8))
+
+    too_small = stats[:, cv2.CC_STAT_AREA] < min_size
+    too_small[0] = False  # метка 0 - фон
+    if too_small.any():
+        if is_small is None:
+            mask[too_small[labels]] = 0
+        else:
+            np.take(too_small, labels, out=is_small, mode='clip')
+            np.copyto(mask, 0, where=is_small)
+
+    return mask
+
+def clean_mask(mask, kernel, small_obj_size=500, connectivity=1,
+               labels=None, is_small=None):
+    """
+    Выполняет замыкание маски uint8 (0/255), заполняет пустоты и удаляет
+    изолированные регионы площадью меньше small_obj_size.
 
-    # Нахождение уникальных значений диспаритета
-    mask_valid = np.logical_not(np.isnan(disp))
-    d_unique = np.unique(disp[mask_valid])
-    # Запись биекции значений диспаритета и индекса ввиде словарей
-    d2index_dict = dict( zip(d_unique, range(d_unique.size)) )
-    index2d_dict = dict( zip(range(d_unique.size), d_unique) )
+    Эквивалентно цепочке morphologyEx(MORPH_CLOSE), remove_small_holes и
+    remove_small_objects из scikit-image, но использует по одному проходу
+    cv2.connectedComponentsWithStats на каждую полярность. Маска изменяется
+    на месте; labels и is_small - буферы (см. remove_small_components).
+    """
+    cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, dst=mask, iterations=1)
 
-    # Подсчет кол-ва пикселей вдоль горизонтальных направлений с одинаковым
-    # диспаритетом и формирование карты v-диспаритета
-    m = disp.shape[0]
-    n = d_unique.size
-    v_disp = np.zeros((m, n))
+    # Пустоты - небольшие компоненты инвертированной маски
+    cv2.bitwise_not(mask, dst=mask)
+    remove_small_components(mask, small_obj_size, connectivity, labels,
+                            is_small)
+    cv2.bitwise_not(mask, dst=mask)
 
-    for v in range(m):
-        unique, counts = np.unique(disp[v,:][mask_valid[v,:]],
-                                   return_counts=True)
-        v_disp[v, [d2index_dict[d] for d in unique]] = counts
+    remove_small_components(mask, small_obj_size, connectivity, labels,
+                            is_small)
 
-    return (v_disp, index2d_dict)
+    return mask
 
 def split_disp(disp, u_disp_threshold=3, morph_disk_radius=9, small_obj_size=500,
-               connectivity=1):
+               connectivity=1, return_v_disp=False, row_range=None,
+               num_disp_bins=None, max_disp=MAX_DISP):
     """
     Разделяет карту диспаритета на две карты диспаритета
     (препятствий и не препятствий)
+
+    Карта диспаритета задается как float32 (невалидные значения - NaN) или
+    как uint16 с фиксированной точкой (см. read_disp); выходные карты
+    имеют то же представление.
+
+    При return_v_disp=True дополнительно возвращает v-диспаритет карты
+    не-препятствий и его index2d, полученные вычитанием вклада препятствий
+    из общей гистограммы (без повторного прохода по изображению).
+
+    row_range=(top, bottom) ограничивает обработку строками top:bottom
+    (см. kitti.valid_row_range); остальные пиксели выходных карт невалидны,
+    а v-диспаритет содержит только строки диапазона.
+
+    num_disp_bins и max_disp задают квантование диспаритета на фиксированную
+    ось (см. bin_disp): размер карт u- и v-диспаритета не зависит от кадра,
+    и пустые столбцы v-диспаритета не удаляются.
     """
-    # Получение u-диспаритета
-    (u_disp, index2d_dict) = compute_u_disp(disp)
+    # Ограничение обработки диапазоном строк
+    rows = slice(None) if row_range is None else slice(*row_range)
+    full_disp = disp
+    disp = disp[rows]
 
-    # Применение порога и поиск пикселей относящихся к препятствию
-    mask_obst = np.zeros_like(disp, dtype=np.uint8)
+    # Получение u- и v-диспаритета по общему разбиению на бины
+    (u_disp, v_disp, disp_bins, index2d) = compute_uv_disp(disp, num_disp_bins,
+                                                           max_disp)
 
+    # Применение порога и поиск пикселей относящихся к препятствию:
+    # каждый пиксель выбирает ячейку (бин, столбец) бинарной карты
+    # u-диспаритета. Добавленная нулевая строка соответствует индексу -1,
+    # т.е. невалидные пиксели к препятствиям не относятся
     u_disp_bin = u_disp > u_disp_threshold
-    for (m,u) in np.argwhere(u_disp_bin):
-        d = index2d_dict[m]
-        mask_obst[np.where(disp[:,u] == d),u] = 255
+    u_disp_lut = np.zeros((u_disp_bin.shape[0]+1, u_disp_bin.shape[1]),
+                          dtype=np.uint8)
+    u_disp_lut[:-1][u_disp_bin] = 255
+
+    columns = np.arange(disp.shape[1])
+    mask_obst = u_disp_lut[disp_bins, columns]
 
-    # Выполнение морфологической операции замыкания
+    # Замыкание и избавление от небольших пустот и изолированных регионов
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(morph_disk_radius,
                                                           morph_disk_radius))
-    mask_obst = cv2.morphologyEx(mask_obst, cv2.MORPH_CLOSE, kernel,
-                                 iterations=1)
-
-    # Избавление от небольших изолированных регионов
-    mask_obst = mask_obst.astype(np.bool)
-    mask_obst = remove_small_holes(mask_obst,
-                                   min_size=small_obj_size,
-                                   connectivity=connectivity)
-    mask_obst = remove_small_objects(mask_obst,
-                                     min_size=small_obj_size,
-                                     connectivity=connectivity)
+    clean_mask(mask_obst, kernel, small_obj_size, connectivity)
 
     # Получение искомых карт диспаритета
     mask_non_obst = np.logical_not(mask_obst)
 
-    invalid = disp.copy()
-    invalid[:] = np.nan
+    obst_disp = np.full_like(full_disp, invalid_value(disp))
+    non_obst_disp = np.full_like(full_disp, invalid_value(disp))
 
-    obst_disp = np.where(mask_obst, disp, invalid)
-    non_obst_disp = np.where(mask_non_obst, disp, invalid)
+    np.copyto(obst_disp[rows], disp, where=mask_obst.astype(bool))
+    np.copyto(non_obst_disp[rows], disp, where=mask_non_obst)
+
+    if return_v_disp:
+        (v_disp, index2d) = subtract_v_disp(v_disp, index2d, disp_bins,
+                                            mask_obst,
+                                            drop_empty=num_disp_bins is None)
 
 #    # Рисуем карту u-диспаритета
 #    plt.figure()
@@ -142,57 +365,120 @@ def split_disp(disp, u_disp_threshold=3, morph_disk_radius=9, small_obj_size=500
 #    plt.title("non-obstacle disparity map")
 #    plt.show()
 
+    if return_v_disp:
+        return (obst_disp, non_obst_disp, v_disp, index2d)
     return (obst_disp, non_obst_disp)
 
+def find_ground_line(v_disp_bin, v_disp=None, engine='hough'):
+    """
+    Находит линию корреляции земной поверхности на бинарной карте
+    v-диспаритета.
+
+    engine - имя оценщика из ground_line.ENGINES (по умолчанию полное
+    преобразование Хафа) или функция с тем же интерфейсом. Возвращает
+    параметры (rho, theta) линии или None, если линия не найдена.
+    """
+    return ground_line.get_engine(engine)(v_disp_bin, v_disp)
+
+def ground_band(v_disp_bin, rho, theta, line_width=20):
+    """
+    Возвращает булеву таблицу ячеек (строка, бин) бинарной карты
+    v-диспаритета, лежащих в полосе шириной line_width вокруг линии.
+    """
+    (m, n) = v_disp_bin.shape
+    condition = (np.arange(n)*np.cos(theta)
+                 + np.arange(m)[:, np.newaxis]*np.sin(theta))
+
+    return ((v_disp_bin != 0)
+            & (condition >= rho-line_width/2)
+            & (condition <= rho+line_width/2))
+
+def save_mask(outdirpath, filename, mask_tr_regions, output='png',
+              writer=None):
+    """
+    Сохраняет маску регионов, доступных для движения, в outdirpath.
+
+    output='png' - изображение filename, 'runs' или 'boundary' - компактное
+    представление по столбцам (см. freespace) в файле с расширением *.fsp.
+    writer - необязательная отложенная запись (frame_io.WriteBehind); маска
+    не должна изменяться до ее записи.
+    """
+    if output == 'png':
+        if writer is not None:
+            writer.submit(f"{outdirpath}/{filename}", frame_io.encode_image,
+                          mask_tr_regions)
+        else:
+            cv2.imwrite(f"{outdirpath}/{filename}", mask_tr_regions)
+        return
+
+    filename = os.path.splitext(filename)[0] + freespace.FREESPACE_END
+    if writer is not None:
+        writer.submit(f"{outdirpath}/{filename}",
+                      lambda _, mask, mode: freespace.encode_freespace(mask,
+                                                                       mode),
+                      mask_tr_regions, output)
+    else:
+        freespace.write_freespace(f"{outdirpath}/{filename}", mask_tr_regions,
+                                  output)
+
 def detect_traversable_regions(filename, outdirpath,
                                non_obst_disp, v_disp_threshold=3,
                                line_width=20, morph_disk_radius=9,
-                               small_obj_size=500, connectivity=1):
+                               small_obj_size=500, connectivity=1,
+                               v_disp=None, index2d=None, line_engine='hough',
+                               row_range=None, num_disp_bins=None,
+                               max_disp=MAX_DISP, output='png'):
     """
     Определяет регионы, доступные для движения, и возвращает
     маску для входной карты диспаритета.
+
+    Если v-диспаритет уже вычислен (см. split_disp с return_v_disp=True),
+    его можно передать через v_disp и index2d. line_engine задает оценщик
+    линии земли (см. find_ground_line). row_range=(top, bottom) ограничивает
+    обработку строками top:bottom (как в split_disp); вне диапазона маска
+    нулевая. num_disp_bins и max_disp задают квантование диспаритета (как в
+    split_disp; переданный v_disp должен быть получен с тем же квантованием).
+    output задает формат сохраняемой маски (см. save_mask).
     """
+    # Ограничение обработки диапазоном строк
+    rows = slice(None) if row_range is None else slice(*row_range)
+    mask_tr_regions = np.zeros_like(non_obst_disp, dtype=np.uint8)
+    non_obst_disp = non_obst_disp[rows]
 
     # Получение v-диспаритета
-    (v_disp, index2d_dict) = compute_v_disp(non_obst_disp)
+    if v_disp is None:
+        (v_disp, index2d) = compute_v_disp(non_obst_disp, num_disp_bins,
+                                           max_disp)
 
     # Нахождение линии кореляции земной поверхности
-    # с помощью преобразования Хафа
     v_disp_bin = (v_disp > v_disp_threshold).astype(np.uint8)
 
-    lines = cv2.HoughLines(image=v_disp_bin,
-                           rho=1,
-                           theta=np.pi/180,
-                           threshold=50)
-    mask_tr_regions = np.zeros_like(non_obst_disp, dtype=np.uint8)
-    if lines is not None:
-        rho, theta = lines[0,0,:]  # параметры линии с наибольшим кол. голосов
+    line = find_ground_line(v_disp_bin, v_disp, line_engine)
+    if line is not None:
+        (rho, theta) = line
 
-        for (v,n) in np.argwhere(v_disp_bin != 0):
-            condition = n*np.cos(theta) + v*np.sin(theta)
-            if ((condition >= rho-line_width/2)
-                    and (condition <= rho+line_width/2)):
-                d = index2d_dict[n]
-                mask_tr_regions[v, np.where(non_obst_disp[v,:] == d)] = 255
+        # Таблица ячеек (строка, бин) v-диспаритета, попадающих в полосу
+        # вокруг линии. Добавленный нулевой столбец соответствует
+        # невалидным пикселям (см. lookup_disp_bins)
+        (m, n) = v_disp_bin.shape
+        band_lut = np.zeros((m, n+1), dtype=np.uint8)
+        band_lut[:, :-1][ground_band(v_disp_bin, rho, theta, line_width)] = 255
 
-        # Избавление от пустот
+        # Разметка пикселей по их паре (строка, бин); при квантовании
+        # невалидным пикселям соответствует индекс -1, т.е. тот же столбец
+        if num_disp_bins is None:
+            disp_bins = lookup_disp_bins(non_obst_disp, index2d)
+        else:
+            disp_bins = quantize_disp(non_obst_disp, num_disp_bins, max_disp)
+        mask_tr_regions[rows] = band_lut[np.arange(m)[:, np.newaxis],
+                                         disp_bins]
+
+        # Избавление от пустот и маленьких изолированных участков
         kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(morph_disk_radius,
                                                               morph_disk_radius))
-        mask_tr_regions = cv2.morphologyEx(mask_tr_regions, cv2.MORPH_CLOSE,
-                                           kernel, iterations=1)
-
-        mask_tr_regions = mask_tr_regions.astype(np.bool)
-        mask_tr_regions = remove_small_holes(mask_tr_regions,
-                                       min_size=small_obj_size,
-                                       connectivity=connectivity)
+        clean_mask(mask_tr_regions[rows], kernel, small_obj_size, connectivity)
 
-        # Избавление от маленьких изолированных участков
-        mask_tr_regions = remove_small_objects(mask_tr_regions,
-                                         min_size=small_obj_size,
-                                         connectivity=connectivity)
-
-        mask_tr_regions = mask_tr_regions.astype(np.uint8)*255
-        cv2.imwrite(f"{outdirpath}/{filename}", mask_tr_regions)
+        save_mask(outdirpath, filename, mask_tr_regions, output)
 
 
 #        # Рисуем найденную линию корреляции земли линию
@@ -210,11 +496,1124 @@ def detect_traversable_regions(filename, outdirpath,
 
     return mask_tr_regions
 
+def band_rows_for_memory(width, max_memory, min_rows=64):
+    """
+    Возвращает высоту полосы, при которой временные массивы полосной
+    обработки кадра ширины width занимают не больше max_memory байт.
+    """
+    return max(int(max_memory // (width*BAND_BYTES_PER_PIXEL)), min_rows)
+
+def iter_bands(rows, band_rows):
+    """Перебирает полосы (начало, конец) диапазона строк rows"""
+    for start in range(rows.start, rows.stop, band_rows):
+        yield (start, min(start + band_rows, rows.stop))
+
+def close_mask_banded(mask, kernel, band_rows):
+    """
+    Выполняет замыкание маски uint8 на месте по полосам из band_rows строк.
+
+    Каждая полоса обрабатывается с перекрытием, покрывающим радиус
+    дилатации и последующей эрозии, поэтому результат совпадает с
+    morphologyEx(MORPH_CLOSE) для всей маски.
+    """
+    halo = 2*max(kernel.shape)
+    band_rows = max(band_rows, halo)
+    height = mask.shape[0]
+
+    saved = None  # исходные строки перед текущей полосой
+    for (start, stop) in iter_bands(slice(0, height), band_rows):
+        (lo, hi) = (max(start - halo, 0), min(stop + halo, height))
+        band = mask[lo:hi].copy()
+        if start > lo:
+            band[:start-lo] = saved[-(start-lo):]
+        saved = mask[max(stop - halo, 0):stop].copy()
+
+        cv2.morphologyEx(band, cv2.MORPH_CLOSE, kernel, dst=band, iterations=1)
+        mask[start:stop] = band[start-lo:stop-lo]
+
+    return mask
+
+def _merge_labels(num_labels, edges):
+    """
+    Возвращает для каждой метки наименьшую метку ее класса эквивалентности
+    по парам меток edges (массив (k, 2)).
+    """
+    root = np.arange(num_labels)
+    if edges.size == 0:
+        return root
+
+    (a, b) = (edges[:,0], edges[:,1])
+    while True:
+        low = np.minimum(root[a], root[b])
+        changed = np.any(root[a] != low) or np.any(root[b] != low)
+        np.minimum.at(root, root[a], low)
+        np.minimum.at(root, root[b], low)
+        root = root[root]
+        if not changed:
+            break
+
+    # Сжатие путей до корней классов
+    while np.any(root[root] != root):
+        root = root[root]
+
+    return root
+
+def remove_small_components_banded(mask, min_size, connectivity=1,
+                                   band_rows=256):
+    """
+    Удаляет связные компоненты маски uint8 площадью меньше min_size,
+    размечая компоненты по полосам из band_rows строк.
+
+    Метки полос объединяются по соседним строкам на границах полос, и
+    площади компонент суммируются. Результат совпадает с
+    remove_small_components для всей маски. Маска изменяется на месте.
+    """
+    (height, width) = mask.shape
+    cv_connectivity = 4 if connectivity == 1 else 8
+    labels = np.empty((min(band_rows, height), width), dtype=np.int32)
+    bands = list(iter_bands(slice(0, height), band_rows))
+
+    # Проход 1: площади меток полос и пары меток, соседних через границу.
+    # Метка 0 - фон, метка l полосы получает номер offsets[i] + l
+    areas = [np.zeros(1, dtype=np.int64)]
+    offsets = []
+    edges = []
+    last_row = None
+    for (start, stop) in bands:
+        band_labels = labels[:stop-start]
+        (num, _, stats, _) = cv2.connectedComponentsWithStats(
+            mask[start:stop], labels=band_labels, connectivity=cv_connectivity)
+        offset = sum(area.size for area in areas) - 1
+        offsets.append(offset)
+        areas.append(stats[1:, cv2.CC_STAT_AREA].astype(np.int64))
+
+        first_row = np.where(band_labels[0] > 0, band_labels[0] + offset, 0)
+        if last_row is not None:
+            shifts = [0] if cv_connectivity == 4 else [-1, 0, 1]
+            for shift in shifts:
+                (upper, lower) = (last_row, first_row)
+                if shift < 0:
+                    (upper, lower) = (upper[:shift], lower[-shift:])
+                elif shift > 0:
+                    (upper, lower) = (upper[shift:], lower[:-shift])
+                touching = (upper > 0) & (lower > 0)
+                edges.append(np.column_stack((upper[touching],
+                                              lower[touching])))
+        last_row = np.where(band_labels[-1] > 0, band_labels[-1] + offset, 0)
+
+    areas = np.concatenate(areas)
+    edges = np.concatenate(edges) if edges else np.empty((0, 2), np.intp)
+    root = _merge_labels(areas.size, edges)
+
+    too_small = np.bincount(root, weights=areas, minlength=areas.size)
+    too_small = (too_small < min_size)[root]
+    too_small[0] = False  # фон
+    if not too_small.any():
+        return mask
+
+    # Проход 2: повторная разметка полос (та же, что в проходе 1) и удаление
+    for ((start, stop), offset) in zip(bands, offsets):
+        band_labels = labels[:stop-start]
+        cv2.connectedComponents(mask[start:stop], labels=band_labels,
+                                connectivity=cv_connectivity)
+        band_small = too_small[offset:offset+band_labels.max()+1].copy()
+        band_small[0] = False
+        mask[start:stop][band_small[band_labels]] = 0
+
+    return mask
+
+def clean_mask_banded(mask, kernel, small_obj_size=500, connectivity=1,
+                      band_rows=256):
+    """
+    Полосный вариант clean_mask с тем же результатом: временные массивы
+    имеют размер полосы из band_rows строк. Маска изменяется на месте.
+    """
+    close_mask_banded(mask, kernel, band_rows)
+
+    cv2.bitwise_not(mask, dst=mask)
+    remove_small_components_banded(mask, small_obj_size, connectivity,
+                                   band_rows)
+    cv2.bitwise_not(mask, dst=mask)
+
+    remove_small_components_banded(mask, small_obj_size, connectivity,
+                                   band_rows)
+
+    return mask
+
+def bin_disp_banded(disp, band_rows=256):
+    """
+    Возвращает index2d (см. bin_disp) карты диспаритета и функцию,
+    вычисляющую disp_bins для полосы карты. Значения собираются по полосам
+    из band_rows строк.
+    """
+    rows = slice(0, disp.shape[0])
+    if is_fixed_point(disp):
+        counts = np.zeros(INVALID_DISP+1, dtype=np.int64)
+        for (start, stop) in iter_bands(rows, band_rows):
+            counts += np.bincount(disp[start:stop].ravel(),
+                                  minlength=INVALID_DISP+1)
+        counts[INVALID_DISP] = 0
+        index2d = np.flatnonzero(counts).astype(np.uint16)
+
+        code2index = np.full(INVALID_DISP+1, -1, dtype=np.int32)
+        code2index[index2d] = np.arange(index2d.size, dtype=np.int32)
+
+        return (index2d, lambda band: code2index[band])
+
+    index2d = np.empty(0, dtype=disp.dtype)
+    for (start, stop) in iter_bands(rows, band_rows):
+        band = disp[start:stop]
+        index2d = np.union1d(index2d, band[valid_disp_mask(band)])
+
+    def band_bins(band):
+        disp_bins = lookup_disp_bins(band, index2d).astype(np.int32)
+        disp_bins[disp_bins == index2d.size] = -1
+        return disp_bins
+
+    return (index2d, band_bins)
+
+def split_disp_banded(disp, u_disp_threshold=3, morph_disk_radius=9,
+                      small_obj_size=500, connectivity=1, return_v_disp=False,
+                      row_range=None, band_rows=256):
+    """
+    Полосный вариант split_disp с тем же результатом.
+
+    Карта обрабатывается полосами из band_rows строк: u-диспаритет
+    накапливается по полосам, маска препятствий очищается
+    clean_mask_banded. Временные массивы размера кадра не создаются, кроме
+    маски препятствий uint8; объем остальных определяется высотой полосы
+    (см. band_rows_for_memory), а не высотой кадра.
+    """
+    rows = slice(None) if row_range is None else slice(*row_range)
+    full_disp = disp
+    disp = disp[rows]
+    (m, n) = disp.shape
+    bands = list(iter_bands(slice(0, m), band_rows))
+
+    # u-диспаритет по общему разбиению на бины
+    (index2d, band_bins) = bin_disp_banded(disp, band_rows)
+    num_bins = index2d.size
+    u_disp = np.zeros(num_bins*n, dtype=np.int64)
+    for (start, stop) in bands:
+        disp_bins = band_bins(disp[start:stop])
+        (_, u) = np.nonzero(disp_bins >= 0)
+        u_disp += np.bincount(disp_bins[disp_bins >= 0]*n + u,
+                              minlength=num_bins*n)
+    u_disp = u_disp.reshape((num_bins, n)).astype(np.float64)
+
+    u_disp_lut = np.zeros((num_bins+1, n), dtype=np.uint8)
+    u_disp_lut[:-1][u_disp > u_disp_threshold] = 255
+    del u_disp
+
+    # Маска препятствий и ее очистка по полосам
+    columns = np.arange(n)
+    mask_obst = np.empty((m, n), dtype=np.uint8)
+    for (start, stop) in bands:
+        mask_obst[start:stop] = u_disp_lut[band_bins(disp[start:stop]),
+                                           columns]
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(morph_disk_radius,
+                                                          morph_disk_radius))
+    clean_mask_banded(mask_obst, kernel, small_obj_size, connectivity,
+                      band_rows)
+
+    # Искомые карты диспаритета и v-диспаритет не-препятствий
+    obst_disp = np.full_like(full_disp, invalid_value(disp))
+    non_obst_disp = np.full_like(full_disp, invalid_value(disp))
+    (obst_rows, non_obst_rows) = (obst_disp[rows], non_obst_disp[rows])
+    if return_v_disp:
+        v_disp = np.empty((m, num_bins), dtype=np.float64)
+
+    for (start, stop) in bands:
+        band = disp[start:stop]
+        is_obst = mask_obst[start:stop] != 0
+        np.copyto(obst_rows[start:stop], band, where=is_obst)
+        np.copyto(non_obst_rows[start:stop], band, where=~is_obst)
+
+        if return_v_disp:
+            (_, v_disp[start:stop]) = count_disp_bins(band_bins(band),
+                                                      num_bins, ~is_obst)
+
+    if return_v_disp:
+        non_empty = v_disp.any(axis=0)
+        return (obst_disp, non_obst_disp, v_disp[:, non_empty],
+                index2d[non_empty])
+    return (obst_disp, non_obst_disp)
+
+def detect_traversable_regions_banded(filename, outdirpath,
+                                      non_obst_disp, v_disp_threshold=3,
+                                      line_width=20, morph_disk_radius=9,
+                                      small_obj_size=500, connectivity=1,
+                                      v_disp=None, index2d=None,
+                                      line_engine='hough', row_range=None,
+                                      band_rows=256, output='png',
+                                      writer=None):
+    """
+    Полосный вариант detect_traversable_regions с тем же результатом
+    (см. split_disp_banded). output - формат маски, writer - отложенная
+    запись (см. save_mask).
+    """
+    rows = slice(None) if row_range is None else slice(*row_range)
+    mask_tr_regions = np.zeros_like(non_obst_disp, dtype=np.uint8)
+    non_obst_disp = non_obst_disp[rows]
+    mask_rows = mask_tr_regions[rows]
+    (m, n) = non_obst_disp.shape
+    bands = list(iter_bands(slice(0, m), band_rows))
+
+    # v-диспаритет накапливается по полосам (строки независимы)
+    if v_disp is None:
+        (index2d, band_bins) = bin_disp_banded(non_obst_disp, band_rows)
+        v_disp = np.empty((m, index2d.size), dtype=np.float64)
+        for (start, stop) in bands:
+            (_, v_disp[start:stop]) = count_disp_bins(
+                band_bins(non_obst_disp[start:stop]), index2d.size)
+
+    v_disp_bin = (v_disp > v_disp_threshold).astype(np.uint8)
+
+    line = find_ground_line(v_disp_bin, v_disp, line_engine)
+    if line is not None:
+        (rho, theta) = line
+
+        band_lut = np.zeros((m, v_disp_bin.shape[1]+1), dtype=np.uint8)
+        band_lut[:, :-1][ground_band(v_disp_bin, rho, theta, line_width)] = 255
+
+        for (start, stop) in bands:
+            disp_bins = lookup_disp_bins(non_obst_disp[start:stop], index2d)
+            mask_rows[start:stop] = band_lut[
+                np.arange(start, stop)[:, np.newaxis], disp_bins]
+
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(morph_disk_radius,
+                                                              morph_disk_radius))
+        clean_mask_banded(mask_rows, kernel, small_obj_size, connectivity,
+                          band_rows)
+
+        save_mask(outdirpath, filename, mask_tr_regions, output, writer)
+
+    return mask_tr_regions
+
+def bin_disp_batch(disps):
+    """
+    Разбивает на бины стопку карт диспаритета (N, H, W), у каждой карты
+    свои бины (как в bin_disp).
+
+    Возвращает карту индексов бинов disp_bins (N, H, W), int32, -1 для
+    невалидных пикселей, и список index2d по картам.
+    """
+    num_frames = disps.shape[0]
+    if is_fixed_point(disps):
+        # Гистограмма пар (карта, код) за один проход
+        frames = np.arange(num_frames)[:, np.newaxis, np.newaxis]
+        keys = frames*(INVALID_DISP+1) + disps
+        counts = np.bincount(keys.ravel(),
+                             minlength=num_frames*(INVALID_DISP+1))
+        counts = counts.reshape((num_frames, INVALID_DISP+1))
+        counts[:, INVALID_DISP] = 0
+
+        present = counts > 0
+        code2index = np.cumsum(present, axis=1, dtype=np.int32) - 1
+        code2index[~present] = -1
+        index2ds = [np.flatnonzero(row).astype(np.uint16) for row in present]
+
+        return (np.take(code2index, keys), index2ds)
+
+    # Ранги значений в отсортированных картах (NaN в конце каждой)
+    flat = disps.reshape((num_frames, -1))
+    order = np.argsort(flat, axis=1, kind='stable')
+    values = np.take_along_axis(flat, order, axis=1)
+    is_new = np.ones(values.shape, dtype=bool)
+    is_new[:, 1:] = values[:, 1:] != values[:, :-1]
+    ranks = np.cumsum(is_new, axis=1, dtype=np.int32) - 1
+    ranks[np.isnan(values)] = -1
+
+    disp_bins = np.empty_like(ranks)
+    np.put_along_axis(disp_bins, order, ranks, axis=1)
+    index2ds = [row[is_new_row & ~np.isnan(row)]
+                for (row, is_new_row) in zip(values, is_new)]
+
+    return (disp_bins.reshape(disps.shape), index2ds)
+
+def _batch_offsets(num_bins, m):
+    """
+    Возвращает смещения гистограмм карт стопки в общих массивах:
+    u-диспаритет карты i занимает строки (бины) с bin_offsets[i]+1,
+    v-диспаритет - блок (m, num_bins[i]+1) с v_offsets[i].
+    """
+    num_bins = np.asarray(num_bins, dtype=np.intp)
+    bin_offsets = np.concatenate(([0], np.cumsum(num_bins)))
+    v_offsets = np.concatenate(([0], np.cumsum(m*(num_bins+1))))
+
+    return (bin_offsets, v_offsets)
+
+def _batch_u_index(disp_bins, bin_offsets):
+    """
+    Возвращает плоские индексы ячеек (бин, столбец) общего u-диспаритета
+    стопки индексов бинов (N, H, W); строка 0 соответствует невалидным
+    пикселям (см. _batch_offsets).
+    """
+    n = disp_bins.shape[2]
+    u_index = np.where(disp_bins >= 0,
+                       disp_bins + (bin_offsets[:-1, np.newaxis, np.newaxis]
+                                    + 1), 0)
+    u_index *= n
+    u_index += np.arange(n)
+
+    return u_index
+
+def _batch_v_index(disp_bins, num_bins, v_offsets, mask=None):
+    """
+    Возвращает плоские индексы ячеек (строка, бин) общего v-диспаритета
+    стопки индексов бинов (N, H, W); столбец 0 блока каждой карты
+    соответствует невалидным пикселям и пикселям вне маски
+    (см. _batch_offsets).
+    """
+    (num_frames, m, _) = disp_bins.shape
+    shape = (num_frames, 1, 1)
+
+    v_index = disp_bins.astype(np.intp)
+    v_index += 1
+    if mask is not None:
+        v_index[~mask.astype(bool)] = 0
+    v_index += v_offsets[:-1].reshape(shape)
+    v_index += (np.arange(m)[:, np.newaxis]
+                * (np.asarray(num_bins, dtype=np.intp)+1).reshape(shape))
+
+    return v_index
+
+def count_disp_bins_batch(disp_bins, num_bins, mask=None, u=True):
+    """
+    Вычисляет карты u- и v-диспаритета для стопки карт индексов бинов
+    (N, H, W) двумя вызовами bincount на всю стопку.
+
+    num_bins - кол. бинов каждой карты. Возвращает списки u_disp и v_disp
+    по картам (float64, как count_disp_bins); при u=False u-диспаритет не
+    вычисляется (вместо списка возвращается None).
+    """
+    (num_frames, m, n) = disp_bins.shape
+    (bin_offsets, v_offsets) = _batch_offsets(num_bins, m)
+
+    u_disps = None
+    if u:
+        if mask is not None:
+            disp_bins = np.where(mask.astype(bool), disp_bins, -1)
+        u_disp = np.bincount(_batch_u_index(disp_bins, bin_offsets).ravel(),
+                             minlength=(bin_offsets[-1]+1)*n)
+        u_disps = [u_disp[(bin_offsets[i]+1)*n:(bin_offsets[i+1]+1)*n]
+                   .reshape((-1, n)).astype(np.float64)
+                   for i in range(num_frames)]
+
+    v_index = _batch_v_index(disp_bins, num_bins, v_offsets, mask)
+    v_disp = np.bincount(v_index.ravel(), minlength=v_offsets[-1])
+    v_disps = [v_disp[v_offsets[i]:v_offsets[i+1]].reshape((m, -1))[:, 1:]
+               .astype(np.float64) for i in range(num_frames)]
+
+    return (u_disps, v_disps)
+
+def compute_uv_disp_batch(disps):
+    """
+    Вычисляет u- и v-диспаритет для стопки карт диспаритета (N, H, W).
+
+    Возвращает (u_disps, v_disps, disp_bins, index2ds): списки карт
+    u- и v-диспаритета и index2d по картам (как compute_uv_disp для каждой
+    карты) и стопку индексов бинов (см. bin_disp_batch).
+    """
+    (disp_bins, index2ds) = bin_disp_batch(disps)
+    (u_disps, v_disps) = count_disp_bins_batch(
+        disp_bins, [index2d.size for index2d in index2ds])
+
+    return (u_disps, v_disps, disp_bins, index2ds)
+
+def compute_u_disp_batch(disps):
+    """
+    Вычисляет u-диспаритет для стопки карт диспаритета (N, H, W).
+
+    Возвращает списки карт u-диспаритета и index2d (как compute_u_disp).
+    """
+    (u_disps, _, _, index2ds) = compute_uv_disp_batch(disps)
+
+    return (u_disps, index2ds)
+
+def compute_v_disp_batch(disps):
+    """
+    Вычисляет v-диспаритет для стопки карт диспаритета (N, H, W).
+
+    Возвращает списки карт v-диспаритета и index2d (как compute_v_disp).
+    """
+    (_, v_disps, _, index2ds) = compute_uv_disp_batch(disps)
+
+    return (v_disps, index2ds)
+
+def split_disp_batch(disps, u_disp_threshold=3, morph_disk_radius=9,
+                     small_obj_size=500, connectivity=1, return_v_disp=False):
+    """
+    Вариант split_disp для стопки карт диспаритета (N, H, W).
+
+    Гистограммы и разметка препятствий вычисляются для всей стопки сразу,
+    морфологическая обработка - по картам. Возвращает стопки карт
+    препятствий и не-препятствий, при return_v_disp=True также списки
+    v-диспаритета не-препятствий и index2d. Результат для каждой карты
+    совпадает с split_disp.
+    """
+    (num_frames, m, n) = disps.shape
+    (disp_bins, index2ds) = bin_disp_batch(disps)
+    num_bins = [index2d.size for index2d in index2ds]
+
+    # Бинарный u-диспаритет всей стопки служит таблицей для разметки
+    # препятствий; строка 0 (невалидные пиксели) обнуляется
+    (bin_offsets, _) = _batch_offsets(num_bins, m)
+    u_index = _batch_u_index(disp_bins, bin_offsets)
+    u_disp = np.bincount(u_index.ravel(), minlength=(bin_offsets[-1]+1)*n)
+    u_disp_lut = (u_disp > u_disp_threshold).astype(np.uint8)
+    u_disp_lut *= 255
+    u_disp_lut[:n] = 0
+    masks_obst = np.take(u_disp_lut, u_index)
+    del u_index
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(morph_disk_radius,
+                                                          morph_disk_radius))
+    labels = np.empty((m, n), dtype=np.int32)
+    for mask_obst in masks_obst:
+        clean_mask(mask_obst, kernel, small_obj_size, connectivity, labels)
+
+    is_obst = masks_obst.astype(bool)
+    obst_disps = np.where(is_obst, disps, invalid_value(disps))
+    non_obst_disps = np.where(is_obst, invalid_value(disps), disps)
+
+    if not return_v_disp:
+        return (obst_disps, non_obst_disps)
+
+    # v-диспаритет не-препятствий без пустых бинов (как compute_v_disp)
+    (_, v_disps) = count_disp_bins_batch(disp_bins, num_bins, ~is_obst,
+                                         u=False)
+    non_obst_v_disps = []
+    non_obst_index2ds = []
+    for (v_disp, index2d) in zip(v_disps, index2ds):
+        non_empty = v_disp.any(axis=0)
+        non_obst_v_disps.append(v_disp[:, non_empty])
+        non_obst_index2ds.append(index2d[non_empty])
+
+    return (obst_disps, non_obst_disps, non_obst_v_disps, non_obst_index2ds)
+
+def detect_traversable_regions_batch(filenames, outdirpath,
+                                     non_obst_disps, v_disp_threshold=3,
+                                     line_width=20, morph_disk_radius=9,
+                                     small_obj_size=500, connectivity=1,
+                                     v_disps=None, index2ds=None,
+                                     line_engine='hough', output='png'):
+    """
+    Вариант detect_traversable_regions для стопки карт диспаритета
+    не-препятствий (N, H, W).
+
+    Возвращает стопку масок (N, H, W); маска каждой карты совпадает с
+    detect_traversable_regions. Маски карт, для которых найдена линия
+    земли, записываются в outdirpath под именами filenames (если
+    outdirpath не None) в формате output (см. save_mask). Линия земли
+    ищется для каждой карты отдельно, разметка пикселей по полосе
+    выполняется для всей стопки сразу.
+    """
+    (num_frames, m, n) = non_obst_disps.shape
+
+    # Получение v-диспаритета
+    if v_disps is None:
+        (v_disps, index2ds) = compute_v_disp_batch(non_obst_disps)
+
+    # Линии земли и таблицы полос (строка, бин) по картам; добавленный
+    # нулевой столбец соответствует невалидным пикселям
+    band_luts = []
+    lines = []
+    for (v_disp, index2d) in zip(v_disps, index2ds):
+        v_disp_bin = (v_disp > v_disp_threshold).astype(np.uint8)
+        line = find_ground_line(v_disp_bin, v_disp, line_engine)
+        lines.append(line)
+
+        band_lut = np.zeros((m, v_disp_bin.shape[1]+1), dtype=np.uint8)
+        if line is not None:
+            band_lut[:, :-1][ground_band(v_disp_bin, *line, line_width)] = 255
+        band_luts.append(band_lut)
+
+    # Индексы бинов пикселей по index2d своей карты (невалидные - в
+    # последний столбец таблицы)
+    if is_fixed_point(non_obst_disps):
+        code2index = np.empty((num_frames, INVALID_DISP+1), dtype=np.intp)
+        for (i, index2d) in enumerate(index2ds):
+            code2index[i] = index2d.size
+            code2index[i, index2d] = np.arange(index2d.size)
+        frames = np.arange(num_frames)[:, np.newaxis, np.newaxis]
+        disp_bins = np.take(code2index,
+                            frames*(INVALID_DISP+1) + non_obst_disps)
+    else:
+        disp_bins = np.stack([lookup_disp_bins(disp, index2d)
+                              for (disp, index2d) in zip(non_obst_disps,
+                                                         index2ds)])
+
+    # Разметка всей стопки через общую таблицу полос
+    lut_offsets = np.cumsum([0] + [lut.size for lut in band_luts])
+    widths = np.array([lut.shape[1] for lut in band_luts])
+    index = (lut_offsets[:-1, np.newaxis, np.newaxis]
+             + np.arange(m)[:, np.newaxis]*widths[:, np.newaxis, np.newaxis]
+             + disp_bins)
+    masks = np.take(np.concatenate([lut.ravel() for lut in band_luts]), index)
+
+    # Избавление от пустот и маленьких изолированных участков
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(morph_disk_radius,
+                                                          morph_disk_radius))
+    labels = np.empty((m, n), dtype=np.int32)
+    for (i, line) in enumerate(lines):
+        if line is None:
+            continue
+        clean_mask(masks[i], kernel, small_obj_size, connectivity, labels)
+        if outdirpath is not None:
+            save_mask(outdirpath, filenames[i], masks[i], output)
+
+    return masks
+
+def kitti_frame_key(filename):
+    """
+    Возвращает ключ (последовательность, номер кадра) для имени файла KITTI
+    вида <последовательность>_<номер>.png, например ('um', 12) для
+    um_000012.png. Для имен другого вида номер кадра равен -1.
+    """
+    tags = os.path.splitext(os.path.basename(filename))[0].split('_')
+    if len(tags) >= 2 and tags[-1].isdigit():
+        return ('_'.join(tags[:-1]), int(tags[-1]))
+
+    return (filename, -1)
+
+class TraversableDetector(object):
+    """
+    Детектор регионов, доступных для движения, для потока карт диспаритета
+    одного размера.
+
+    Параметры задаются один раз при создании. Ядро морфологии и буферы
+    размера кадра (индексы бинов и ячеек гистограмм, метки компонент,
+    маски) создаются заранее и переиспользуются между кадрами. На каждый
+    кадр выделяются гистограммы u- и v-диспаритета (np.bincount) и таблицы
+    по ним: их размер пропорционален кол. бинов и без квантования
+    (num_disp_bins) может превышать размер кадра. Для карт float32
+    разбиение на бины (bin_disp, quantize_disp) создает временные массивы
+    размера кадра.
+    Результат process совпадает с последовательным вызовом split_disp и
+    detect_traversable_regions с теми же параметрами. При заданном
+    row_range=(top, bottom) обрабатываются только строки top:bottom, и буферы
+    имеют размер этого диапазона. num_disp_bins и max_disp задают
+    квантование диспаритета (см. split_disp).
+    """
+
+    def __init__(self, shape, u_disp_threshold=3, v_disp_threshold=3,
+                 line_width=20, morph_disk_radius=9, small_obj_size=500,
+                 connectivity=1, line_engine='hough', row_range=None,
+                 num_disp_bins=None, max_disp=MAX_DISP):
+        self.shape = tuple(shape[:2])
+        self.row_range = (0, self.shape[0]) if row_range is None \
+                         else tuple(row_range)
+        self.u_disp_threshold = u_disp_threshold
+        self.v_disp_threshold = v_disp_threshold
+        self.line_width = line_width
+        self.small_obj_size = small_obj_size
+        self.connectivity = connectivity
+        self.line_engine = ground_line.get_engine(line_engine)
+        self.num_disp_bins = num_disp_bins
+        self.max_disp = max_disp
+        self._quant_lut = None  # таблица бинов квантования для кодов uint16
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,
+                                                (morph_disk_radius,
+                                                 morph_disk_radius))
+        self.line = None  # (rho, theta) последнего кадра или None
+        self._band = None  # полоса земли на v-диспаритете и ее диспаритеты
+
+        # Буферы размера обрабатываемой части кадра
+        (m, n) = shape = (self.row_range[1] - self.row_range[0], self.shape[1])
+        self._rows = np.arange(m)[:, np.newaxis]
+        self._columns = np.arange(n)
+        self._code2index = np.empty(INVALID_DISP+1, dtype=np.int32)
+        self._bins = np.empty(shape, dtype=np.int32)
+        self._non_obst_bins = np.empty(shape, dtype=np.int32)
+        self._index = np.empty(shape, dtype=np.intp)
+        self._labels = np.empty(shape, dtype=np.int32)
+        self._is_small = np.empty(shape, dtype=bool)
+        self._is_obst = np.empty(shape, dtype=bool)
+        self.mask_obst = np.empty(shape, dtype=np.uint8)
+
+    def _bin(self, disp):
+        """Заполняет буфер индексов бинов и возвращает index2d"""
+        if self.num_disp_bins is not None:
+            index2d = disp_axis(self.num_disp_bins, self.max_disp,
+                                is_fixed_point(disp))
+            if not is_fixed_point(disp):
+                np.copyto(self._bins, quantize_disp(disp, self.num_disp_bins,
+                                                    self.max_disp))
+                return index2d
+
+            if self._quant_lut is None:
+                self._quant_lut = quantize_disp(
+                    np.arange(INVALID_DISP+1, dtype=np.uint16),
+                    self.num_disp_bins, self.max_disp)
+            np.take(self._quant_lut, disp, out=self._bins)
+            return index2d
+
+        if not is_fixed_point(disp):
+            (disp_bins, index2d) = bin_disp(disp)
+            np.copyto(self._bins, disp_bins)
+            return index2d
+
+        counts = np.bincount(disp.ravel(), minlength=INVALID_DISP+1)
+        counts[INVALID_DISP] = 0
+        index2d = np.flatnonzero(counts).astype(np.uint16)
+
+        self._code2index.fill(-1)
+        self._code2index[index2d] = np.arange(index2d.size, dtype=np.int32)
+        np.take(self._code2index, disp, out=self._bins)
+
+        return index2d
+
+    def _u_index(self, disp_bins):
+        """
+        Заполняет буфер плоских индексов ячеек (бин+1, столбец) карты
+        u-диспаритета; строка 0 соответствует невалидным пикселям.
+        """
+        np.add(disp_bins, 1, out=self._index)
+        np.multiply(self._index, self.shape[1], out=self._index)
+        np.add(self._index, self._columns, out=self._index)
+
+        return self._index
+
+    def _v_index(self, disp_bins, num_bins):
+        """
+        Заполняет буфер плоских индексов ячеек (строка, бин+1) карты
+        v-диспаритета; столбец 0 соответствует невалидным пикселям.
+        """
+        np.add(disp_bins, 1, out=self._index)
+        np.add(self._index, self._rows*(num_bins+1), out=self._index)
+
+        return self._index
+
+    def _split(self, num_bins):
+        """Заполняет маску препятствий по буферу индексов бинов"""
+        n = self.shape[1]
+
+        index = self._u_index(self._bins)
+        u_disp = np.bincount(index.ravel(), minlength=(num_bins+1)*n)
+        u_disp_lut = np.greater(u_disp, self.u_disp_threshold).view(np.uint8)
+        u_disp_lut *= 255
+        u_disp_lut[:n] = 0  # невалидные пиксели
+
+        np.take(u_disp_lut, index, out=self.mask_obst)
+        clean_mask(self.mask_obst, self.kernel, self.small_obj_size,
+                   self.connectivity, self._labels, self._is_small)
+
+    def process(self, disp, out=None):
+        """
+        Возвращает маску регионов, доступных для движения (uint8, 0/255),
+        для карты диспаритета (float32 или uint16 с фиксированной точкой).
+
+        Маска записывается в out, если он задан. Маска препятствий последнего
+        кадра (в диапазоне строк row_range) доступна в mask_obst, параметры
+        линии земли - в line.
+        """
+        assert disp.shape == self.shape, "unexpected disparity map shape"
+        if out is None:
+            out = np.empty(self.shape, dtype=np.uint8)
+
+        # Строки вне диапазона не обрабатываются
+        (top, bottom) = self.row_range
+        out[:top] = 0
+        out[bottom:] = 0
+        (disp, out_full, out) = (disp[top:bottom], out, out[top:bottom])
+
+        # Разделение на препятствия и не-препятствия
+        index2d = self._bin(disp)
+        self._split(index2d.size)
+
+        np.not_equal(self.mask_obst, 0, out=self._is_obst)
+        np.copyto(self._non_obst_bins, self._bins)
+        np.copyto(self._non_obst_bins, -1, where=self._is_obst)
+
+        # v-диспаритет не-препятствий без пустых бинов (как compute_v_disp;
+        # фиксированная ось квантования сохраняется целиком)
+        num_bins = index2d.size
+        index = self._v_index(self._non_obst_bins, num_bins)
+        m = self._rows.shape[0]
+        v_disp = np.bincount(index.ravel(), minlength=m*(num_bins+1))
+        v_disp = v_disp.reshape((m, num_bins+1))[:, 1:]
+        non_empty = v_disp.any(axis=0)
+        if self.num_disp_bins is not None:
+            non_empty.fill(True)
+        v_disp = v_disp[:, non_empty]
+        v_disp_bin = np.greater(v_disp, self.v_disp_threshold).view(np.uint8)
+
+        self.line = find_ground_line(v_disp_bin, v_disp, self.line_engine)
+        self._band = None
+        if self.line is None:
+            out.fill(0)
+            return out_full
+        (rho, theta) = self.line
+
+        # Разметка пикселей по паре (строка, бин) через таблицу полосы,
+        # столбец 0 которой соответствует невалидным пикселям
+        bin2column = np.zeros(num_bins+1, dtype=np.intp)
+        bin2column[1:] = np.cumsum(non_empty)
+
+        band = ground_band(v_disp_bin, rho, theta, self.line_width)
+        band_lut = np.zeros((v_disp_bin.shape[0], v_disp_bin.shape[1]+1),
+                            dtype=np.uint8)
+        band_lut[:, 1:][band] = 255
+        self._band = (band, index2d[non_empty])
+
+        np.add(self._non_obst_bins, 1, out=self._index)
+        np.take(bin2column, self._index, out=self._index)
+        np.add(self._index, self._rows*band_lut.shape[1], out=self._index)
+        np.take(band_lut, self._index, out=out)
+
+        clean_mask(out, self.kernel, self.small_obj_size, self.connectivity,
+                   self._labels, self._is_small)
+
+        return out_full
+
+    def ground_disp_range(self):
+        """
+        Возвращает для каждой строки диапазона row_range последнего кадра
+        наименьший и наибольший диспаритет (в представлении входной карты)
+        ячеек полосы земли (float64, NaN для строк без полосы) или None,
+        если линия земли не найдена.
+        """
+        if self._band is None:
+            return None
+        (band, disps) = self._band
+
+        has_band = band.any(axis=1)
+        disps = disps.astype(np.float64)
+        lo = np.where(band, disps, np.inf).min(axis=1)
+        hi = np.where(band, disps, -np.inf).max(axis=1)
+        lo[~has_band] = np.nan
+        hi[~has_band] = np.nan
+
+        return (lo, hi)
+
+def downsample_disp(disp, level=1):
+    """
+    Возвращает карту диспаритета, уменьшенную в 2**level раз.
+
+    Значение пикселя - среднее валидных пикселей блока 2**level x 2**level,
+    деленное на 2**level (диспаритет уменьшенной стереопары); блоки без
+    валидных пикселей невалидны. Неполные блоки у нижнего и правого края
+    отбрасываются. Представление карты (float или uint16) сохраняется.
+    """
+    f = 2**level
+    (m, n) = (disp.shape[0]//f, disp.shape[1]//f)
+    blocks = disp[:m*f, :n*f].reshape((m, f, n, f))
+    mask_valid = valid_disp_mask(blocks)
+
+    counts = mask_valid.sum(axis=(1, 3))
+    sums = np.where(mask_valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums/(counts*f)
+
+    if is_fixed_point(disp):
+        small = np.full((m, n), INVALID_DISP, dtype=np.uint16)
+        np.rint(means, out=means)
+        np.copyto(small, means, where=counts > 0, casting='unsafe')
+        return small
+
+    return means.astype(disp.dtype)
+
+def pyramid_params(level=1, u_disp_threshold=3, v_disp_threshold=3,
+                   line_width=20, morph_disk_radius=9, small_obj_size=500):
+    """
+    Возвращает параметры алгоритма (словарь) для карты диспаритета,
+    уменьшенной downsample_disp в f=2**level раз.
+
+    Ячейки u-диспаритета земли при уменьшении карты сохраняют число
+    пикселей (строк на единицу диспаритета столько же), а препятствия
+    становятся ниже в f раз, поэтому u_disp_threshold не меняется. Ячейки
+    v-диспаритета теряют f столбцов, и v_disp_threshold уменьшается в f раз,
+    но не ниже 2 (иначе порог пропускает одиночные пиксели). line_width и
+    morph_disk_radius уменьшаются в f раз (ядро не меньше 3), small_obj_size
+    - в f**2 раз.
+    """
+    f = 2**level
+    if f == 1:
+        return dict(u_disp_threshold=u_disp_threshold,
+                    v_disp_threshold=v_disp_threshold,
+                    line_width=line_width,
+                    morph_disk_radius=morph_disk_radius,
+                    small_obj_size=small_obj_size)
+
+    return dict(u_disp_threshold=u_disp_threshold,
+                v_disp_threshold=max(v_disp_threshold/f, 2),
+                line_width=line_width/f,
+                morph_disk_radius=max(int(round(morph_disk_radius/f)), 3),
+                small_obj_size=int(small_obj_size/f**2))
+
+def upsample_mask(mask, shape):
+    """Увеличивает маску до размера shape (ближайший сосед)"""
+    return cv2.resize(mask, (shape[1], shape[0]),
+                      interpolation=cv2.INTER_NEAREST)
+
+class PyramidDetector(object):
+    """
+    Быстрый детектор регионов, доступных для движения, работающий на
+    уменьшенной в 2**level раз карте диспаритета (см. downsample_disp).
+
+    Параметры алгоритма задаются для полного разрешения и пересчитываются
+    pyramid_params. Маска увеличивается до размера кадра; при refine=True
+    пиксели в полосе шириной 2**level вокруг границы маски размечаются
+    заново в полном разрешении: пиксель доступен для движения, если он не
+    относится к препятствию и его диспаритет попадает в диапазон полосы
+    земли своей строки (см. TraversableDetector.ground_disp_range).
+    При квантовании (num_disp_bins) ось уменьшенной карты - [0, max_disp/f).
+    """
+
+    def __init__(self, shape, level=1, refine=False, u_disp_threshold=3,
+                 v_disp_threshold=3, line_width=20, morph_disk_radius=9,
+                 small_obj_size=500, connectivity=1, line_engine='hough',
+                 row_range=None, num_disp_bins=None, max_disp=MAX_DISP):
+        self.shape = tuple(shape[:2])
+        self.level = level
+        self.refine = refine
+
+        f = 2**level
+        small_shape = (self.shape[0]//f, self.shape[1]//f)
+        if row_range is not None:
+            row_range = (row_range[0]//f,
+                         min(-(-row_range[1]//f), small_shape[0]))
+        self.detector = TraversableDetector(
+            small_shape, connectivity=connectivity, line_engine=line_engine,
+            row_range=row_range, num_disp_bins=num_disp_bins,
+            max_disp=max_disp/f,
+            **pyramid_params(level, u_disp_threshold, v_disp_threshold,
+                             line_width, morph_disk_radius, small_obj_size))
+        self._small_out = np.empty(small_shape, dtype=np.uint8)
+        self._edge_kernel = np.ones((2*f+1, 2*f+1), dtype=np.uint8)
+
+    @property
+    def line(self):
+        """Линия земли последнего кадра на уменьшенном v-диспаритете"""
+        return self.detector.line
+
+    def _refine(self, disp, out):
+        """Уточняет маску out в полосе вокруг ее границы"""
+        ground = self.detector.ground_disp_range()
+        if ground is None:
+            return
+
+        f = 2**self.level
+        edge = cv2.morphologyEx(out, cv2.MORPH_GRADIENT, self._edge_kernel)
+        (v, u) = np.nonzero(edge)
+
+        # Строка и столбец уменьшенной карты для каждого пикселя полосы
+        small_v = np.minimum(v//f, self._small_out.shape[0]-1)
+        small_u = np.minimum(u//f, self._small_out.shape[1]-1)
+
+        # Диапазон диспаритета земли в строке (с допуском на округление
+        # среднего по блоку) в представлении полной карты
+        top = self.detector.row_range[0]
+        rows = small_v - top
+        in_range = (rows >= 0) & (rows < ground[0].size)
+        rows = np.clip(rows, 0, ground[0].size-1)
+        lo = (ground[0][rows] - 1)*f
+        hi = (ground[1][rows] + 1)*f
+
+        # Пиксели без валидного диспаритета сохраняют прежнюю разметку
+        pixel_disp = disp[v, u]
+        valid = valid_disp_mask(pixel_disp)
+        (v, u, pixel_disp) = (v[valid], u[valid], pixel_disp[valid])
+        (in_range, lo, hi) = (in_range[valid], lo[valid], hi[valid])
+
+        obst = self._obst_full(small_v[valid], small_u[valid])
+        with np.errstate(invalid='ignore'):
+            traversable = (in_range & ~obst
+                           & (pixel_disp >= lo) & (pixel_disp <= hi))
+
+        out[v, u] = np.where(traversable, 255, 0)
+
+    def _obst_full(self, small_v, small_u):
+        """Признак препятствия для пикселей по маске уменьшенной карты"""
+        top = self.detector.row_range[0]
+        mask_obst = self.detector.mask_obst
+        rows = small_v - top
+        in_range = (rows >= 0) & (rows < mask_obst.shape[0])
+        rows = np.clip(rows, 0, mask_obst.shape[0]-1)
+
+        return in_range & (mask_obst[rows, small_u] != 0)
+
+    def process(self, disp, out=None):
+        """
+        Возвращает маску регионов, доступных для движения (uint8, 0/255),
+        размера входной карты диспаритета. Маска записывается в out, если
+        он задан.
+        """
+        assert disp.shape == self.shape, "unexpected disparity map shape"
+        if out is None:
+            out = np.empty(self.shape, dtype=np.uint8)
+
+        small = downsample_disp(disp, self.level)
+        self.detector.process(small, out=self._small_out)
+        cv2.resize(self._small_out, (self.shape[1], self.shape[0]), dst=out,
+                   interpolation=cv2.INTER_NEAREST)
+
+        if self.refine:
+            self._refine(disp, out)
+
+        return out
+
+class FrameProcessor(object):
+    """
+    Обработка файлов карт диспаритета одного каталога с сохранением масок
+    (режимы командной строки find_traversable.py).
+
+    Детекторы (по одному на размер кадра, диапазон строк и
+    последовательность), диапазоны строк калибровки и трекеры линии земли
+    создаются при первом обращении и используются повторно для следующих
+    кадров. Параметры соответствуют аргументам командной строки; writer -
+    необязательная отложенная запись масок (frame_io.WriteBehind).
+
+    В режиме последовательности без disp_bins используется фиксированная
+    ось SEQUENCE_DISP_BINS (см. ground_line.GroundLineTracker).
+    """
+
+    def __init__(self, dispdirpath, outdirpath, output='png',
+                 float_disp=False, line_engine='hough', sequence=False,
+                 pyramid_level=0, refine=False, band_memory=None,
+                 disp_bins=None, max_disp=MAX_DISP, calib=None,
+                 writer=None):
+        self.dispdirpath = dispdirpath
+        self.outdirpath = outdirpath
+        self.output = output
+        self.float_disp = float_disp
+        self.line_engine = line_engine
+        self.sequence = sequence
+        self.pyramid_level = pyramid_level
+        self.refine = refine
+        self.band_memory = band_memory
+        if sequence and disp_bins is None:
+            disp_bins = SEQUENCE_DISP_BINS
+        self.disp_bins = disp_bins
+        self.max_disp = max_disp
+        self.calib = calib
+        self.writer = writer
+        self.detectors = {}
+        self.row_ranges = {}  # диапазон строк на файл калибровки и размер
+        self.trackers = {}  # трекер линии земли на последовательность
+
+    def _row_range(self, dispfilename, shape):
+        """Диапазон строк ниже горизонта или None (весь кадр)"""
+        if not self.calib:
+            return None
+
+        calib_file = kitti.calib_filename(self.calib, dispfilename)
+        if calib_file is None:
+            print(f"....: no calibration for {dispfilename}, full frame is "
+                  "processed")
+            return None
+        if (calib_file, shape) not in self.row_ranges:
+            self.row_ranges[calib_file, shape] = kitti.valid_row_range(
+                kitti.read_calib(calib_file), shape)
+
+        return self.row_ranges[calib_file, shape]
+
+    def read(self, dispfilename):
+        """Считывает карту диспаритета из каталога dispdirpath"""
+        return read_disp(dispfilename, self.dispdirpath,
+                         fixed_point=not self.float_disp)
+
+    def __call__(self, dispfilename, disp=None):
+        """
+        Обрабатывает файл карты диспаритета (или уже считанную карту disp)
+        и сохраняет маску.
+
+        Возвращает (имя файла маски, время обработки кадра, с).
+        """
+        start = time.perf_counter()
+
+        tags = dispfilename.split('_')
+        if len(tags) == 2:
+            filename = tags[0] + '_road_' + tags[1]
+        else:
+            filename = dispfilename
+
+        if disp is None:
+            disp = self.read(dispfilename)
+
+        sequence = None
+        line_engine = self.line_engine
+        if self.sequence:
+            sequence = kitti_frame_key(dispfilename)[0]
+            if sequence not in self.trackers:
+                self.trackers[sequence] = ground_line.GroundLineTracker(
+                    self.line_engine)
+            line_engine = self.trackers[sequence]
+
+        row_range = self._row_range(dispfilename, disp.shape)
+
+        if self.band_memory:
+            # Полосная обработка с ограниченным объемом временных массивов
+            band_rows = band_rows_for_memory(disp.shape[1],
+                                             self.band_memory*2**20)
+            (_, non_obst_disp, v_disp, index2d) = split_disp_banded(
+                disp, u_disp_threshold=3, morph_disk_radius=9,
+                small_obj_size=500, connectivity=1, return_v_disp=True,
+                row_range=row_range, band_rows=band_rows)
+            detect_traversable_regions_banded(
+                filename, self.outdirpath, non_obst_disp, v_disp_threshold=3,
+                line_width=20, morph_disk_radius=9, small_obj_size=500,
+                connectivity=1, v_disp=v_disp, index2d=index2d,
+                line_engine=line_engine, row_range=row_range,
+                band_rows=band_rows, output=self.output, writer=self.writer)
+            return (filename, time.perf_counter() - start)
+
+        key = (disp.shape, row_range, sequence)
+        if key not in self.detectors and self.pyramid_level > 0:
+            self.detectors[key] = PyramidDetector(
+                disp.shape, level=self.pyramid_level, refine=self.refine,
+                u_disp_threshold=3, v_disp_threshold=3, line_width=20,
+                morph_disk_radius=9, small_obj_size=500, connectivity=1,
+                line_engine=line_engine, row_range=row_range,
+                num_disp_bins=self.disp_bins, max_disp=self.max_disp)
+        elif key not in self.detectors:
+            self.detectors[key] = TraversableDetector(
+                disp.shape, u_disp_threshold=3, v_disp_threshold=3,
+                line_width=20, morph_disk_radius=9, small_obj_size=500,
+                connectivity=1, line_engine=line_engine, row_range=row_range,
+                num_disp_bins=self.disp_bins, max_disp=self.max_disp)
+        detector = self.detectors[key]
+
+        mask_tr_regions = detector.process(disp)
+        if detector.line is not None:
+            save_mask(self.outdirpath, filename, mask_tr_regions, self.output,
+                      self.writer)
+
+        return (filename, time.perf_counter() - start)
+
+# Обработчик кадров процесса-исполнителя пула (см. --jobs)
+_worker_processor = None
+
+def _init_worker(options):
+    """
+    Инициализатор процесса пула: создает обработчик кадров, детекторы и
+    буферы которого используются для всех кадров процесса. OpenCV работает
+    в одном потоке, чтобы процессы не конкурировали за ядра.
+    """
+    global _worker_processor
+    cv2.setNumThreads(1)
+    _worker_processor = FrameProcessor(**options)
+
+def _process_frame(dispfilename):
+    """Обрабатывает кадр в процессе пула (см. FrameProcessor.__call__)"""
+    return _worker_processor(dispfilename)
+
+def jobs_chunk_size(num_frames, jobs):
+    """
+    Возвращает размер порции кадров на задачу пула: около четырех порций на
+    процесс (как Pool.map по умолчанию), чтобы уменьшить накладные расходы
+    на передачу задач и сохранить балансировку нагрузки.
+    """
+    (chunk_size, extra) = divmod(num_frames, 4*jobs)
+    return chunk_size + 1 if extra else max(chunk_size, 1)
+
 # =============================================================================
 # Скипт
 # =============================================================================
 if __name__ == "__main__":
-    start_time = time.clock()
+    start_time = time.perf_counter()
 
     # Анализ аргументов командной строки
     parser = argparse.ArgumentParser(prog='python find_traversable.py',
@@ -226,10 +1625,134 @@ if __name__ == "__main__":
     parser.add_argument('odir',
                         help="path to output directory",
                         metavar="ODIR")
+    parser.add_argument('--output',
+                        choices=['png'] + list(freespace.FREESPACE_MODES),
+                        default='png',
+                        help="""output format: mask image, or per-column
+                                free-space file (*.fsp) with traversable row
+                                runs or the free-space boundary""")
+    parser.add_argument('--float',
+                        action='store_true',
+                        dest='float_disp',
+                        help="""process disparity as float32 with NaN for
+                                invalid values instead of uint16
+                                fixed-point codes""")
+    parser.add_argument('--line-engine',
+                        choices=sorted(ground_line.ENGINES),
+                        default='hough',
+                        help="ground correlation line estimator")
+    parser.add_argument('--sequence',
+                        action='store_true',
+                        help="""process frames in KITTI index order and track
+                                the ground line between consecutive frames
+                                (full search only on tracking failure); uses
+                                a fixed disparity axis, --disp-bins %d by
+                                default""" % SEQUENCE_DISP_BINS)
+    parser.add_argument('--pyramid-level',
+                        type=int,
+                        choices=[0, 1, 2],
+                        default=0,
+                        help="""run detection on a disparity map downsampled
+                                2**LEVEL times (fast low-resolution mode)""")
+    parser.add_argument('--refine',
+                        action='store_true',
+                        help="""relabel the upsampled mask boundary at full
+                                resolution (with --pyramid-level)""")
+    parser.add_argument('--band-memory',
+                        type=float,
+                        metavar="MB",
+                        help="""process frames in horizontal stripes so that
+                                per-stripe temporaries take about MB megabytes
+                                (same output, memory independent of frame
+                                height)""")
+    parser.add_argument('--disp-bins',
+                        type=int,
+                        metavar="N",
+                        help="""quantize disparity into N bins on a fixed axis
+                                [0, MAX_DISP) instead of one bin per distinct
+                                value""")
+    parser.add_argument('--max-disp',
+                        type=float,
+                        default=MAX_DISP,
+                        help="""upper bound of the fixed disparity axis (with
+                                --disp-bins)""")
+    parser.add_argument('--calib',
+                        metavar="CALIB_DIR",
+                        help="""path to KITTI calibration directory; only rows
+                                below the horizon are processed""")
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        metavar="N",
+                        help="""process frames in N worker processes (output
+                                order is unchanged)""")
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        metavar="K",
+                        help="""frames per pool task with --jobs (default:
+                                about four chunks per worker)""")
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=frame_io.PREFETCH_DEPTH,
+                        metavar="K",
+                        help="""decode the next K disparity maps in background
+                                threads (0: synchronous reading)""")
+    parser.add_argument('--write-threads',
+                        type=int,
+                        default=frame_io.WRITE_THREADS,
+                        metavar="N",
+                        help="""encode and write masks in N background threads
+                                (0: synchronous writing)""")
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help="""keep watching the DISP directory and process
+                                new disparity maps; maps listed in the index
+                                are skipped""")
+    parser.add_argument('--index',
+                        metavar="FILE",
+                        help="""index of processed disparity maps with
+                                --watch (default: ODIR/.processed)""")
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=folder_watch.POLL_INTERVAL,
+                        metavar="SECONDS",
+                        help="directory polling period with --watch")
+    parser.add_argument('--settle-time',
+                        type=float,
+                        default=folder_watch.SETTLE_TIME,
+                        metavar="SECONDS",
+                        help="""process a map only when it has not changed for
+                                SECONDS (partially written files)""")
+    parser.add_argument('--max-batch',
+                        type=int,
+                        default=folder_watch.MAX_BATCH,
+                        metavar="N",
+                        help="""disparity maps processed per polling cycle
+                                with --watch (bounds latency of new maps)""")
+    parser.add_argument('--idle-exit',
+                        type=float,
+                        metavar="SECONDS",
+                        help="""with --watch, exit after SECONDS without new
+                                disparity maps""")
     parser.add_argument('-v',
                         action='version',
                         version='%(prog)s 1.0.0')
     args = parser.parse_args()
+    if args.disp_bins and args.band_memory:
+        parser.error("--disp-bins is not supported with --band-memory")
+    if args.band_memory and (args.pyramid_level or args.refine):
+        parser.error("--pyramid-level and --refine are not supported with "
+                     "--band-memory")
+    if args.refine and not args.pyramid_level:
+        parser.error("--refine requires --pyramid-level")
+    if args.sequence and args.band_memory:
+        parser.error("--sequence is not supported with --band-memory (ground "
+                     "line tracking needs a fixed disparity axis)")
+    if args.jobs > 1 and args.sequence:
+        parser.error("--sequence is not supported with --jobs (ground line "
+                     "tracking needs frames in order)")
+    if args.watch and args.jobs > 1:
+        parser.error("--watch is not supported with --jobs")
 
     workdir = os.getcwd()
     disppath = os.path.abspath(args.disp)
@@ -251,36 +1774,90 @@ if __name__ == "__main__":
         print("INFO: UNSUCCESS")
         print("....: invalid path to input disparity map(s)")
         sys.exit(1)
+    if args.watch and not os.path.isdir(disppath):
+        parser.error("--watch needs a DISP directory")
 
 
-    # Реализация алгоритма
-    print("INFO: Traversable regions searching...")
-    for dispfilename in dispfilenames:
+    # В режиме последовательности кадры упорядочиваются по номеру, и линия
+    # земли отслеживается отдельно для каждой последовательности
+    if args.sequence:
+        dispfilenames.sort(key=kitti_frame_key)
 
-        tags = dispfilename.split('_')
-        if len(tags) == 2:
-            filename = tags[0] + '_road_' + tags[1]
-        else:
-            filename = dispfilename
-        print("....:", filename)
+    options = dict(dispdirpath=dispdirpath, outdirpath=outdirpath,
+                   output=args.output, float_disp=args.float_disp,
+                   line_engine=args.line_engine, sequence=args.sequence,
+                   pyramid_level=args.pyramid_level, refine=args.refine,
+                   band_memory=args.band_memory, disp_bins=args.disp_bins,
+                   max_disp=args.max_disp, calib=args.calib)
 
-        disp = read_disp(dispfilename, dispdirpath)
+    # Реализация алгоритма (детекторы создаются один раз на размер кадра и
+    # диапазон строк, в режиме --jobs - в каждом процессе пула)
+    print("INFO: Traversable regions searching...")
+    frame_times = []
+    if args.jobs > 1:
+        chunk_size = args.chunk_size or jobs_chunk_size(len(dispfilenames),
+                                                        args.jobs)
+        with multiprocessing.Pool(args.jobs, initializer=_init_worker,
+                                  initargs=(options,)) as pool:
+            # imap сохраняет порядок кадров независимо от порядка
+            # завершения задач
+            for (filename, frame_time) in pool.imap(_process_frame,
+                                                    dispfilenames,
+                                                    chunk_size):
+                print("....:", filename)
+                frame_times.append(frame_time)
+    else:
+        processor = FrameProcessor(**options)
 
-        (obst_disp, non_obst_disp) = split_disp(disp,
-                                                u_disp_threshold=3,
-                                                morph_disk_radius=9,
-                                                small_obj_size=500,
-                                                connectivity=1)
+        def process(dispfilenames):
+            """Чтение с упреждением и отложенная запись в фоновых потоках"""
+            reader = frame_io.PrefetchReader(dispfilenames, processor.read,
+                                             args.prefetch)
+            with frame_io.WriteBehind(args.write_threads) as writer:
+                processor.writer = writer
+                for (dispfilename, disp) in reader:
+                    (filename, frame_time) = processor(dispfilename, disp)
+                    print("....:", filename)
+                    frame_times.append(frame_time)
+
+        if args.watch:
+            # Новые карты обрабатываются пакетами по мере появления (детекторы
+            # и трекеры сохраняются между пакетами); пакет записывается в
+            # индекс после записи масок
+            watcher = folder_watch.FolderWatcher(
+                dispdirpath, ('*.png',),
+                args.index or os.path.join(outdirpath,
+                                           folder_watch.INDEX_FILENAME),
+                interval=args.poll_interval, settle_time=args.settle_time,
+                max_batch=args.max_batch)
+            print("....: watching {} ({} maps already processed)".format(
+                  dispdirpath, len(watcher.index)))
+            try:
+                for names in watcher.batches(args.idle_exit):
+                    if args.sequence:
+                        names.sort(key=kitti_frame_key)
+                    process(names)
+                    watcher.done(names)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                watcher.close()
+            print("....:", watcher.report())
+        else:
+            process(dispfilenames)
+        trackers = processor.trackers
 
-        mask_tr_regions = detect_traversable_regions(filename,
-                                                     outdirpath,
-                                                     non_obst_disp,
-                                                     v_disp_threshold=3,
-                                                     line_width=20,
-                                                     morph_disk_radius=9,
-                                                     small_obj_size=500,
-                                                     connectivity=1)
+    if args.sequence:
+        print("....: ground line: {} full searches, {} tracked".format(
+              sum(tracker.full_searches for tracker in trackers.values()),
+              sum(tracker.tracked for tracker in trackers.values())))
+    if frame_times:
+        print("....: {} frames, {:.1f} ms per frame, {:.1f}s. total in {} "
+              "process(es)".format(len(frame_times),
+                                   1e3*sum(frame_times)/len(frame_times),
+                                   sum(frame_times), args.jobs))
 
     print("INFO: SUCCESS")
-    print("....: execution time: {:.1f}s.".format(time.clock() - start_time))
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
 
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+folder_watch.py
+
+Режим наблюдения за каталогом для пакетных скриптов (--watch): новые
+файлы обрабатываются по мере появления, обработанные файлы хранятся в
+постоянном индексе, поэтому после перезапуска обрабатываются только
+новые.
+
+    watcher = FolderWatcher(dirpath, ('*.png',), index_file)
+    for names in watcher.batches():
+        process(names)  # результаты записаны до возврата
+        watcher.done(names)
+    print(watcher.report())
+
+Каталог опрашивается каждые interval секунд (os.scandir; для имен из
+индекса stat не выполняется). Файл готов, если он и файлы-компаньоны
+(например, правое изображение стереопары) не изменялись settle_time
+секунд, поэтому частично записанные файлы не обрабатываются. Пакет
+содержит не больше max_batch файлов, чтобы задержка обработки новых
+файлов и потери при прерывании (необработанный пакет не попадает в
+индекс и обрабатывается повторно) были ограничены.
+"""
+import numpy as np
+import collections
+import fnmatch
+import time
+import os
+
+INDEX_FILENAME = '.processed'  # индекс в выходном каталоге
+POLL_INTERVAL = 0.5  # период опроса каталога, с
+SETTLE_TIME = 0.5  # время без изменений до обработки файла, с
+MAX_BATCH = 16  # наибольшее кол. файлов в пакете
+LAG_WINDOW = 1000  # кол. последних файлов для медианы задержки
+
+
+class ProcessedIndex(object):
+    """
+    Постоянный индекс обработанных файлов: текстовый файл, имя на строку,
+    только дописывается. Незавершенная последняя строка (прерванная
+    запись) игнорируется.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.names = set()
+        if os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                self.names.update(line[:-1] for line in f
+                                  if line.endswith('\n'))
+        self._file = open(filename, 'a', encoding='utf-8')
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, names):
+        """Добавляет имена и сбрасывает индекс на диск"""
+        self._file.write(''.join(f"{name}\n" for name in names))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.names.update(names)
+
+    def close(self):
+        self._file.close()
+
+class FolderWatcher(object):
+    """
+    Наблюдение за каталогом dirpath (см. описание модуля): файлы по
+    шаблонам patterns, еще не записанные в индекс index_file. Файл с тем
+    же именем должен быть в каждом каталоге companion_dirs.
+
+    Задержка файла (lag) - время от его последнего изменения до вызова
+    done после обработки. Хранятся задержки последних LAG_WINDOW файлов
+    (lags), кол. обработанных файлов и наибольшая задержка.
+    """
+
+    def __init__(self, dirpath, patterns, index_file, companion_dirs=(),
+                 interval=POLL_INTERVAL, settle_time=SETTLE_TIME,
+                 max_batch=MAX_BATCH):
+        self.dirpath = dirpath
+        self.patterns = patterns
+        self.companion_dirs = companion_dirs
+        self.interval = interval
+        self.settle_time = settle_time
+        self.max_batch = max_batch
+        self.index = ProcessedIndex(index_file)
+        self.lags = collections.deque(maxlen=LAG_WINDOW)
+        self.processed = 0
+        self.max_lag = 0.0
+        self.busy_time = 0.0  # время обработки пакетов, с
+        self._mtimes = {}  # время изменения выданных файлов
+        self._batch_start = None
+
+    def _mtime(self, entry):
+        """
+        Время последнего изменения файла и компаньонов или None, если
+        компаньона нет
+        """
+        mtimes = [entry.stat().st_mtime]
+        for dirpath in self.companion_dirs:
+            try:
+                mtimes.append(os.stat(os.path.join(dirpath,
+                                                   entry.name)).st_mtime)
+            except FileNotFoundError:
+                return None
+        return max(mtimes)
+
+    def poll(self):
+        """
+        Возвращает готовые необработанные файлы (в порядке времени
+        изменения, <= max_batch)
+        """
+        now = time.time()
+        ready = []
+        with os.scandir(self.dirpath) as entries:
+            for entry in entries:
+                name = entry.name
+                if (name in self.index or name.startswith('.')
+                        or not any(fnmatch.fnmatch(name, pattern)
+                                   for pattern in self.patterns)
+                        or not entry.is_file()):
+                    continue
+                mtime = self._mtime(entry)
+                if mtime is not None and now - mtime >= self.settle_time:
+                    ready.append((name, mtime))
+
+        # Пакет - файлы в порядке поступления, поэтому задержка ограничена
+        ready.sort(key=lambda item: (item[1], item[0]))
+        ready = ready[:self.max_batch]
+        self._mtimes.update(ready)
+        return [name for (name, _) in ready]
+
+    def batches(self, idle_exit=None):
+        """
+        Генератор пакетов новых файлов. Завершается, если новых файлов нет
+        idle_exit секунд (None - не завершается).
+        """
+        idle_since = time.perf_counter()
+        while True:
+            names = self.poll()
+            if names:
+                self._batch_start = time.perf_counter()
+                yield names
+                idle_since = time.perf_counter()
+            elif (idle_exit is not None
+                    and time.perf_counter() - idle_since >= idle_exit):
+                return
+            else:
+                time.sleep(self.interval)
+
+    def done(self, names):
+        """Записывает обработанные файлы в индекс"""
+        self.index.add(names)
+        now = time.time()
+        for name in names:
+            lag = now - self._mtimes.pop(name)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+        self.processed += len(names)
+        if self._batch_start is not None:
+            self.busy_time += time.perf_counter() - self._batch_start
+            self._batch_start = None
+
+    def report(self):
+        """Строка с производительностью и задержкой обработки"""
+        if not self.processed:
+            return "no new files"
+        return ("{} files, {:.1f} files/s while busy, lag: median {:.2f}s "
+                "(last {} files), max {:.2f}s".format(
+                    self.processed, self.processed/max(self.busy_time, 1e-9),
+                    np.median(self.lags), len(self.lags), self.max_lag))
+
+    def close(self):
+        self.index.close()
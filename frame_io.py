@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+frame_io.py
+
+Асинхронный ввод-вывод кадров для пакетных скриптов: чтение с упреждением
+(декодирование следующих файлов в фоновых потоках) и отложенная запись
+(кодирование и атомарная запись в фоновых потоках). Кодеки OpenCV и zlib
+освобождают GIL, поэтому вычисления основного потока идут одновременно с
+декодированием и записью.
+
+    reader = PrefetchReader(names, read_fn, depth=PREFETCH_DEPTH)
+    with WriteBehind(threads=WRITE_THREADS) as writer:
+        for (name, data) in reader:
+            writer.submit(path, encode_image, result(data))
+
+При depth=0 и threads=0 чтение и запись выполняются синхронно в
+вызывающем потоке.
+"""
+import concurrent.futures
+import collections
+import threading
+import cv2
+import os
+
+PREFETCH_DEPTH = 4  # кол. файлов, декодируемых заранее
+WRITE_THREADS = 2  # кол. потоков отложенной записи
+
+
+def read_image(filename):
+    """
+    Считывает изображение без преобразования (cv2.IMREAD_UNCHANGED);
+    IOError, если файл не удалось прочитать.
+    """
+    image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError(f"cannot read image: {filename}")
+    return image
+
+def encode_image(filename, image):
+    """
+    Кодирует изображение в формат по расширению filename (cv2.imencode) и
+    возвращает байты файла.
+    """
+    (success, buffer) = cv2.imencode(os.path.splitext(filename)[1], image)
+    if not success:
+        raise IOError(f"cannot encode image: {filename}")
+    return buffer.tobytes()
+
+def atomic_write(filename, data):
+    """
+    Записывает байты в файл атомарно: во временный файл того же каталога с
+    последующим переименованием (прерванная запись не оставляет
+    неполного файла).
+    """
+    (dirpath, name) = os.path.split(os.path.abspath(filename))
+    tmp_filename = os.path.join(dirpath,
+                                f".{name}.{os.getpid()}."
+                                f"{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+class PrefetchReader(object):
+    """
+    Итератор по (элемент, данные) для элементов items в исходном порядке:
+    данные read_fn(элемент) для следующих depth элементов декодируются
+    заранее в threads фоновых потоках (ограниченная очередь: в памяти не
+    больше depth+1 декодированных кадров).
+
+    Исключение read_fn передается в вызывающий поток при получении
+    соответствующего элемента.
+    """
+
+    def __init__(self, items, read_fn, depth=PREFETCH_DEPTH, threads=None):
+        self.items = items
+        self.read_fn = read_fn
+        self.depth = depth
+        self.threads = max(1, min(depth, 2)) if threads is None else threads
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for item in self.items:
+                yield (item, self.read_fn(item))
+            return
+
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+            try:
+                for item in self.items:
+                    pending.append((item, pool.submit(self.read_fn, item)))
+                    if len(pending) > self.depth:
+                        (item, future) = pending.popleft()
+                        yield (item, future.result())
+
+                while pending:
+                    (item, future) = pending.popleft()
+                    yield (item, future.result())
+            finally:
+                # Прерванный обход: незапущенные чтения отменяются
+                for (_, future) in pending:
+                    future.cancel()
+
+class WriteBehind(object):
+    """
+    Отложенная запись: кодирование encode_fn(filename, *args) -> bytes и
+    атомарная запись (см. atomic_write) в threads фоновых потоках.
+
+    submit блокируется, если в очереди max_pending файлов (ограничение
+    памяти). Переданные данные не должны изменяться до записи. Первая
+    ошибка записи передается в вызывающий поток при следующем submit или
+    при close (выход из контекста); close дожидается записи всех файлов.
+    written - кол. записанных файлов.
+    """
+
+    def __init__(self, threads=WRITE_THREADS, max_pending=None):
+        self.threads = threads
+        self.max_pending = (2*max(threads, 1) if max_pending is None
+                            else max_pending)
+        self.written = 0
+        self._lock = threading.Lock()  # защита written
+        self._pool = None
+        self._slots = None
+        self._errors = []
+        if threads > 0:
+            self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+            self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _write(self, filename, encode_fn, args):
+        try:
+            atomic_write(filename, encode_fn(filename, *args))
+            with self._lock:
+                self.written += 1
+            return True
+        except Exception as error:
+            self._errors.append(error)
+            return False
+        finally:
+            self._slots.release()
+
+    def _raise_errors(self):
+        if self._errors:
+            error = self._errors[0]
+            self._errors.clear()
+            raise error
+
+    def submit(self, filename, encode_fn=encode_image, *args):
+        """
+        Ставит в очередь запись файла filename. Возвращает
+        concurrent.futures.Future с результатом True после записи (False
+        при ошибке записи)
+        """
+        if self._pool is None:
+            atomic_write(filename, encode_fn(filename, *args))
+            with self._lock:
+                self.written += 1
+            future = concurrent.futures.Future()
+            future.set_result(True)
+            return future
+
+        self._raise_errors()
+        self._slots.acquire()
+        return self._pool.submit(self._write, filename, encode_fn, args)
+
+    def close(self):
+        """Дожидается записи всех файлов"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+freespace.py
+
+Компактное представление маски регионов, доступных для движения, по
+столбцам изображения (в духе stixel-представления) и его двоичный формат.
+
+Поддерживаются два представления:
+
+    'runs'     - интервалы [начало, конец) строк, доступных для движения, в
+                 каждом столбце (маска восстанавливается без потерь);
+    'boundary' - граница свободного пространства: для каждого столбца
+                 верхняя строка нижнего интервала, доступного для движения
+                 (высота изображения, если таких строк нет); при
+                 восстановлении свободными считаются строки от границы до
+                 низа изображения.
+
+Файл *.fsp: заголовок FREESPACE_HEADER (сигнатура, представление, высота,
+ширина, размер данных) и сжатые zlib данные uint16 little-endian:
+для 'runs' - кол. интервалов по столбцам (W) и пары (начало, конец),
+для 'boundary' - границы по столбцам (W).
+"""
+import numpy as np
+import argparse
+import struct
+import time
+import glob
+import zlib
+import sys
+import cv2
+import os
+
+FREESPACE_MAGIC = b'FSP1'
+FREESPACE_HEADER = struct.Struct('<4sBHHI')
+FREESPACE_MODES = ('runs', 'boundary')
+FREESPACE_END = '.fsp'
+
+
+def mask_to_runs(mask):
+    """
+    Возвращает интервалы строк маски (не нулевых), по столбцам: кол.
+    интервалов в каждом столбце counts (W,) и пары (начало, конец) runs
+    (K, 2), упорядоченные по столбцам и строкам (uint16).
+    """
+    (m, n) = mask.shape
+
+    # Перепады вдоль столбцов (транспонированная маска с нулевыми краями)
+    columns = np.zeros((n, m+2), dtype=np.int8)
+    columns[:, 1:-1] = mask.T != 0
+    steps = np.diff(columns, axis=1)
+    (start_u, start_v) = np.nonzero(steps == 1)
+    (_, stop_v) = np.nonzero(steps == -1)
+
+    counts = np.bincount(start_u, minlength=n).astype(np.uint16)
+    runs = np.column_stack((start_v, stop_v)).astype(np.uint16)
+
+    return (counts, runs)
+
+def runs_to_mask(shape, counts, runs):
+    """Восстанавливает маску uint8 (0/255) по интервалам mask_to_runs"""
+    (m, n) = shape[:2]
+    columns = np.repeat(np.arange(n), counts)
+
+    # Разметка перепадов и накопление вдоль столбцов
+    steps = np.zeros((n, m+1), dtype=np.int16)
+    np.add.at(steps, (columns, runs[:,0].astype(np.intp)), 1)
+    np.add.at(steps, (columns, runs[:,1].astype(np.intp)), -1)
+    mask = np.cumsum(steps[:, :-1], axis=1) > 0
+
+    return mask.T.astype(np.uint8)*255
+
+def mask_to_boundary(mask):
+    """
+    Возвращает границу свободного пространства (uint16, W): для каждого
+    столбца верхнюю строку нижнего интервала маски или высоту маски, если
+    столбец пуст.
+    """
+    (m, n) = mask.shape
+    (counts, runs) = mask_to_runs(mask)
+
+    boundary = np.full(n, m, dtype=np.uint16)
+    non_empty = counts > 0
+    last = np.cumsum(counts.astype(np.intp))[non_empty] - 1
+    boundary[non_empty] = runs[last, 0]
+
+    return boundary
+
+def boundary_to_mask(shape, boundary):
+    """
+    Восстанавливает маску uint8 (0/255) по границе mask_to_boundary:
+    свободны строки от границы до низа изображения.
+    """
+    rows = np.arange(shape[0])[:, np.newaxis]
+    return (rows >= boundary).astype(np.uint8)*255
+
+def encode_freespace(mask, mode='runs'):
+    """Возвращает представление маски mode в двоичном формате *.fsp"""
+    if mode == 'runs':
+        (counts, runs) = mask_to_runs(mask)
+        data = counts.astype('<u2').tobytes() + runs.astype('<u2').tobytes()
+    elif mode == 'boundary':
+        data = mask_to_boundary(mask).astype('<u2').tobytes()
+    else:
+        raise ValueError(f"unknown free-space mode: {mode} "
+                         f"(available: {', '.join(FREESPACE_MODES)})")
+
+    data = zlib.compress(data)
+    header = FREESPACE_HEADER.pack(FREESPACE_MAGIC,
+                                   FREESPACE_MODES.index(mode),
+                                   mask.shape[0], mask.shape[1], len(data))
+    return header + data
+
+def decode_freespace(buffer):
+    """
+    Разбирает данные в формате *.fsp.
+
+    Возвращает (mode, shape, data), где data - (counts, runs) для 'runs'
+    или граница для 'boundary' (см. mask_to_runs, mask_to_boundary).
+    Для усеченных и поврежденных данных возбуждает ValueError.
+    """
+    if len(buffer) < FREESPACE_HEADER.size:
+        raise ValueError("truncated free-space (*.fsp) header")
+    (magic, mode, m, n, size) = FREESPACE_HEADER.unpack_from(buffer)
+    if magic != FREESPACE_MAGIC or mode >= len(FREESPACE_MODES):
+        raise ValueError("not a free-space (*.fsp) file")
+
+    start = FREESPACE_HEADER.size
+    if len(buffer) < start + size:
+        raise ValueError(f"truncated free-space (*.fsp) data: "
+                         f"{len(buffer) - start} of {size} bytes")
+    try:
+        data = zlib.decompress(buffer[start:start+size])
+    except zlib.error as e:
+        raise ValueError(f"corrupt free-space (*.fsp) data: {e}")
+    if len(data) % 2:
+        raise ValueError("corrupt free-space (*.fsp) data: odd size")
+    values = np.frombuffer(data, dtype='<u2').astype(np.uint16)
+
+    # Согласованность данных с размером маски
+    mode = FREESPACE_MODES[mode]
+    if mode == 'runs':
+        (counts, runs) = (values[:n], values[n:])
+        if counts.size != n or runs.size != 2*int(counts.sum(dtype=np.int64)):
+            raise ValueError("corrupt free-space (*.fsp) data: "
+                             "run counts do not match runs")
+        runs = runs.reshape((-1, 2))
+        if (runs[:, 1] > m).any() or (runs[:, 0] >= runs[:, 1]).any():
+            raise ValueError("corrupt free-space (*.fsp) data: "
+                             "runs out of range")
+        return (mode, (m, n), (counts, runs))
+
+    if values.size != n or (values > m).any():
+        raise ValueError("corrupt free-space (*.fsp) data: "
+                         "invalid boundary")
+    return (mode, (m, n), values)
+
+def write_freespace(filename, mask, mode='runs'):
+    """Сохраняет представление маски mode в файл *.fsp"""
+    with open(filename, 'wb') as f:
+        f.write(encode_freespace(mask, mode))
+
+def read_freespace(filename):
+    """Считывает файл *.fsp и возвращает (mode, shape, data), см.
+    decode_freespace"""
+    with open(filename, 'rb') as f:
+        return decode_freespace(f.read())
+
+def read_freespace_mask(filename):
+    """Считывает файл *.fsp и восстанавливает маску uint8 (0/255)"""
+    (mode, shape, data) = read_freespace(filename)
+    if mode == 'runs':
+        return runs_to_mask(shape, *data)
+
+    return boundary_to_mask(shape, data)
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python freespace.py',
+                                 description="""Rebuild traversable region
+                                                masks from free-space
+                                                (*.fsp) files.""",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('fsp',
+                        help="path to input free-space file(s)",
+                        metavar="FSP")
+    parser.add_argument('odir',
+                        help="path to output directory",
+                        metavar="ODIR")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+
+    fsppath = os.path.abspath(args.fsp)
+    outdirpath = os.path.abspath(args.odir)
+
+    if not os.path.exists(outdirpath):
+        os.makedirs(outdirpath)
+
+    if os.path.isfile(fsppath):
+        fsppaths = [fsppath]
+    elif os.path.isdir(fsppath):
+        fsppaths = sorted(glob.glob(f"{fsppath}/*{FREESPACE_END}"))
+    else:
+        print("INFO: UNSUCCESS")
+        print("....: invalid path to input free-space file(s)")
+        sys.exit(1)
+
+    # Восстановление масок
+    print("INFO: Masks rebuilding...")
+    for path in fsppaths:
+        filename = os.path.splitext(os.path.basename(path))[0] + '.png'
+        print("....:", filename)
+        try:
+            mask = read_freespace_mask(path)
+        except ValueError as error:
+            print("INFO: UNSUCCESS")
+            print("....:", os.path.basename(path), "-", error)
+            sys.exit(1)
+        cv2.imwrite(f"{outdirpath}/{filename}", mask)
+
+    print("INFO: SUCCESS")
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ground_line.py
+
+Оценка линии корреляции земной поверхности на карте v-диспаритета.
+
+Линия задается в нормальной форме n*cos(theta) + v*sin(theta) = rho, где
+n - индекс бина диспаритета (столбец карты), v - строка изображения, как в
+cv2.HoughLines. Все оценщики имеют общий интерфейс
+
+    engine(v_disp_bin, v_disp=None) -> (rho, theta) или None,
+
+где v_disp_bin - бинарная карта v-диспаритета (uint8), v_disp - карта
+v-диспаритета с количеством пикселей (используется как веса).
+"""
+import numpy as np
+import cv2
+
+# Допустимый диапазон угла нормали линии земли: диспаритет земли растет
+# вниз по изображению, поэтому theta лежит в (pi/2, pi)
+THETA_RANGE = (np.radians(91), np.radians(170))
+
+
+def normal_form(a, c):
+    """
+    Переводит линию n = a*v + c в нормальную форму (rho, theta),
+    theta в [0, pi).
+    """
+    s = np.hypot(1, a)
+    (cos_theta, sin_theta, rho) = (1/s, -a/s, c/s)
+    if sin_theta < 0 or (sin_theta == 0 and cos_theta < 0):
+        (cos_theta, sin_theta, rho) = (-cos_theta, -sin_theta, -rho)
+
+    return (rho, np.arctan2(sin_theta, cos_theta))
+
+def line_distance(n, v, rho, theta):
+    """Возвращает расстояния от точек (n, v) до линии (rho, theta)"""
+    return np.abs(n*np.cos(theta) + v*np.sin(theta) - rho)
+
+def nonzero_cells(v_disp_bin):
+    """Возвращает координаты (v, n) ненулевых ячеек бинарной карты"""
+    points = cv2.findNonZero(v_disp_bin)
+    if points is None:
+        return (np.empty(0, dtype=np.intc), np.empty(0, dtype=np.intc))
+    points = points.reshape((-1, 2))  # (x, y) = (n, v)
+
+    return (points[:,1], points[:,0])
+
+def line_support(v_disp_bin, rho, theta, tolerance=1, cells=None):
+    """
+    Возвращает кол. ненулевых ячеек бинарной карты v-диспаритета на
+    расстоянии не больше tolerance от линии (rho, theta).
+
+    cells - необязательные координаты ячеек, см. nonzero_cells.
+    """
+    (v, n) = nonzero_cells(v_disp_bin) if cells is None else cells
+    return np.count_nonzero(line_distance(n, v, rho, theta) <= tolerance)
+
+def hough_line(v_disp_bin, v_disp=None, threshold=50):
+    """
+    Полное преобразование Хафа по всем углам с шагом 1 градус.
+
+    Возвращает линию с наибольшим кол. голосов.
+    """
+    lines = cv2.HoughLines(image=v_disp_bin,
+                           rho=1,
+                           theta=np.pi/180,
+                           threshold=threshold)
+    if lines is None:
+        return None
+
+    return tuple(lines[0,0,:])
+
+def constrained_hough_line(v_disp_bin, v_disp=None, threshold=50,
+                           theta_range=THETA_RANGE):
+    """
+    Преобразование Хафа только по углам из диапазона theta_range.
+
+    Аккумулятор содержит лишь допустимые для линии земли наклоны, поэтому
+    голосование выполняется в несколько раз быстрее полного.
+    """
+    lines = cv2.HoughLines(image=v_disp_bin,
+                           rho=1,
+                           theta=np.pi/180,
+                           threshold=threshold,
+                           min_theta=theta_range[0],
+                           max_theta=theta_range[1])
+    if lines is None:
+        return None
+
+    return tuple(lines[0,0,:])
+
+def wls_line(v_disp_bin, v_disp=None, min_rows=10, max_residual=10,
+             iterations=3, init_fraction=1/3):
+    """
+    Взвешенный метод наименьших квадратов по строкам v-диспаритета.
+
+    Для каждой строки берется бин с наибольшим кол. пикселей (вес -
+    кол. пикселей), по этим точкам подбирается линия n = a*v + c. Начальная
+    линия строится по нижней init_fraction строк, где преобладает земля; на
+    каждой следующей итерации используются все точки не дальше max_residual
+    от текущей линии.
+    """
+    if v_disp is None:
+        v_disp = v_disp_bin
+    weights = np.where(v_disp_bin != 0, v_disp, 0)
+
+    v = np.flatnonzero(weights.any(axis=1))
+    if v.size < min_rows:
+        return None
+    n = weights[v].argmax(axis=1)
+    w = np.sqrt(weights[v, n].astype(np.float64))
+
+    inliers = np.zeros(v.size, dtype=bool)
+    inliers[-max(min_rows, int(v.size*init_fraction)):] = True
+    line = None
+    for _ in range(iterations+1):
+        if np.count_nonzero(inliers) < min_rows:
+            break
+        (a, c) = np.polyfit(v[inliers], n[inliers], 1, w=w[inliers])
+        line = normal_form(a, c)
+        inliers = line_distance(n, v, *line) <= max_residual
+
+    return line
+
+def ransac_line(v_disp_bin, v_disp=None, threshold=50, iterations=100,
+                max_residual=4, max_points=2000, theta_range=THETA_RANGE,
+                seed=0):
+    """
+    RANSAC с ограниченным числом итераций по ненулевым ячейкам бинарной
+    карты v-диспаритета.
+
+    Гипотезы строятся по парам случайных точек (гипотезы с наклоном вне
+    theta_range отбрасываются) и оцениваются по кол. точек в пределах
+    max_residual среди не более чем max_points случайных точек. Лучшая
+    уточняется методом наименьших квадратов (полным) по всем своим
+    инлаерам. Если инлаеров меньше threshold, возвращается None.
+    """
+    (v, n) = np.nonzero(v_disp_bin)
+    if v.size < 2:
+        return None
+    (v, n) = (v.astype(np.float64), n.astype(np.float64))
+
+    # Гипотезы по парам точек в нормальной форме, sin(theta) >= 0
+    rng = np.random.RandomState(seed)
+    pairs = rng.randint(0, v.size, size=(iterations, 2))
+    normal_n = v[pairs[:,1]] - v[pairs[:,0]]
+    normal_v = n[pairs[:,0]] - n[pairs[:,1]]
+    flip = (normal_v < 0) | ((normal_v == 0) & (normal_n < 0))
+    normal_n[flip] *= -1
+    normal_v[flip] *= -1
+    theta = np.arctan2(normal_v, normal_n)
+
+    valid = (((normal_n != 0) | (normal_v != 0))
+             & (theta >= theta_range[0]) & (theta <= theta_range[1]))
+    if not valid.any():
+        return None
+    theta = theta[valid]
+    rho = (n[pairs[valid,0]]*np.cos(theta) + v[pairs[valid,0]]*np.sin(theta))
+
+    # Выбор гипотезы с наибольшим кол. инлаеров на подвыборке точек
+    sample = np.arange(v.size)
+    if v.size > max_points:
+        sample = rng.choice(v.size, max_points, replace=False)
+    distances = np.abs(np.outer(np.cos(theta), n[sample])
+                       + np.outer(np.sin(theta), v[sample])
+                       - rho[:, np.newaxis])
+    best = np.count_nonzero(distances <= max_residual, axis=1).argmax()
+
+    inliers = line_distance(n, v, rho[best], theta[best]) <= max_residual
+    if np.count_nonzero(inliers) < threshold:
+        return None
+
+    # Уточнение: нормаль - собственный вектор ковариации инлаеров
+    # с наименьшим собственным значением
+    points = np.vstack((n[inliers], v[inliers]))
+    center = points.mean(axis=1)
+    (_, vectors) = np.linalg.eigh(np.cov(points))
+    (cos_theta, sin_theta) = vectors[:, 0]
+    if sin_theta < 0 or (sin_theta == 0 and cos_theta < 0):
+        (cos_theta, sin_theta) = (-cos_theta, -sin_theta)
+
+    return (center[0]*cos_theta + center[1]*sin_theta,
+            np.arctan2(sin_theta, cos_theta))
+
+ENGINES = {'hough': hough_line,
+           'hough_constrained': constrained_hough_line,
+           'wls': wls_line,
+           'ransac': ransac_line}
+
+class GroundLineTracker(object):
+    """
+    Отслеживание линии земли в последовательности кадров.
+
+    Экземпляр - оценщик с общим интерфейсом (см. описание модуля), который
+    хранит линию предыдущего кадра. Поиск выполняется преобразованием Хафа
+    только в окне theta_window вокруг прежнего угла и только по ячейкам
+    не дальше rho_window от прежней линии. Если линия в окне не найдена или
+    ее опора (см. line_support) упала ниже min_support_ratio от опоры
+    последнего полного поиска, выполняется полный поиск оценщиком engine.
+
+    Линия хранится в координатах столбцов v-диспаритета, поэтому карты
+    v-диспаритета всех кадров должны быть построены на одной фиксированной
+    оси диспаритета (num_disp_bins, см. find_traversable.bin_disp): при
+    оси из значений кадра столбцы разных кадров соответствуют разному
+    диспаритету.
+    """
+
+    def __init__(self, engine='hough', threshold=50, rho_window=10,
+                 theta_window=np.radians(3), min_support_ratio=0.5):
+        self.engine = get_engine(engine)
+        self.threshold = threshold
+        self.rho_window = rho_window
+        self.theta_window = theta_window
+        self.min_support_ratio = min_support_ratio
+        self.line = None
+        self.support = None  # опора линии при последнем полном поиске
+        self.full_searches = 0
+        self.tracked = 0
+
+    def reset(self):
+        """Сбрасывает состояние (следующий кадр - полный поиск)"""
+        self.line = None
+        self.support = None
+
+    def _track(self, v_disp_bin):
+        """Ищет линию в окне вокруг прежней, возвращает ее или None"""
+        (rho, theta) = self.line
+
+        # Голосуют только ячейки не дальше rho_window от прежней линии
+        cells = nonzero_cells(v_disp_bin)
+        near = line_distance(cells[1], cells[0], rho, theta) <= self.rho_window
+        (v, n) = (cells[0][near], cells[1][near])
+        if v.size < self.threshold:
+            return None
+
+        # Аккумулятор Хафа по углам окна на сетке полного поиска (шаг 1
+        # градус) и по rho с шагом 1, как в cv2.HoughLines
+        step = np.pi/180
+        thetas = np.arange(max(0, np.floor((theta-self.theta_window)/step)),
+                           min(180, np.ceil((theta+self.theta_window)/step))
+                           + 1)*step
+        rhos = np.rint(np.outer(np.cos(thetas), n)
+                       + np.outer(np.sin(thetas), v)).astype(np.intp)
+        rho_min = rhos.min()
+        span = rhos.max() - rho_min + 1
+        votes = np.bincount((rhos - rho_min
+                             + span*np.arange(thetas.size)[:, np.newaxis]
+                             ).ravel())
+        best = votes.argmax()
+        if votes[best] < self.threshold:
+            return None
+        line = (float(best % span + rho_min), float(thetas[best // span]))
+
+        if (line_support(v_disp_bin, *line, cells=cells)
+                < self.min_support_ratio*self.support):
+            return None
+        return line
+
+    def __call__(self, v_disp_bin, v_disp=None):
+        if self.line is not None:
+            line = self._track(v_disp_bin)
+            if line is not None:
+                self.line = line
+                self.tracked += 1
+                return line
+
+        self.line = self.engine(v_disp_bin, v_disp)
+        self.full_searches += 1
+        if self.line is not None:
+            self.support = line_support(v_disp_bin, *self.line)
+        return self.line
+
+def get_engine(engine):
+    """
+    Возвращает оценщик линии по имени из ENGINES (или сам engine, если это
+    уже функция с интерфейсом оценщика).
+    """
+    if callable(engine):
+        return engine
+    if engine not in ENGINES:
+        raise ValueError(f"unknown ground line engine: {engine} "
+                         f"(available: {', '.join(sorted(ENGINES))})")
+    return ENGINES[engine]
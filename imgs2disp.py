@@ -6,39 +6,143 @@ imgs2disp.py
 Строит карту диспаратности для изображений с помощью алгоритма StereoSGBM.
 """
 import numpy as np
+import concurrent.futures
+import collections
+import threading
 import argparse
 import time
 import glob
 import sys
 import cv2
 import os
+import frame_io
+import folder_watch
 
 
-def compute_disp(sgbm_obj, imgLname, imgLdirpath,
-                 imgRname, imgRdirpath, outdirpath):
-    """Вычисляет и сохраняет карту диспаритета для стереопары"""
+def read_stereo_pair(imgLname, imgLdirpath, imgRname, imgRdirpath):
+    """Считывает стереопару или возвращает None, если файлов нет"""
 
     if ( os.path.exists(f"{imgLdirpath}/{imgLname}")
             and os.path.exists(f"{imgRdirpath}/{imgRname}")):
         imgL = cv2.imread(f"{imgLdirpath}/{imgLname}", cv2.IMREAD_UNCHANGED)
         imgR = cv2.imread(f"{imgRdirpath}/{imgRname}", cv2.IMREAD_UNCHANGED)
+        return (imgL, imgR)
+    else:
+        return None
 
-        disp = sgbm_obj.compute(imgL, imgR)
+def stereo_disp(sgbm_obj, imgL, imgR, out=None):
+    """
+    Вычисляет карту диспаритета стереопары (uint16, невалидные пиксели
+    равны 65535); результат записывается в out, если он задан
+    """
+    if out is None:
+        out = np.empty(imgL.shape[:2], dtype=np.uint16)
 
-        mask = (disp < 0)
-        disp = disp.astype(np.uint16)
-        disp[mask] = 65535
+    # StereoSGBM пишет int16 прямо в out (без копии)
+    disp = sgbm_obj.compute(imgL, imgR, out.view(np.int16))
+    if not np.shares_memory(disp, out):
+        np.copyto(out.view(np.int16), disp)
+    out[disp < 0] = 65535
 
-        cv2.imwrite(f"{outdirpath}/{imgLname}", disp)
-        return 0
+    return out
+
+def save_disp(outdirpath, imgLname, disp, writer=None):
+    """
+    Сохраняет карту диспаритета; writer - необязательная отложенная запись
+    (frame_io.WriteBehind)
+    """
+    if writer is not None:
+        writer.submit(f"{outdirpath}/{imgLname}", frame_io.encode_image, disp)
     else:
+        cv2.imwrite(f"{outdirpath}/{imgLname}", disp)
+
+def compute_disp(sgbm_obj, imgLname, imgLdirpath,
+                 imgRname, imgRdirpath, outdirpath, writer=None):
+    """Вычисляет и сохраняет карту диспаритета для стереопары"""
+
+    pair = read_stereo_pair(imgLname, imgLdirpath, imgRname, imgRdirpath)
+    if pair is None:
         return 1
 
+    save_disp(outdirpath, imgLname, stereo_disp(sgbm_obj, *pair), writer)
+    return 0
+
+def create_sgbm():
+    """Создает объект StereoSGBM с параметрами построения карт"""
+    window_size = 7
+    num_img_channels = 3
+    sgbm_obj = cv2.StereoSGBM_create(minDisparity = 0,
+                                        numDisparities = 7*16,
+                                        blockSize = 5,
+                                        P1 = 8*num_img_channels*window_size**2,
+                                        P2 = 32*num_img_channels*window_size**2,
+                                        disp12MaxDiff = -1,
+                                        uniquenessRatio = 5,
+                                        preFilterCap = 1,
+                                        speckleWindowSize = 200,
+                                        speckleRange = 1,
+                                        mode = cv2.StereoSGBM_MODE_SGBM_3WAY
+                                        )
+    return sgbm_obj
+
+class ThreadedDispComputer(object):
+    """
+    Вычисление карт диспаритета в пуле потоков (StereoSGBM освобождает GIL
+    на время вычисления).
+
+    Каждый поток использует собственный объект StereoSGBM (создается при
+    первом обращении потока). В обработке одновременно находится не больше
+    inflight стереопар, чтобы ограничить объем изображений в памяти.
+    Внутренние потоки OpenCV делятся между потоками пула: на каждый
+    приходится cv2.getNumberOfCPUs()//threads (не меньше одного).
+    """
+
+    def __init__(self, threads, inflight=None):
+        self.threads = threads
+        self.inflight = 2*threads if inflight is None else max(inflight, 1)
+        self._local = threading.local()
+
+    def _compute(self, imgLname, imgLdirpath, imgRname, imgRdirpath,
+                 outdirpath, writer):
+        if not hasattr(self._local, 'sgbm_obj'):
+            self._local.sgbm_obj = create_sgbm()
+        return compute_disp(self._local.sgbm_obj, imgLname, imgLdirpath,
+                            imgRname, imgRdirpath, outdirpath, writer)
+
+    def run(self, imgLfilenames, imgLdirpath, imgRfilenames, imgRdirpath,
+            outdirpath, writer=None):
+        """
+        Вычисляет и сохраняет карты диспаритета для стереопар (writer -
+        необязательная отложенная запись, см. save_disp).
+
+        Генератор: возвращает (имя левого изображения, результат
+        compute_disp) в порядке входных стереопар.
+        """
+        num_cv_threads = cv2.getNumThreads()
+        cv2.setNumThreads(max(cv2.getNumberOfCPUs()//self.threads, 1))
+
+        pending = collections.deque()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.threads) as pool:
+                for imgLname, imgRname in zip(imgLfilenames, imgRfilenames):
+                    if len(pending) >= self.inflight:
+                        (name, future) = pending.popleft()
+                        yield (name, future.result())
+                    pending.append((imgLname, pool.submit(
+                        self._compute, imgLname, imgLdirpath, imgRname,
+                        imgRdirpath, outdirpath, writer)))
+
+                while pending:
+                    (name, future) = pending.popleft()
+                    yield (name, future.result())
+        finally:
+            cv2.setNumThreads(num_cv_threads)
+
 # =============================================================================
 # Скипт вычисления карт диспарантности
 # =============================================================================
 if __name__ == "__main__":
-    start_time = time.clock()
+    start_time = time.perf_counter()
 
     # Анализ аргументов командной строки
     parser = argparse.ArgumentParser(prog='python imgs2disp.py',
@@ -53,6 +157,62 @@ if __name__ == "__main__":
     parser.add_argument('odir',
                         help="path to output directory",
                         metavar="ODIR")
+    parser.add_argument('--threads',
+                        type=int,
+                        default=1,
+                        metavar="N",
+                        help="""compute disparity maps in N threads, each with
+                                its own StereoSGBM matcher""")
+    parser.add_argument('--inflight',
+                        type=int,
+                        metavar="M",
+                        help="""maximum number of stereo pairs in progress
+                                with --threads (default: 2*N)""")
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=frame_io.PREFETCH_DEPTH,
+                        metavar="K",
+                        help="""decode the next K stereo pairs in background
+                                threads (0: synchronous reading)""")
+    parser.add_argument('--write-threads',
+                        type=int,
+                        default=frame_io.WRITE_THREADS,
+                        metavar="N",
+                        help="""encode and write disparity maps in N
+                                background threads (0: synchronous
+                                writing)""")
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help="""keep watching the IMG_L directory and compute
+                                disparity maps for new stereo pairs; pairs
+                                listed in the index are skipped""")
+    parser.add_argument('--index',
+                        metavar="FILE",
+                        help="""index of processed stereo pairs with --watch
+                                (default: ODIR/.processed)""")
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=folder_watch.POLL_INTERVAL,
+                        metavar="SECONDS",
+                        help="directory polling period with --watch")
+    parser.add_argument('--settle-time',
+                        type=float,
+                        default=folder_watch.SETTLE_TIME,
+                        metavar="SECONDS",
+                        help="""process a pair only when both images have not
+                                changed for SECONDS (partially written
+                                files)""")
+    parser.add_argument('--max-batch',
+                        type=int,
+                        default=folder_watch.MAX_BATCH,
+                        metavar="N",
+                        help="""stereo pairs processed per polling cycle with
+                                --watch (bounds latency of new pairs)""")
+    parser.add_argument('--idle-exit',
+                        type=float,
+                        metavar="SECONDS",
+                        help="""with --watch, exit after SECONDS without new
+                                stereo pairs""")
     parser.add_argument('-v',
                         action='version',
                         version='%(prog)s 1.0.0')
@@ -87,28 +247,59 @@ if __name__ == "__main__":
         print("....: invalid path to input files")
         sys.exit(1)
 
-    # Создание объекта SGBM
-    window_size = 7
-    num_img_channels = 3
-    sgbm_obj = cv2.StereoSGBM_create(minDisparity = 0,
-                                        numDisparities = 7*16,
-                                        blockSize = 5,
-                                        P1 = 8*num_img_channels*window_size**2,
-                                        P2 = 32*num_img_channels*window_size**2,
-                                        disp12MaxDiff = -1,
-                                        uniquenessRatio = 5,
-                                        preFilterCap = 1,
-                                        speckleWindowSize = 200,
-                                        speckleRange = 1,
-                                        mode = cv2.StereoSGBM_MODE_SGBM_3WAY
-                                        )
+    if args.watch and not os.path.isdir(imgLpath):
+        parser.error("--watch needs IMG_L and IMG_R directories")
+
+    sgbm_obj = create_sgbm() if args.threads <= 1 else None
+
+    def process(imgLfilenames, imgRfilenames):
+        """Вычисляет и сохраняет карты диспаритета для стереопар"""
+        with frame_io.WriteBehind(args.write_threads) as writer:
+            if args.threads > 1:
+                # Потоки пула читают стереопары сами, запись - отложенная
+                computer = ThreadedDispComputer(args.threads, args.inflight)
+                for imgLname, _ in computer.run(imgLfilenames, imgLdirpath,
+                                                imgRfilenames, imgRdirpath,
+                                                outdirpath, writer):
+                    print("....:", imgLname)
+            else:
+                # Чтение стереопар с упреждением в фоновых потоках
+                reader = frame_io.PrefetchReader(
+                    list(zip(imgLfilenames, imgRfilenames)),
+                    lambda names: read_stereo_pair(names[0], imgLdirpath,
+                                                   names[1], imgRdirpath),
+                    args.prefetch)
+                for (imgLname, _), pair in reader:
+                    print("....:", imgLname)
+                    if pair is not None:
+                        save_disp(outdirpath, imgLname,
+                                  stereo_disp(sgbm_obj, *pair), writer)
 
     # Вычисление карт диспарантности для входных данных
     print("INFO: Disparity maps executing...")
-    for imgLname, imgRname in zip(imgLfilenames, imgRfilenames):
-        print("....:", imgLname)
-        compute_disp(sgbm_obj, imgLname, imgLdirpath,
-                     imgRname, imgRdirpath, outdirpath)
+    if args.watch:
+        # Новые стереопары обрабатываются пакетами по мере появления;
+        # пакет записывается в индекс после записи карт диспаритета
+        watcher = folder_watch.FolderWatcher(
+            imgLdirpath, ('*.png', '*.jpg', '*.jpeg'),
+            args.index or os.path.join(outdirpath,
+                                       folder_watch.INDEX_FILENAME),
+            companion_dirs=(imgRdirpath,), interval=args.poll_interval,
+            settle_time=args.settle_time, max_batch=args.max_batch)
+        print("....: watching {} ({} pairs already processed)".format(
+              imgLdirpath, len(watcher.index)))
+        try:
+            for names in watcher.batches(args.idle_exit):
+                process(names, names)
+                watcher.done(names)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        print("....:", watcher.report())
+    else:
+        process(imgLfilenames, imgRfilenames)
     print("INFO: SUCCESS")
-    print("....: execution time: {:.1f}s.".format(time.clock() - start_time))
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
 
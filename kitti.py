@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+kitti.py
+
+Работа с калибровкой KITTI-ROAD [1] для поиска свободных для движения
+регионов. Разбор файлов калибровки и таблицы преобразования в вид
+сверху вычисляет devkit_road (BirdsEyeView).
+
+[1] Fritsch J., Kuehnl T., Geiger A. A New Performance Measure and Evaluation
+    Benchmark for Road Detection Algorithms International Conference on
+    Intelligent Transportation Systems (ITSC) / 2013.
+"""
+import numpy as np
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'devkit_road', 'python'))
+from BirdsEyeView import KittiCalibration, BirdsEyeView
+
+
+def calib_filename(calibdirpath, filename, calib_end='.txt'):
+    """
+    Возвращает путь к файлу калибровки для кадра (например, um_000000.png
+    или um_road_000000.png -> <calibdirpath>/um_000000.txt) или None, если
+    файл не найден.
+    """
+    file_key = os.path.splitext(os.path.basename(filename))[0]
+    tags = file_key.split('_')
+
+    calib_file = os.path.join(calibdirpath, file_key + calib_end)
+    if not os.path.isfile(calib_file) and len(tags) == 3:
+        # исключение "road"/"lane" из имени файла
+        calib_file = os.path.join(calibdirpath, tags[0] + '_' + tags[2]
+                                  + calib_end)
+
+    return calib_file if os.path.isfile(calib_file) else None
+
+def read_calib(calib_file):
+    """Считывает калибровку KITTI из файла"""
+    calib = KittiCalibration()
+    calib.readFromFile(fn=calib_file)
+    return calib
+
+def horizon_line(calib):
+    """
+    Возвращает линию горизонта плоскости дороги на изображении (камера P2)
+    в однородных координатах l: l[0]*u + l[1]*v + l[2] = 0.
+
+    Горизонт проходит через точки схода осей X и Z системы координат дороги.
+    """
+    Tr = np.asarray(calib.Tr)
+    return np.cross(Tr[:,0], Tr[:,2])
+
+def valid_row_range(calib, shape, margin=10):
+    """
+    Возвращает диапазон строк (top, bottom), в котором на изображении
+    размера shape может находиться дорога: строки ниже самой высокой точки
+    горизонта с запасом margin строк.
+    """
+    (height, width) = shape[:2]
+    l = horizon_line(calib)
+    if l[1] == 0:
+        # вертикальный горизонт - ограничение невозможно
+        return (0, height)
+
+    v = -(l[0]*np.array([0, width-1]) + l[2])/l[1]
+    top = int(np.clip(np.floor(v.min()) - margin, 0, height))
+
+    return (top, height)
+
+class BevTransform(object):
+    """
+    Преобразование изображений (масок, разметки) размера shape в вид
+    сверху для калибровки calib_file, как BirdsEyeView.compute, но таблица
+    преобразования вычисляется один раз при создании.
+    """
+
+    def __init__(self, calib_file, shape):
+        bev = BirdsEyeView()
+        bev.setup(calib_file)
+        bev.imSize = tuple(shape[:2])
+        bev.computeBEVLookUpTable()
+        self.shape = tuple(bev.bevParams.bev_size)
+        self._bev_index = (bev.bev_z_ind - 1, bev.bev_x_ind - 1)
+        self._image_index = (bev.im_v_float.astype('u4') - 1,
+                             bev.im_u_float.astype('u4') - 1)
+
+    def out_shape(self, image_shape):
+        """Размер вида сверху для изображения размера image_shape"""
+        return self.shape + tuple(image_shape[2:])
+
+    def __call__(self, image, out=None):
+        """Вид сверху изображения image (в out, если задан)"""
+        if out is None:
+            out = np.zeros(self.out_shape(image.shape), dtype=image.dtype)
+        else:
+            out.fill(0)
+        out[self._bev_index] = image[self._image_index]
+        return out
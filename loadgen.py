@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+loadgen.py
+
+Нагрузочное тестирование сервера detect_server.py: concurrency клиентов
+(потоков с отдельными соединениями) отправляют запросы для карт
+диспаритета (или стереопар) каталога по кругу. Выводятся перцентили
+задержки запроса и накладных расходов (задержка минус время вычислений на
+сервере).
+"""
+from multiprocessing import shared_memory
+import concurrent.futures
+import argparse
+import time
+import glob
+import sys
+import os
+import numpy as np
+import find_traversable as ft
+import detect_client
+import frame_io
+
+# Перцентили в отчете
+PERCENTILES = (50, 90, 99)
+
+
+def run_client(socket_path, frames, num_requests, mode, bev=False):
+    """
+    Отправляет num_requests запросов по кругу для кадров frames (пары (имя,
+    массивы)) по одному соединению. Возвращает массивы задержек и времени
+    вычислений на сервере (с).
+    """
+    latency = np.empty(num_requests)
+    compute = np.empty(num_requests)
+    shms = []
+    try:
+        if mode == 'shm':
+            # Карты диспаритета и маски в разделяемой памяти клиента
+            shared = []
+            for (name, (disp,)) in frames:
+                disp_shm = shared_memory.SharedMemory(create=True,
+                                                      size=disp.nbytes)
+                mask_shm = shared_memory.SharedMemory(
+                    create=True, size=disp.shape[0]*disp.shape[1])
+                shms += [disp_shm, mask_shm]
+                np.ndarray(disp.shape, dtype=disp.dtype,
+                           buffer=disp_shm.buf)[:] = disp
+                shared.append((name, disp, disp_shm, mask_shm))
+
+        with detect_client.DetectionClient(socket_path) as client:
+            for i in range(num_requests):
+                (name, arrays) = frames[i % len(frames)]
+                start = time.perf_counter()
+                if mode == 'disp':
+                    client.detect(arrays[0], name, bev=bev)
+                elif mode == 'pair':
+                    client.detect_pair(arrays[0], arrays[1], name, bev=bev)
+                else:
+                    (_, disp, disp_shm, mask_shm) = shared[i % len(frames)]
+                    client.detect_shared(disp_shm, disp.shape, disp.dtype,
+                                         mask_shm, name)
+                latency[i] = time.perf_counter() - start
+                compute[i] = client.compute_time
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    return (latency, compute)
+
+def percentiles(values):
+    return ", ".join("p{} {:.2f}".format(p, 1e3*np.percentile(values, p))
+                     for p in PERCENTILES)
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python loadgen.py',
+                                 description="""Load generator for the
+                                                traversable region detection
+                                                server.""",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('socket',
+                        help="path to the server Unix domain socket",
+                        metavar="SOCKET")
+    parser.add_argument('input',
+                        help="""path to the disparity map(s) or, with --mode
+                                pair, to the left image(s)""",
+                        metavar="INPUT")
+    parser.add_argument('--right',
+                        metavar="IMG_R",
+                        help="path to the right image(s) for --mode pair")
+    parser.add_argument('--mode',
+                        choices=('disp', 'pair', 'shm'),
+                        default='disp',
+                        help="""send disparity maps, stereo pairs or shared
+                                memory handles""")
+    parser.add_argument('--requests',
+                        type=int,
+                        default=100,
+                        help="requests per client")
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=1,
+                        help="number of concurrent clients")
+    parser.add_argument('--bev',
+                        action='store_true',
+                        help="request bird's-eye view masks too")
+    parser.add_argument('--float',
+                        action='store_true',
+                        help="disparity maps are float32 (disp_float=True)")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+
+    inpath = os.path.abspath(args.input)
+    paths = (sorted(glob.glob(f"{inpath}/*.png")) if os.path.isdir(inpath)
+             else [inpath])
+    if not paths or (args.mode == 'pair') != (args.right is not None):
+        print("INFO: UNSUCCESS")
+        print("....: invalid path to input files")
+        sys.exit(1)
+
+    # Входные данные считываются заранее и не входят в измерения
+    if args.mode == 'pair':
+        rightpath = os.path.abspath(args.right)
+        frames = [(os.path.basename(path),
+                   (frame_io.read_image(path),
+                    frame_io.read_image(rightpath if os.path.isfile(rightpath)
+                                        else os.path.join(
+                                            rightpath,
+                                            os.path.basename(path)))))
+                  for path in paths]
+    else:
+        frames = [(os.path.basename(path),
+                   (ft.read_disp(os.path.basename(path),
+                                 os.path.dirname(path),
+                                 fixed_point=not args.float),))
+                  for path in paths]
+
+    print("INFO: Sending requests...")
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(
+            lambda _: run_client(args.socket, frames, args.requests,
+                                 args.mode, args.bev),
+            range(args.concurrency)))
+    total_time = time.perf_counter() - start
+
+    latency = np.concatenate([result[0] for result in results])
+    compute = np.concatenate([result[1] for result in results])
+    print("....: requests: {}, {:.1f} requests/s".format(
+          latency.size, latency.size/total_time))
+    print("....: latency, ms:", percentiles(latency))
+    print("....: server compute, ms:", percentiles(compute))
+    print("....: overhead, ms:", percentiles(latency - compute))
+    print("INFO: SUCCESS")
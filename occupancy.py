@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+occupancy.py
+
+Сетка занятости в виде сверху (bird's-eye view, BEV) непосредственно по
+карте диспаритета: пиксели регионов, доступных для движения, и препятствий
+перепроецируются в метрическую сетку BevParams devkit_road без
+преобразования перспективной маски (transform2BEV).
+
+Сетка имеет размер BevParams.bev_size (строки - расстояние Z от дальней
+границы к ближней, столбцы - боковое смещение X), ячейки принимают
+значения BEV_UNKNOWN, BEV_OCCUPIED и BEV_FREE.
+"""
+import numpy as np
+import argparse
+import time
+import glob
+import sys
+import cv2
+import os
+import find_traversable as ft
+import ground_line
+import kitti
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'devkit_road', 'python'))
+from BirdsEyeView import BevParams, readKittiCalib
+
+BEV_UNKNOWN = 0  # в ячейку не попал ни один пиксель
+BEV_OCCUPIED = 128  # препятствие
+BEV_FREE = 255  # регион, доступный для движения
+
+# Сетка по умолчанию - как в BirdsEyeView devkit_road
+BEV_RES = 0.05
+BEV_X_LIMITS = (-10, 10)
+BEV_Z_LIMITS = (6, 46)
+
+
+def default_bev_params():
+    """Возвращает параметры сетки BirdsEyeView по умолчанию"""
+    return BevParams(BEV_RES, BEV_X_LIMITS, BEV_Z_LIMITS, None)
+
+def stereo_geometry(calib_file):
+    """
+    Возвращает матрицу проекции левой камеры P2 (3x4), базу стереопары
+    P2/P3 (м) и преобразование из выпрямленной системы координат камеры в
+    систему координат дороги (3x4, Tr_cam_to_road * R0_rect^-1) по файлу
+    калибровки KITTI.
+    """
+    calib = kitti.read_calib(calib_file)
+    P3 = readKittiCalib(calib_file)['P3'].reshape((3, 4))
+
+    P2 = np.asarray(calib.P2)
+    baseline = (P2[0,3] - P3[0,3])/P2[0,0]
+    rect_to_road = np.asarray(calib.Tr_cam_to_road*calib.R0_rect.I)[:3]
+
+    return (P2, baseline, rect_to_road)
+
+class BevProjector(object):
+    """
+    Перепроецирование пикселей карты диспаритета заданного размера в сетку
+    вида сверху для одной калибровки.
+
+    Для выпрямленной стереопары точка пикселя (u, v) с диспаритетом d
+    линейно зависит от w = fx*baseline/d, поэтому координаты X и Z дороги
+    равны w*A(u, v) + c. Таблицы A вычисляются один раз при создании, и
+    на кадр остаются деление, два умножения со сложением и один bincount.
+    """
+
+    def __init__(self, calib_file, shape, bev_params=None,
+                 min_obst_points=2, fill_radius=0):
+        self.shape = tuple(shape[:2])
+        self.bev_params = default_bev_params() if bev_params is None \
+                          else bev_params
+        self.min_obst_points = min_obst_points
+        self.fill_kernel = None
+        if fill_radius > 0:
+            self.fill_kernel = cv2.getStructuringElement(
+                cv2.MORPH_ELLIPSE, (2*fill_radius+1, 2*fill_radius+1))
+
+        (P2, baseline, rect_to_road) = stereo_geometry(calib_file)
+        (fx, fy, cx, cy) = (P2[0,0], P2[1,1], P2[0,2], P2[1,2])
+        self.fxb = fx*baseline
+
+        # Выпрямленная точка: w*(луч пикселя) + смещение камеры P2
+        (m, n) = self.shape
+        ray_x = (np.arange(n) - cx)/fx
+        ray_y = ((np.arange(m) - cy)/fy)[:, np.newaxis]
+        offset = np.array([(cx*P2[2,3] - P2[0,3])/fx,
+                           (cy*P2[2,3] - P2[1,3])/fy,
+                           -P2[2,3]])
+
+        # Координаты X (строка 0) и Z (строка 2) дороги
+        (R, t) = (rect_to_road[:, :3], rect_to_road[:, 3])
+        self._a_x = (R[0,0]*ray_x + R[0,1]*ray_y + R[0,2]).astype(np.float32)
+        self._a_z = (R[2,0]*ray_x + R[2,1]*ray_y + R[2,2]).astype(np.float32)
+        (self._c_x, _, self._c_z) = R @ offset + t
+
+    def cells(self, disp, mask=None):
+        """
+        Возвращает плоские индексы ячеек сетки для валидных пикселей карты
+        диспаритета (внутри маски, если задана), попадающих в сетку, и
+        маску этих пикселей среди выбранных.
+        """
+        params = self.bev_params
+        (rows, cols) = params.bev_size
+
+        select = ft.valid_disp_mask(disp) & (disp > 0)
+        scale = ft.DISP_SCALE if ft.is_fixed_point(disp) else 1
+        if mask is not None:
+            select &= mask.astype(bool)
+
+        w = self.fxb*scale/disp[select]
+        x = w*self._a_x[select] + self._c_x
+        z = w*self._a_z[select] + self._c_z
+
+        row = np.floor((params.bev_zLimits[1] - z)/params.bev_res)
+        col = np.floor((x - params.bev_xLimits[0])/params.bev_res)
+        inside = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+
+        return ((row[inside]*cols + col[inside]).astype(np.intp), select,
+                inside)
+
+    def occupancy(self, disp, mask_tr_regions, mask_obst):
+        """
+        Возвращает сетку занятости (uint8, BevParams.bev_size) для карты
+        диспаритета (float32 или uint16 с фиксированной точкой), маски
+        регионов, доступных для движения, и маски препятствий.
+
+        Пиксели обеих масок раскладываются по ячейкам одним bincount.
+        Ячейка занята, если в нее попало не меньше min_obst_points пикселей
+        препятствий, иначе свободна, если в нее попал пиксель региона.
+        При fill_radius > 0 свободная область замыкается (заполнение
+        разрывов между дальними строками изображения).
+        """
+        labelled = (mask_tr_regions != 0) | (mask_obst != 0)
+        (index, select, inside) = self.cells(disp, labelled)
+        is_obst = (mask_obst[select] != 0)[inside]
+
+        size = self.bev_params.bev_size[0]*self.bev_params.bev_size[1]
+        counts = np.bincount(2*index + is_obst, minlength=2*size)
+        counts = counts.reshape(self.bev_params.bev_size + (2,))
+
+        free = (counts[:, :, 0] > 0).astype(np.uint8)
+        if self.fill_kernel is not None:
+            cv2.morphologyEx(free, cv2.MORPH_CLOSE, self.fill_kernel, dst=free)
+
+        grid = np.where(free != 0, BEV_FREE, BEV_UNKNOWN).astype(np.uint8)
+        grid[counts[:, :, 1] >= self.min_obst_points] = BEV_OCCUPIED
+
+        return grid
+
+def detect_occupancy(detector, projector, disp):
+    """
+    Возвращает сетку занятости для карты диспаритета или None, если линия
+    земли не найдена: регионы, доступные для движения, и препятствия
+    находит детектор (TraversableDetector), перепроецирует projector
+    (BevProjector).
+    """
+    mask_tr_regions = detector.process(disp)
+    if detector.line is None:
+        return None
+
+    # Маска препятствий детектора - только в диапазоне строк row_range
+    (top, bottom) = detector.row_range
+    mask_obst = np.zeros(disp.shape, dtype=np.uint8)
+    mask_obst[top:bottom] = detector.mask_obst
+
+    return projector.occupancy(disp, mask_tr_regions, mask_obst)
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python occupancy.py',
+                                 description="""Bird's-eye view occupancy grid
+                                                built directly from disparity
+                                                maps.""",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('disp',
+                        help="path to input disparity map(s)",
+                        metavar="DISP")
+    parser.add_argument('calib',
+                        help="path to KITTI calibration directory",
+                        metavar="CALIB_DIR")
+    parser.add_argument('odir',
+                        help="path to output directory",
+                        metavar="ODIR")
+    parser.add_argument('--float',
+                        action='store_true',
+                        dest='float_disp',
+                        help="""process disparity as float32 with NaN for
+                                invalid values instead of uint16
+                                fixed-point codes""")
+    parser.add_argument('--line-engine',
+                        choices=sorted(ground_line.ENGINES),
+                        default='hough',
+                        help="ground correlation line estimator")
+    parser.add_argument('--fill-radius',
+                        type=int,
+                        default=4,
+                        help="""radius (in cells) of the closing that fills
+                                gaps between far image rows in free space""")
+    parser.add_argument('--min-obst-points',
+                        type=int,
+                        default=2,
+                        help="""minimum number of obstacle pixels for an
+                                occupied cell""")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+
+    disppath = os.path.abspath(args.disp)
+    outdirpath = os.path.abspath(args.odir)
+
+    if not os.path.exists(outdirpath):
+        os.makedirs(outdirpath)
+
+    if os.path.isfile(disppath):
+        disppaths = [disppath]
+    elif os.path.isdir(disppath):
+        disppaths = sorted(glob.glob(f"{disppath}/*.png"))
+    else:
+        print("INFO: UNSUCCESS")
+        print("....: invalid path to input disparity map(s)")
+        sys.exit(1)
+
+    # Детекторы - по одному на размер кадра и диапазон строк, таблицы
+    # перепроецирования и диапазоны строк - по одному на файл калибровки и
+    # размер кадра
+    print("INFO: Occupancy grids building...")
+    detectors = {}
+    projectors = {}
+    row_ranges = {}
+    for path in disppaths:
+        (dispdirpath, dispfilename) = os.path.split(path)
+
+        tags = dispfilename.split('_')
+        if len(tags) == 2:
+            filename = tags[0] + '_road_' + tags[1]
+        else:
+            filename = dispfilename
+        print("....:", filename)
+
+        calib_file = kitti.calib_filename(args.calib, dispfilename)
+        if calib_file is None:
+            print("....: no calibration, skipped")
+            continue
+
+        disp = ft.read_disp(dispfilename, dispdirpath,
+                            fixed_point=not args.float_disp)
+
+        if (calib_file, disp.shape) not in projectors:
+            projectors[calib_file, disp.shape] = BevProjector(
+                calib_file, disp.shape, min_obst_points=args.min_obst_points,
+                fill_radius=args.fill_radius)
+        projector = projectors[calib_file, disp.shape]
+
+        if (calib_file, disp.shape) not in row_ranges:
+            row_ranges[calib_file, disp.shape] = kitti.valid_row_range(
+                kitti.read_calib(calib_file), disp.shape)
+        row_range = row_ranges[calib_file, disp.shape]
+        if (disp.shape, row_range) not in detectors:
+            detectors[disp.shape, row_range] = ft.TraversableDetector(
+                disp.shape, u_disp_threshold=3, v_disp_threshold=3,
+                line_width=20, morph_disk_radius=9, small_obj_size=500,
+                connectivity=1, line_engine=args.line_engine,
+                row_range=row_range)
+        detector = detectors[disp.shape, row_range]
+
+        grid = detect_occupancy(detector, projector, disp)
+        if grid is not None:
+            cv2.imwrite(f"{outdirpath}/{filename}", grid)
+
+    print("INFO: SUCCESS")
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+orchestrator.py
+
+Потоковая обработка набора данных вместо demonstrate.sh: каждый кадр
+проходит все этапы (StereoSGBM, поиск регионов, наложение на изображение,
+вид сверху, накопление оценки) сразу, не дожидаясь обработки остальных
+кадров предыдущим этапом.
+
+Этапы - сопрограммы asyncio, связанные очередями ограниченной длины
+(обратное давление: быстрый этап ждет, пока медленный освободит место).
+Вычисления выполняются в пуле потоков (run_in_executor), поэтому этапы
+работают одновременно (OpenCV освобождает GIL). На диск записываются только
+запрошенные результаты кадра, промежуточные каталоги не нужны.
+"""
+import numpy as np
+import concurrent.futures
+import argparse
+import asyncio
+import time
+import glob
+import sys
+import cv2
+import os
+import find_traversable as ft
+import ground_line
+import imgs2disp
+import kitti
+import frame_io
+import pipeline
+from overlay_img_with_tr_regs import encode_png
+
+# Результаты, которые можно сохранить (подкаталоги ODIR)
+SAVE_STAGES = ('disp', 'mask', 'overlay', 'bev')
+
+# Длина очередей между этапами
+QUEUE_SIZE = 2
+
+
+class FrameStages(object):
+    """
+    Этапы обработки кадра для orchestrate. Кадр - словарь с именем левого
+    изображения 'filename' и результатами этапов; каждый этап добавляет
+    свой результат и удаляет ненужные далее массивы.
+
+    Объекты StereoSGBM, детекторы и преобразования вида сверху создаются
+    один раз; каждый этап выполняется одной сопрограммой, поэтому они не
+    используются одновременно из разных потоков.
+    """
+
+    def __init__(self, calibdirpath, gtdirpath=None, line_engine='hough',
+                 overlay=True):
+        self.calibdirpath = calibdirpath
+        self.gtdirpath = gtdirpath
+        self.line_engine = line_engine
+        self.overlay = overlay
+        self.sgbm_obj = imgs2disp.create_sgbm()
+        self.detectors = {}
+        self.bevs = {}
+        self.evaluation = pipeline.RoadEvaluation()
+
+    def read(self, paths):
+        """Считывает стереопару"""
+        return {'filename': os.path.basename(paths[0]),
+                'imgL': frame_io.read_image(paths[0]),
+                'imgR': frame_io.read_image(paths[1])}
+
+    def disp(self, frame):
+        frame['disp'] = imgs2disp.stereo_disp(self.sgbm_obj, frame['imgL'],
+                                              frame.pop('imgR'))
+        return frame
+
+    def detect(self, frame):
+        disp = frame['disp']
+        if disp.shape not in self.detectors:
+            self.detectors[disp.shape] = ft.TraversableDetector(
+                disp.shape, u_disp_threshold=3, v_disp_threshold=3,
+                line_width=20, morph_disk_radius=9, small_obj_size=500,
+                connectivity=1, line_engine=self.line_engine)
+        frame['mask'] = self.detectors[disp.shape].process(disp)
+        return frame
+
+    def overlay_image(self, frame):
+        imgL = frame.pop('imgL')
+        if self.overlay:
+            frame['overlay'] = pipeline.overlay_image(imgL, frame['mask'])
+        return frame
+
+    def bev(self, frame):
+        """Маска и разметка (если есть) вида сверху"""
+        calib_file = kitti.calib_filename(self.calibdirpath,
+                                          frame['filename'])
+        if calib_file is None:
+            return frame
+        key = (calib_file, frame['mask'].shape)
+        if key not in self.bevs:
+            self.bevs[key] = kitti.BevTransform(calib_file,
+                                                frame['mask'].shape)
+        bev = self.bevs[key]
+        frame['bev'] = bev(frame['mask'])
+
+        gt_file = (pipeline.gt_filename(self.gtdirpath, frame['filename'])
+                   if self.gtdirpath else None)
+        if gt_file is not None:
+            frame['gt_bev'] = bev(cv2.imread(gt_file, cv2.IMREAD_UNCHANGED))
+        return frame
+
+    def evaluate(self, frame):
+        if 'gt_bev' in frame:
+            self.evaluation.add(frame['filename'], frame['bev'],
+                                frame.pop('gt_bev'))
+        return frame
+
+async def _stage(fn, executor, in_queue, out_queue):
+    """
+    Этап: берет кадры из in_queue, выполняет fn в пуле потоков и передает
+    результат в out_queue (ожидая места в ней). None - конец потока.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        frame = await in_queue.get()
+        if frame is None:
+            await out_queue.put(None)
+            return
+        await out_queue.put(await loop.run_in_executor(executor, fn, frame))
+
+async def _feed(pairs, queue):
+    for paths in pairs:
+        await queue.put(paths)
+    await queue.put(None)
+
+async def orchestrate(pairs, stages, sink, queue_size=QUEUE_SIZE):
+    """
+    Пропускает стереопары pairs (пары путей) через этапы stages
+    (FrameStages) и вызывает sink(frame) для каждого обработанного кадра
+    (в пуле потоков, в порядке pairs).
+
+    Возвращает время до первого результата (с) или None, если кадров нет.
+    """
+    chain = [stages.read, stages.disp, stages.detect, stages.overlay_image,
+             stages.bev, stages.evaluate, sink]
+    queues = [asyncio.Queue(queue_size) for _ in range(len(chain) + 1)]
+    start = time.perf_counter()
+    first_result = None
+
+    with concurrent.futures.ThreadPoolExecutor(len(chain)) as executor:
+        tasks = [asyncio.create_task(_feed(pairs, queues[0]))]
+        tasks += [asyncio.create_task(_stage(fn, executor, queues[i],
+                                             queues[i+1]))
+                  for (i, fn) in enumerate(chain)]
+
+        # Выход последнего этапа; ошибка любого этапа прерывает обработку
+        running = set(tasks)
+        getter = None
+        while True:
+            if getter is None:
+                getter = asyncio.create_task(queues[-1].get())
+            (done, _) = await asyncio.wait(running | {getter},
+                                           return_when=asyncio.FIRST_COMPLETED)
+            for task in done - {getter}:
+                running.discard(task)
+                if task.exception() is not None:
+                    for other in running | {getter}:
+                        other.cancel()
+                    raise task.exception()
+
+            if getter in done:
+                frame = getter.result()
+                getter = None
+                if frame is None:
+                    break
+                if first_result is None:
+                    first_result = time.perf_counter() - start
+
+        await asyncio.gather(*tasks)
+
+    return first_result
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python orchestrator.py',
+                                 description="""Stream frames through stereo
+                                                matching, traversable region
+                                                detection, overlay,
+                                                bird's-eye view and
+                                                evaluation.""",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('imgl',
+                        help="path to the left image(s)",
+                        metavar="IMG_L")
+    parser.add_argument('imgr',
+                        help="path to the right image(s)",
+                        metavar="IMG_R")
+    parser.add_argument('calib',
+                        help="path to KITTI calibration directory",
+                        metavar="CALIB_DIR")
+    parser.add_argument('odir',
+                        help="path to output directory",
+                        metavar="ODIR")
+    parser.add_argument('--gt',
+                        metavar="GT_DIR",
+                        help="""path to perspective ground truth (gt_image_2)
+                                for evaluation""")
+    parser.add_argument('--save',
+                        nargs='*',
+                        choices=SAVE_STAGES,
+                        default=['mask', 'bev'],
+                        help="results written to ODIR/<stage>")
+    parser.add_argument('--queue-size',
+                        type=int,
+                        default=QUEUE_SIZE,
+                        help="frames buffered between consecutive stages")
+    parser.add_argument('--line-engine',
+                        choices=sorted(ground_line.ENGINES),
+                        default='hough',
+                        help="ground correlation line estimator")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+
+    imgLpath = os.path.abspath(args.imgl)
+    imgRpath = os.path.abspath(args.imgr)
+    outdirpath = os.path.abspath(args.odir)
+
+    if os.path.isfile(imgLpath) and os.path.isfile(imgRpath):
+        pairs = [(imgLpath, imgRpath)]
+    elif os.path.isdir(imgLpath) and os.path.isdir(imgRpath):
+        pairs = [(path, os.path.join(imgRpath, os.path.basename(path)))
+                 for path in sorted(glob.glob(f"{imgLpath}/*.png"))]
+    else:
+        print("INFO: UNSUCCESS")
+        print("....: invalid path to input files")
+        sys.exit(1)
+
+    for stage in args.save:
+        os.makedirs(os.path.join(outdirpath, stage), exist_ok=True)
+
+    stages = FrameStages(args.calib, args.gt, args.line_engine,
+                         overlay='overlay' in args.save)
+    written = []  # размеры записанных файлов
+
+    def save(frame):
+        """Сохраняет запрошенные результаты кадра"""
+        filename = frame['filename']
+        print("....:", filename)
+
+        # Имена как у скриптов demonstrate.sh
+        tags = filename.split('_')
+        road_filename = (tags[0] + '_road_' + tags[1] if len(tags) == 2
+                         else filename)
+        for stage in args.save:
+            if stage not in frame:
+                continue
+            path = (f"{outdirpath}/{stage}/"
+                    f"{filename if stage == 'disp' else road_filename}")
+            encode_fn = (encode_png if stage == 'overlay'
+                         else frame_io.encode_image)
+            data = encode_fn(path, frame[stage])
+            frame_io.atomic_write(path, data)
+            written.append(len(data))
+        return frame
+
+    print("INFO: Streaming frames...")
+    first_result = asyncio.run(orchestrate(pairs, stages, save,
+                                           args.queue_size))
+
+    for (category, scores) in stages.evaluation.scores().items():
+        print(f"INFO: {category}:", ", ".join(
+              "{} {:.2f}".format(name, 100*np.ravel(scores[name])[0])
+              for name in pipeline.EVAL_PROPERTIES))
+
+    if first_result is not None:
+        print("INFO: time to first result: {:.2f}s.".format(first_result))
+    print("....: written: {} files, {:.1f} MB".format(
+          len(written), sum(written)/2**20))
+    print("INFO: SUCCESS")
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
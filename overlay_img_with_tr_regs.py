@@ -10,8 +10,10 @@ import argparse
 import time
 import glob
 import sys
+import io
 import os
 from matplotlib import pyplot as plt
+import frame_io
 
 def overlay_image_with_tr_mask(in_image, mask_tr_regions,
                                vis_channel = 1, threshold = 0.5):
@@ -34,11 +36,30 @@ def overlay_image_with_tr_mask(in_image, mask_tr_regions,
                                     )
     return visImage
 
+def read_image_pair(imgLname, imgLdirpath, imgTRname, imgTRdirpath):
+    """
+    Считывает изображение и маску региона или возвращает None, если файлов
+    нет.
+    """
+    if ( os.path.exists(f"{imgLdirpath}/{imgLname}")
+            and os.path.exists(f"{imgTRdirpath}/{imgTRname}")):
+        imgL = plt.imread(f"{imgLdirpath}/{imgLname}")
+        imgTR = plt.imread(f"{imgTRdirpath}/{imgTRname}").astype(bool)
+        return (imgL, imgTR)
+    else:
+        return None
+
+def encode_png(filename, image):
+    """Кодирует изображение в PNG (plt.imsave) и возвращает байты файла"""
+    buffer = io.BytesIO()
+    plt.imsave(buffer, image, format='png')
+    return buffer.getvalue()
+
 # =============================================================================
 # Скипт
 # =============================================================================
 if __name__ == "__main__":
-    start_time = time.clock()
+    start_time = time.perf_counter()
 
     # Анализ аргументов командной строки
     parser = argparse.ArgumentParser(prog='python show_img_with_tr_regs.py',
@@ -53,6 +74,18 @@ if __name__ == "__main__":
     parser.add_argument('odir',
                         help="path to output directory",
                         metavar="ODIR")
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=frame_io.PREFETCH_DEPTH,
+                        metavar="K",
+                        help="""decode the next K image pairs in background
+                                threads (0: synchronous reading)""")
+    parser.add_argument('--write-threads',
+                        type=int,
+                        default=frame_io.WRITE_THREADS,
+                        metavar="N",
+                        help="""encode and write images in N background
+                                threads (0: synchronous writing)""")
     parser.add_argument('-v',
                         action='version',
                         version='%(prog)s 1.0.0')
@@ -85,29 +118,39 @@ if __name__ == "__main__":
         print("....: invalid path to input files")
         sys.exit(1)
 
-    # Объединение
+    pairs = []
     for imgLname, imgTRname in zip(imgLfilenames, imgTRfilenames):
 
         tags = imgTRname.split('_')
         if len(tags) == 3:
             imgLname = tags[0] + "_" + tags[2]
-        print("....:", imgLname)
-
-        if ( os.path.exists(f"{imgLdirpath}/{imgLname}")
-                and os.path.exists(f"{imgTRdirpath}/{imgTRname}")):
-            imgL = plt.imread(f"{imgLdirpath}/{imgLname}")
-            imgTR = plt.imread(f"{imgTRdirpath}/{imgTRname}").astype(np.bool)
-            visImage = overlay_image_with_tr_mask(imgL, imgTR)
-
-            # Сохранение
-            plt.imsave(f"{outdirpath}/{imgTRname}", visImage)
-
-#            # Отображение
-#            plt.figure()
-#            plt.imshow(visImage)
-#            plt.title(f"traversable region ({imgLname})")
-#            plt.show()
-        else:
-            print(f"WARN: file {imgLname} or {imgTRname} not exist")
+        pairs.append((imgLname, imgTRname))
+
+    # Объединение (чтение с упреждением и отложенная запись в фоновых
+    # потоках)
+    reader = frame_io.PrefetchReader(
+        pairs,
+        lambda names: read_image_pair(names[0], imgLdirpath,
+                                      names[1], imgTRdirpath),
+        args.prefetch)
+    with frame_io.WriteBehind(args.write_threads) as writer:
+        for (imgLname, imgTRname), images in reader:
+            print("....:", imgLname)
+
+            if images is not None:
+                visImage = overlay_image_with_tr_mask(*images)
+
+                # Сохранение
+                writer.submit(f"{outdirpath}/{imgTRname}", encode_png,
+                              visImage)
+
+#                # Отображение
+#                plt.figure()
+#                plt.imshow(visImage)
+#                plt.title(f"traversable region ({imgLname})")
+#                plt.show()
+            else:
+                print(f"WARN: file {imgLname} or {imgTRname} not exist")
     print("INFO: SUCCESS")
-    print("....: execution time: {:.1f}s.".format(time.clock() - start_time))
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
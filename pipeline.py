@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pipeline.py
+
+Сквозная обработка в памяти: стереопара -> карта диспаритета (StereoSGBM)
+-> маска регионов, доступных для движения -> вид сверху (BirdsEyeView) ->
+оценка по разметке (evalExp) [1], без промежуточных файлов, которыми
+обмениваются скрипты demonstrate.sh.
+
+Промежуточные результаты сохраняются только по запросу. Для сравнения с
+обработкой через файлы измеряется время кодирования и декодирования в PNG
+тех же массивов, которые записывает и считывает demonstrate.sh.
+
+[1] Fritsch J., Kuehnl T., Geiger A. A New Performance Measure and Evaluation
+    Benchmark for Road Detection Algorithms International Conference on
+    Intelligent Transportation Systems (ITSC) / 2013.
+"""
+import numpy as np
+import multiprocessing
+import collections
+import threading
+import argparse
+import time
+import glob
+import sys
+import cv2
+import os
+import find_traversable as ft
+import ground_line
+import imgs2disp
+import kitti
+import frame_io
+import shm_ring
+from overlay_img_with_tr_regs import overlay_image_with_tr_mask, encode_png
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'devkit_road', 'python'))
+from helper import evalExp, pxEval_maximizeFMeasure
+
+# Пороги вероятности и показатели оценки, как в evaluateRoad
+EVAL_THRESH = np.array(list(range(0, 256)))/255.0
+EVAL_PROPERTIES = ['MaxF', 'AvgPrec', 'PRE_wp', 'REC_wp', 'FPR_wp', 'FNR_wp',
+                   'A_wp']
+
+# Промежуточные результаты, которые можно сохранить (подкаталоги ODIR)
+SAVE_STAGES = ('disp', 'mask', 'overlay', 'bev', 'gt_bev')
+
+
+def gt_filename(gtdirpath, filename):
+    """
+    Возвращает путь к разметке кадра (um_000000.png ->
+    <gtdirpath>/um_road_000000.png) или None, если файла нет.
+    """
+    tags = os.path.splitext(os.path.basename(filename))[0].split('_')
+    if len(tags) == 2:
+        tags = [tags[0], 'road', tags[1]]
+    gt_file = os.path.join(gtdirpath, '_'.join(tags) + '.png')
+
+    return gt_file if os.path.isfile(gt_file) else None
+
+def png_round_trip(image):
+    """Возвращает время (с) кодирования изображения в PNG и декодирования"""
+    start = time.perf_counter()
+    (_, buffer) = cv2.imencode('.png', image)
+    cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+    return time.perf_counter() - start
+
+def overlay_image(imgL, mask_tr_regions):
+    """
+    Изображение с регионом, доступным для движения (RGB float32, как в
+    overlay_img_with_tr_regs.py), для изображения cv2 (BGR uint8).
+    """
+    image = imgL[:, :, ::-1].astype(np.float32)/255
+    return overlay_image_with_tr_mask(image, mask_tr_regions != 0)
+
+class RoadEvaluation(object):
+    """
+    Накопление оценки масок вида сверху по категориям KITTI-ROAD (um_road,
+    umm_road, uu_road), как в evaluateRoad.
+    """
+
+    def __init__(self):
+        self.totals = {}  # категория -> [FN, FP, posNum, negNum]
+
+    def add(self, filename, bev_mask, gt_bev):
+        """Учитывает кадр filename в оценке его категории"""
+        # OpenCV хранит BGR: синий канал - дорога, красный - валидная
+        # область
+        road_area = gt_bev[:, :, 0] > 0
+        valid_area = gt_bev[:, :, 2] > 0
+        prob = np.clip(bev_mask.astype('f4')/np.iinfo(bev_mask.dtype).max,
+                       0., 1.)
+
+        (FN, FP, pos_num, neg_num) = evalExp(road_area, prob, EVAL_THRESH,
+                                             validMap=None,
+                                             validArea=valid_area)
+
+        tags = os.path.splitext(os.path.basename(filename))[0].split('_')
+        category = tags[0] + '_road'
+        if category not in self.totals:
+            self.totals[category] = [np.zeros(EVAL_THRESH.shape),
+                                     np.zeros(EVAL_THRESH.shape), 0, 0]
+        total = self.totals[category]
+        total[0] += FN
+        total[1] += FP
+        total[2] += pos_num
+        total[3] += neg_num
+
+    def scores(self):
+        """
+        Возвращает показатели оценки по категориям (словари
+        pxEval_maximizeFMeasure)
+        """
+        return {category: pxEval_maximizeFMeasure(pos_num, neg_num, FN, FP,
+                                                  thresh=EVAL_THRESH)
+                for (category, (FN, FP, pos_num, neg_num))
+                in sorted(self.totals.items())}
+
+class RoadPipeline(object):
+    """
+    Сквозная обработка стереопар в памяти с накоплением оценки по
+    категориям KITTI-ROAD (um_road, umm_road, uu_road).
+
+    Объект StereoSGBM, детекторы (по одному на размер кадра) и
+    преобразования вида сверху (по одному на файл калибровки) создаются
+    один раз. times - суммарное время этапов, png_times - время
+    кодирования и декодирования в PNG массивов этапов (при
+    measure_png=True).
+    """
+
+    def __init__(self, calibdirpath, gtdirpath=None, line_engine='hough',
+                 measure_png=True):
+        self.calibdirpath = calibdirpath
+        self.gtdirpath = gtdirpath
+        self.line_engine = line_engine
+        self.measure_png = measure_png
+        self.sgbm_obj = imgs2disp.create_sgbm()
+        self.detectors = {}
+        self.bevs = {}
+        self.evaluation = RoadEvaluation()
+        self.times = collections.OrderedDict()
+        self.png_times = collections.OrderedDict()
+
+    def _timed(self, stage, fn, *args):
+        """Выполняет fn(*args) и учитывает время в этапе stage"""
+        start = time.perf_counter()
+        result = fn(*args)
+        self.times[stage] = (self.times.get(stage, 0)
+                             + time.perf_counter() - start)
+        return result
+
+    def _png(self, stage, image):
+        """Учитывает время обмена массивом этапа через файл PNG"""
+        if self.measure_png:
+            self.png_times[stage] = (self.png_times.get(stage, 0)
+                                     + png_round_trip(image))
+
+    def _bev(self, calib_file, shape):
+        key = (calib_file, shape[:2])
+        if key not in self.bevs:
+            self.bevs[key] = kitti.BevTransform(calib_file, shape)
+        return self.bevs[key]
+
+    def _detector(self, shape):
+        if shape not in self.detectors:
+            self.detectors[shape] = ft.TraversableDetector(
+                shape, u_disp_threshold=3, v_disp_threshold=3, line_width=20,
+                morph_disk_radius=9, small_obj_size=500, connectivity=1,
+                line_engine=self.line_engine)
+        return self.detectors[shape]
+
+    def process(self, filename, imgL, imgR):
+        """
+        Обрабатывает стереопару кадра filename (имя левого изображения).
+
+        Возвращает словарь результатов этапов: 'disp' (uint16 с
+        фиксированной точкой), 'mask' (маска, 0/255), 'bev' (маска вида
+        сверху или None без калибровки) и 'gt_bev' (разметка вида сверху
+        или None). При наличии разметки кадр учитывается в оценке.
+        """
+        result = dict.fromkeys(('disp', 'mask', 'bev', 'gt_bev'))
+
+        disp = self._timed('disp', imgs2disp.stereo_disp, self.sgbm_obj,
+                           imgL, imgR)
+        self._png('disp', disp)
+        result['disp'] = disp
+
+        detector = self._detector(disp.shape)
+        mask_tr_regions = self._timed('mask', detector.process, disp)
+        self._png('mask', mask_tr_regions)
+        result['mask'] = mask_tr_regions
+
+        calib_file = kitti.calib_filename(self.calibdirpath, filename)
+        if calib_file is None:
+            return result
+        bev = self._bev(calib_file, mask_tr_regions.shape)
+        result['bev'] = self._timed('bev', bev, mask_tr_regions)
+        self._png('bev', result['bev'])
+
+        gt_file = (gt_filename(self.gtdirpath, filename)
+                   if self.gtdirpath else None)
+        if gt_file is None:
+            return result
+        gt = cv2.imread(gt_file, cv2.IMREAD_UNCHANGED)
+        result['gt_bev'] = self._timed('gt_bev', bev, gt)
+        self._png('gt_bev', result['gt_bev'])
+
+        self._timed('eval', self.evaluation.add, filename, result['bev'],
+                    result['gt_bev'])
+
+        return result
+
+    def scores(self):
+        """Возвращает показатели оценки по категориям (RoadEvaluation)"""
+        return self.evaluation.scores()
+
+def _ring_frames(in_ring, out_ring):
+    """
+    Кадры входного буфера стадии: (номер, представления массивов) до
+    признака конца потока, который передается в выходной буфер. Ячейка
+    освобождается при переходе к следующему кадру.
+    """
+    while True:
+        (frame_id, views) = in_ring.receive()
+        if frame_id == shm_ring.END_OF_STREAM:
+            in_ring.release()
+            break
+        yield (frame_id, views)
+        in_ring.release()
+
+    out_ring.put_end()
+    in_ring.close()
+    out_ring.close()
+
+def _disp_stage(in_ring, out_ring, busy):
+    """
+    Стадия: стереопара -> карта диспаритета (uint16, записывается прямо в
+    ячейку выходного буфера)
+    """
+    sgbm_obj = imgs2disp.create_sgbm()
+    for (frame_id, (imgL, imgR)) in _ring_frames(in_ring, out_ring):
+        (disp,) = out_ring.reserve(frame_id, (imgL.shape[:2], np.uint16))
+        start = time.perf_counter()
+        imgs2disp.stereo_disp(sgbm_obj, imgL, imgR, out=disp)
+        busy[0] += time.perf_counter() - start
+        out_ring.publish()
+
+def _mask_stage(in_ring, out_ring, busy, line_engine):
+    """
+    Стадия: карта диспаритета -> маска регионов, доступных для движения
+    (записывается детектором прямо в ячейку выходного буфера)
+    """
+    detectors = {}
+    for (frame_id, (disp,)) in _ring_frames(in_ring, out_ring):
+        if disp.shape not in detectors:
+            detectors[disp.shape] = ft.TraversableDetector(
+                disp.shape, u_disp_threshold=3, v_disp_threshold=3,
+                line_width=20, morph_disk_radius=9, small_obj_size=500,
+                connectivity=1, line_engine=line_engine)
+
+        (mask_tr_regions,) = out_ring.reserve(frame_id, (disp.shape,
+                                                         np.uint8))
+        start = time.perf_counter()
+        detectors[disp.shape].process(disp, out=mask_tr_regions)
+        busy[1] += time.perf_counter() - start
+        out_ring.publish()
+
+def _bev_stage(in_ring, out_ring, busy, filenames, calibdirpath, gtdirpath):
+    """
+    Стадия: маска -> (маска, маска вида сверху, разметка вида сверху);
+    без калибровки передается только маска, без разметки - две маски.
+    Виды сверху записываются прямо в ячейку выходного буфера.
+    """
+    bevs = {}
+    for (frame_id, (mask_tr_regions,)) in _ring_frames(in_ring, out_ring):
+        start = time.perf_counter()
+        images = []  # изображения для преобразования в вид сверху
+        calib_file = kitti.calib_filename(calibdirpath, filenames[frame_id])
+        if calib_file is not None:
+            key = (calib_file, mask_tr_regions.shape)
+            if key not in bevs:
+                bevs[key] = kitti.BevTransform(calib_file,
+                                               mask_tr_regions.shape)
+            images.append(mask_tr_regions)
+
+            gt_file = (gt_filename(gtdirpath, filenames[frame_id])
+                       if gtdirpath else None)
+            if gt_file is not None:
+                images.append(cv2.imread(gt_file, cv2.IMREAD_UNCHANGED))
+        busy[2] += time.perf_counter() - start
+
+        views = out_ring.reserve(
+            frame_id, (mask_tr_regions.shape, mask_tr_regions.dtype),
+            *((bevs[key].out_shape(image.shape), image.dtype)
+              for image in images))
+        start = time.perf_counter()
+        np.copyto(views[0], mask_tr_regions)
+        for (image, view) in zip(images, views[1:]):
+            bevs[key](image, out=view)
+        busy[2] += time.perf_counter() - start
+        out_ring.publish()
+
+class StagedPipeline(object):
+    """
+    Многопроцессная обработка стереопар: стадии сопоставления (StereoSGBM),
+    поиска регионов и вида сверху работают в отдельных процессах
+    одновременно, кадры передаются между ними через кольцевые буферы в
+    разделяемой памяти (shm_ring) с slots ячейками размера кадра KITTI.
+    Производительность ограничена самой медленной стадией.
+
+    Стадии работают с полной калибровкой без ограничения строк, как
+    RoadPipeline. stage_times - время вычислений стадий ('disp', 'mask',
+    'bev') после run.
+    """
+
+    STAGES = ('disp', 'mask', 'bev')
+
+    def __init__(self, calibdirpath, gtdirpath=None, line_engine='hough',
+                 slots=4, frame_shape=shm_ring.KITTI_FRAME_SHAPE,
+                 bev_shape=shm_ring.KITTI_BEV_SHAPE):
+        self.calibdirpath = calibdirpath
+        self.gtdirpath = gtdirpath
+        self.line_engine = line_engine
+        self.slots = slots
+        frame = tuple(frame_shape[:2])
+        bev = tuple(bev_shape[:2])
+        self.slot_bytes = [
+            shm_ring.ring_bytes([(frame + (3,), np.uint8)]*2),
+            shm_ring.ring_bytes([(frame, np.uint16)]),
+            shm_ring.ring_bytes([(frame, np.uint8)]),
+            shm_ring.ring_bytes([(frame, np.uint8), (bev, np.uint8),
+                                 (bev + (3,), np.uint8)])]
+        self.stage_times = dict.fromkeys(self.STAGES, 0.0)
+
+    def _feed(self, ring, pairs, errors):
+        """Поток чтения стереопар во входной буфер"""
+        try:
+            reader = frame_io.PrefetchReader(
+                pairs, lambda paths: (frame_io.read_image(paths[0]),
+                                      frame_io.read_image(paths[1])))
+            for (frame_id, (_, (imgL, imgR))) in enumerate(reader):
+                ring.put(frame_id, imgL, imgR)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            ring.put_end()
+
+    def run(self, pairs):
+        """
+        Обрабатывает стереопары pairs (пары путей к левому и правому
+        изображениям).
+
+        Генератор: возвращает (имя левого изображения, результаты) в
+        порядке pairs; результаты - словарь 'mask', 'bev', 'gt_bev' (см.
+        RoadPipeline.process, без 'disp'), массивы которого -
+        представления ячейки буфера, действительные до следующего кадра.
+        """
+        filenames = [os.path.basename(imgLpath) for (imgLpath, _) in pairs]
+        rings = [shm_ring.SharedRing(self.slots, slot_bytes)
+                 for slot_bytes in self.slot_bytes]
+        busy = multiprocessing.Array('d', len(self.STAGES), lock=False)
+
+        stages = [multiprocessing.Process(
+                      target=_disp_stage, args=(rings[0], rings[1], busy)),
+                  multiprocessing.Process(
+                      target=_mask_stage,
+                      args=(rings[1], rings[2], busy, self.line_engine)),
+                  multiprocessing.Process(
+                      target=_bev_stage,
+                      args=(rings[2], rings[3], busy, filenames,
+                            self.calibdirpath, self.gtdirpath))]
+        errors = []
+        feeder = threading.Thread(target=self._feed,
+                                  args=(rings[0], pairs, errors), daemon=True)
+        try:
+            for stage in stages:
+                stage.daemon = True
+                stage.start()
+            feeder.start()
+
+            out_ring = rings[-1]
+            while True:
+                try:
+                    (frame_id, views) = out_ring.receive(timeout=1)
+                except TimeoutError:
+                    if any(stage.exitcode not in (None, 0)
+                           for stage in stages):
+                        raise RuntimeError("pipeline stage failed")
+                    continue
+                if frame_id == shm_ring.END_OF_STREAM:
+                    out_ring.release()
+                    break
+
+                result = dict(zip(('mask', 'bev', 'gt_bev'),
+                                  views + [None]*(3 - len(views))))
+                yield (filenames[frame_id], result)
+                del result, views
+                out_ring.release()
+
+            for stage in stages:
+                stage.join()
+            feeder.join()
+            if errors:
+                raise errors[0]
+            self.stage_times = dict(zip(self.STAGES, busy))
+        finally:
+            for stage in stages:
+                if stage.is_alive():
+                    stage.terminate()
+            for ring in rings:
+                ring.close()
+                ring.unlink()
+
+# =============================================================================
+# Скипт
+# =============================================================================
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+
+    # Анализ аргументов командной строки
+    parser = argparse.ArgumentParser(prog='python pipeline.py',
+                                 description="""In-memory pipeline from stereo
+                                                pairs to traversable regions,
+                                                bird's-eye view and
+                                                evaluation.""",
+                                 epilog="Abramenko A.A.")
+    parser.add_argument('imgl',
+                        help="path to the left image(s)",
+                        metavar="IMG_L")
+    parser.add_argument('imgr',
+                        help="path to the right image(s)",
+                        metavar="IMG_R")
+    parser.add_argument('calib',
+                        help="path to KITTI calibration directory",
+                        metavar="CALIB_DIR")
+    parser.add_argument('--gt',
+                        metavar="GT_DIR",
+                        help="""path to perspective ground truth (gt_image_2)
+                                for evaluation""")
+    parser.add_argument('--odir',
+                        help="""path to output directory for the stages
+                                requested with --save""")
+    parser.add_argument('--save',
+                        nargs='+',
+                        choices=SAVE_STAGES,
+                        default=[],
+                        help="intermediate results written to ODIR/<stage>")
+    parser.add_argument('--line-engine',
+                        choices=sorted(ground_line.ENGINES),
+                        default='hough',
+                        help="ground correlation line estimator")
+    parser.add_argument('--no-png-cost',
+                        action='store_false',
+                        dest='measure_png',
+                        help="""do not measure the PNG encode/decode time of
+                                the file-based pipeline""")
+    parser.add_argument('--staged',
+                        action='store_true',
+                        help="""run matching, region detection and
+                                bird's-eye view in separate processes
+                                connected by shared-memory ring buffers""")
+    parser.add_argument('--slots',
+                        type=int,
+                        default=4,
+                        help="frames per ring buffer (with --staged)")
+    parser.add_argument('-v',
+                        action='version',
+                        version='%(prog)s 1.0.0')
+    args = parser.parse_args()
+    if args.save and not args.odir:
+        parser.error("--save requires --odir")
+    if args.staged and set(args.save) & {'disp', 'overlay'}:
+        parser.error("--save disp/overlay is not supported with --staged")
+
+    imgLpath = os.path.abspath(args.imgl)
+    imgRpath = os.path.abspath(args.imgr)
+
+    if os.path.isfile(imgLpath) and os.path.isfile(imgRpath):
+        pairs = [(imgLpath, imgRpath)]
+    elif os.path.isdir(imgLpath) and os.path.isdir(imgRpath):
+        pairs = [(path, os.path.join(imgRpath, os.path.basename(path)))
+                 for path in sorted(glob.glob(f"{imgLpath}/*.png"))]
+    else:
+        print("INFO: UNSUCCESS")
+        print("....: invalid path to input files")
+        sys.exit(1)
+
+    outdirpath = os.path.abspath(args.odir) if args.odir else None
+    for stage in args.save:
+        os.makedirs(os.path.join(outdirpath, stage), exist_ok=True)
+
+    if args.staged:
+        # Стадии в отдельных процессах, обмен через разделяемую память
+        print("INFO: Staged pipeline processing...")
+        pipeline = StagedPipeline(args.calib, args.gt, args.line_engine,
+                                  args.slots)
+        evaluation = RoadEvaluation()
+        run_start = time.perf_counter()
+        with frame_io.WriteBehind() as writer:
+            for (filename, result) in pipeline.run(pairs):
+                print("....:", filename)
+                tags = filename.split('_')
+                road_filename = (tags[0] + '_road_' + tags[1]
+                                 if len(tags) == 2 else filename)
+                for stage in ('mask', 'bev', 'gt_bev'):
+                    if stage in args.save and result[stage] is not None:
+                        # Ячейка буфера освобождается до записи
+                        writer.submit(
+                            f"{outdirpath}/{stage}/{road_filename}",
+                            frame_io.encode_image, result[stage].copy())
+                if result['gt_bev'] is not None:
+                    evaluation.add(filename, result['bev'], result['gt_bev'])
+        run_time = time.perf_counter() - run_start
+
+        for (category, scores) in evaluation.scores().items():
+            print(f"INFO: {category}:", ", ".join(
+                  "{} {:.2f}".format(name, 100*np.ravel(scores[name])[0])
+                  for name in EVAL_PROPERTIES))
+        print("INFO: stage compute time: {} (sum {:.2f}s.)".format(
+              ", ".join("{} {:.2f}s.".format(stage, seconds)
+                        for (stage, seconds) in pipeline.stage_times.items()),
+              sum(pipeline.stage_times.values())))
+        print("....: {} frames in {:.2f}s. ({:.1f} frames/s)".format(
+              len(pairs), run_time, len(pairs)/run_time))
+        print("INFO: SUCCESS")
+        print("....: execution time: {:.1f}s.".format(
+              time.perf_counter() - start_time))
+        sys.exit(0)
+
+    pipeline = RoadPipeline(args.calib, args.gt, args.line_engine,
+                            args.measure_png)
+
+    # Обработка (чтение с упреждением и отложенная запись в фоновых
+    # потоках)
+    print("INFO: Pipeline processing...")
+    reader = frame_io.PrefetchReader(
+        pairs, lambda paths: (frame_io.read_image(paths[0]),
+                              frame_io.read_image(paths[1])))
+    with frame_io.WriteBehind() as writer:
+        for (imgLpath, _), (imgL, imgR) in reader:
+            filename = os.path.basename(imgLpath)
+            print("....:", filename)
+            result = pipeline.process(filename, imgL, imgR)
+
+            # Имена как у скриптов demonstrate.sh
+            tags = filename.split('_')
+            road_filename = (tags[0] + '_road_' + tags[1] if len(tags) == 2
+                             else filename)
+            if 'disp' in args.save:
+                writer.submit(f"{outdirpath}/disp/{filename}",
+                              frame_io.encode_image, result['disp'])
+            if 'mask' in args.save:
+                writer.submit(f"{outdirpath}/mask/{road_filename}",
+                              frame_io.encode_image, result['mask'])
+            if 'overlay' in args.save:
+                writer.submit(f"{outdirpath}/overlay/{road_filename}",
+                              encode_png,
+                              overlay_image(imgL, result['mask']))
+            for stage in ('bev', 'gt_bev'):
+                if stage in args.save and result[stage] is not None:
+                    writer.submit(f"{outdirpath}/{stage}/{road_filename}",
+                                  frame_io.encode_image, result[stage])
+
+    # Оценка
+    for (category, scores) in pipeline.scores().items():
+        print(f"INFO: {category}:", ", ".join(
+              "{} {:.2f}".format(name, 100*np.ravel(scores[name])[0])
+              for name in EVAL_PROPERTIES))
+
+    # Время этапов в памяти и обмена теми же массивами через PNG
+    compute_time = sum(pipeline.times.values())
+    print("INFO: compute time: {:.2f}s. ({})".format(compute_time, ", ".join(
+          "{} {:.2f}s.".format(stage, seconds)
+          for (stage, seconds) in pipeline.times.items())))
+    if pipeline.png_times:
+        print("....: PNG round trips avoided: {:.2f}s. ({})".format(
+              sum(pipeline.png_times.values()), ", ".join(
+              "{} {:.2f}s.".format(stage, seconds)
+              for (stage, seconds) in pipeline.png_times.items())))
+
+    print("INFO: SUCCESS")
+    print("....: execution time: {:.1f}s.".format(
+          time.perf_counter() - start_time))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+shm_ring.py
+
+Кольцевой буфер кадров в разделяемой памяти для передачи массивов numpy
+между процессами без сериализации (один писатель, один читатель).
+
+Буфер состоит из slots ячеек фиксированного размера slot_bytes. В ячейку
+записывается номер кадра и до MAX_ARRAYS массивов (тип и форма хранятся в
+заголовке ячейки). Писатель резервирует ячейку и получает представления
+массивов прямо в разделяемой памяти (reserve), заполняет их и публикует
+(publish); читатель получает представления (receive) и освобождает ячейку
+после обработки (release). Свободные и заполненные ячейки считаются
+семафорами, поэтому писатель ждет, когда буфер полон, а читатель - когда
+он пуст.
+
+    ring = SharedRing(slots=4, slot_bytes=ring_bytes([(shape, np.uint16)]))
+    # писатель                      # читатель
+    (disp,) = ring.reserve(i, (shape, np.uint16))
+    compute(out=disp)               (i, (disp,)) = ring.receive()
+    ring.publish()                  use(disp)
+                                    ring.release()
+"""
+from multiprocessing import shared_memory
+import multiprocessing
+import numpy as np
+
+MAX_ARRAYS = 3  # наибольшее кол. массивов в ячейке
+MAX_NDIM = 3  # наибольшая размерность массива
+ALIGNMENT = 64  # выравнивание массивов в ячейке (байт)
+END_OF_STREAM = -1  # номер кадра признака конца потока
+
+# Допустимые типы массивов (в заголовке хранится индекс)
+DTYPES = (np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.int16),
+          np.dtype(np.float32))
+
+# Размер кадра KITTI-ROAD с запасом (строки, столбцы) и сетки BirdsEyeView
+KITTI_FRAME_SHAPE = (376, 1242)
+KITTI_BEV_SHAPE = (800, 400)
+
+# Поля заголовка ячейки: номер кадра, затем для каждого массива индекс
+# типа, размерность и форма
+_HEADER_FIELDS = 1 + MAX_ARRAYS*(2 + MAX_NDIM)
+
+
+def _aligned(nbytes):
+    return -(-nbytes // ALIGNMENT)*ALIGNMENT
+
+def ring_bytes(specs):
+    """
+    Возвращает размер ячейки (байт) для массивов specs - пар (форма, тип)
+    """
+    return sum(_aligned(int(np.prod(shape))*np.dtype(dtype).itemsize)
+               for (shape, dtype) in specs)
+
+class SharedRing(object):
+    """
+    Кольцевой буфер кадров в разделяемой памяти (см. описание модуля).
+
+    Создается в главном процессе и передается процессам-стадиям при их
+    создании (аргументом multiprocessing.Process); в процессе-стадии
+    разделяемая память подключается по имени. close освобождает
+    подключение, unlink (только в создавшем процессе) - саму память.
+    """
+
+    def __init__(self, slots, slot_bytes, ctx=multiprocessing):
+        self.slots = slots
+        self.slot_bytes = _aligned(slot_bytes)
+        header_bytes = _aligned(slots*_HEADER_FIELDS*8)
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=header_bytes + slots*self.slot_bytes)
+        self._free = ctx.Semaphore(slots)
+        self._filled = ctx.Semaphore(0)
+        self._attach()
+
+    def _attach(self):
+        """Представления заголовков и данных ячеек и локальные позиции"""
+        self._header = np.ndarray((self.slots, _HEADER_FIELDS),
+                                  dtype=np.int64, buffer=self._shm.buf)
+        self._data_offset = _aligned(self.slots*_HEADER_FIELDS*8)
+        self._head = 0  # следующая ячейка писателя
+        self._tail = 0  # следующая ячейка читателя
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_shm', '_header'):
+            del state[key]
+        state['_shm_name'] = self._shm.name
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop('_shm_name')
+        self.__dict__.update(state)
+        # resource_tracker общий с создавшим процессом, поэтому повторная
+        # регистрация памяти при подключении не приводит к ее удалению
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._attach()
+
+    def _views(self, slot):
+        """Представления массивов ячейки по ее заголовку"""
+        header = self._header[slot]
+        offset = self._data_offset + slot*self.slot_bytes
+        views = []
+        for i in range(MAX_ARRAYS):
+            (code, ndim) = header[1 + i*(2+MAX_NDIM):3 + i*(2+MAX_NDIM)]
+            if code < 0:
+                break
+            shape = tuple(header[3 + i*(2+MAX_NDIM):3 + i*(2+MAX_NDIM)
+                                 + ndim])
+            dtype = DTYPES[code]
+            views.append(np.ndarray(shape, dtype=dtype, buffer=self._shm.buf,
+                                    offset=offset))
+            offset += _aligned(int(np.prod(shape))*dtype.itemsize)
+
+        return views
+
+    def reserve(self, frame_id, *specs, timeout=None):
+        """
+        Ждет свободную ячейку и возвращает представления массивов specs
+        (пары (форма, тип)) в ней для кадра frame_id. Кадр доступен
+        читателю после publish. TimeoutError, если ячейка не освободилась
+        за timeout секунд.
+        """
+        if ring_bytes(specs) > self.slot_bytes or len(specs) > MAX_ARRAYS:
+            raise ValueError(f"frame does not fit into a ring slot "
+                             f"({ring_bytes(specs)} > {self.slot_bytes} "
+                             f"bytes or more than {MAX_ARRAYS} arrays)")
+        if not self._free.acquire(timeout=timeout):
+            raise TimeoutError("no free ring slot")
+
+        header = self._header[self._head]
+        header.fill(-1)
+        header[0] = frame_id
+        for (i, (shape, dtype)) in enumerate(specs):
+            field = 1 + i*(2+MAX_NDIM)
+            header[field] = DTYPES.index(np.dtype(dtype))
+            header[field+1] = len(shape)
+            header[field+2:field+2+len(shape)] = shape
+
+        return self._views(self._head)
+
+    def publish(self):
+        """Публикует зарезервированную ячейку"""
+        self._head = (self._head + 1) % self.slots
+        self._filled.release()
+
+    def put(self, frame_id, *arrays, timeout=None):
+        """
+        Копирует массивы кадра в ячейку и публикует ее (для массивов,
+        которыми владеет вызывающий; результаты вычислений лучше
+        записывать сразу в представления reserve)
+        """
+        views = self.reserve(frame_id, *((a.shape, a.dtype) for a in arrays),
+                             timeout=timeout)
+        for (view, array) in zip(views, arrays):
+            np.copyto(view, array)
+        self.publish()
+
+    def put_end(self, timeout=None):
+        """Публикует признак конца потока"""
+        self.reserve(END_OF_STREAM, timeout=timeout)
+        self.publish()
+
+    def receive(self, timeout=None):
+        """
+        Ждет заполненную ячейку и возвращает (номер кадра, представления
+        массивов). Представления действительны до release. TimeoutError,
+        если кадр не поступил за timeout секунд.
+        """
+        if not self._filled.acquire(timeout=timeout):
+            raise TimeoutError("no frame in ring")
+        frame_id = int(self._header[self._tail, 0])
+        return (frame_id, self._views(self._tail))
+
+    def release(self):
+        """Освобождает ячейку, полученную receive"""
+        self._tail = (self._tail + 1) % self.slots
+        self._free.release()
+
+    def close(self):
+        """
+        Закрывает подключение к разделяемой памяти (если представления
+        ячеек еще используются, память отключается при завершении
+        процесса)
+        """
+        self._header = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+
+    def unlink(self):
+        """Освобождает разделяемую память (в создавшем процессе)"""
+        self._shm.unlink()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Эквивалентность полосной обработки (*_banded, --band-memory) и обработки
+всего кадра: разбиение на бины, v-диспаритет, маски препятствий и
+регионов, доступных для движения.
+"""
+import numpy as np
+import pytest
+import cv2
+import sys
+import os
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import find_traversable as ft
+import imgs2disp
+
+DATA_DIR = os.path.join(REPO_DIR, 'data')
+KITTI_FRAMES = ('um_000000.png', 'umm_000000.png', 'uu_000000.png')
+BAND_ROWS = (37, 64, 128)
+
+DETECT_PARAMS = dict(v_disp_threshold=3, line_width=20, morph_disk_radius=9,
+                     small_obj_size=500, connectivity=1)
+
+
+def to_float(disp):
+    """Карта с фиксированной точкой -> float32 с NaN (как read_disp)"""
+    disp_float = disp.astype(np.float32)/ft.DISP_SCALE
+    disp_float[disp == ft.INVALID_DISP] = np.nan
+    return disp_float
+
+@pytest.fixture(scope='module', params=KITTI_FRAMES)
+def kitti_disp(request):
+    """Карта диспаритета SGBM кадра KITTI (uint16 с фиксированной точкой)"""
+    frame = request.param
+    imgLdirpath = os.path.join(DATA_DIR, 'data_road', 'training', 'image_2')
+    imgRdirpath = os.path.join(DATA_DIR, 'data_road_right', 'training',
+                               'image_3')
+    if not (os.path.isfile(os.path.join(imgLdirpath, frame))
+            and os.path.isfile(os.path.join(imgRdirpath, frame))):
+        pytest.skip("KITTI frame is not available")
+
+    pair = imgs2disp.read_stereo_pair(frame, imgLdirpath, frame, imgRdirpath)
+    return imgs2disp.stereo_disp(imgs2disp.create_sgbm(), *pair)
+
+def assert_equal_nan(a, b):
+    assert a.dtype == b.dtype
+    np.testing.assert_array_equal(a, b)
+
+@pytest.mark.parametrize('band_rows', BAND_ROWS)
+@pytest.mark.parametrize('fixed_point', [True, False])
+def test_bin_disp(kitti_disp, fixed_point, band_rows):
+    disp = kitti_disp if fixed_point else to_float(kitti_disp)
+    (disp_bins, index2d) = ft.bin_disp(disp)
+    (banded_index2d, band_bins) = ft.bin_disp_banded(disp, band_rows)
+
+    assert_equal_nan(banded_index2d, index2d)
+    banded_bins = np.concatenate([
+        band_bins(disp[start:stop])
+        for (start, stop) in ft.iter_bands(slice(0, disp.shape[0]),
+                                           band_rows)])
+    np.testing.assert_array_equal(banded_bins, disp_bins)
+
+    # u- и v-диспаритет по полосам (как в split_disp_banded)
+    (u_disp, v_disp) = ft.count_disp_bins(disp_bins, index2d.size)
+    u_disp_banded = np.zeros_like(u_disp)
+    v_disp_banded = np.empty_like(v_disp)
+    for (start, stop) in ft.iter_bands(slice(0, disp.shape[0]), band_rows):
+        (u_band, v_disp_banded[start:stop]) = ft.count_disp_bins(
+            band_bins(disp[start:stop]), index2d.size)
+        u_disp_banded += u_band
+    np.testing.assert_array_equal(u_disp_banded, u_disp)
+    np.testing.assert_array_equal(v_disp_banded, v_disp)
+
+@pytest.mark.parametrize('band_rows', BAND_ROWS)
+@pytest.mark.parametrize('fixed_point', [True, False])
+def test_split_and_detect(kitti_disp, fixed_point, band_rows, tmp_path):
+    disp = kitti_disp if fixed_point else to_float(kitti_disp)
+    (obst, non_obst, v_disp, index2d) = ft.split_disp(
+        disp, return_v_disp=True)
+    (obst_banded, non_obst_banded, v_disp_banded, index2d_banded) = \
+        ft.split_disp_banded(disp, return_v_disp=True, band_rows=band_rows)
+
+    assert_equal_nan(obst_banded, obst)
+    assert_equal_nan(non_obst_banded, non_obst)
+    np.testing.assert_array_equal(v_disp_banded, v_disp)
+    assert_equal_nan(index2d_banded, index2d)
+
+    mask = ft.detect_traversable_regions(
+        'frame.png', str(tmp_path), non_obst, v_disp=v_disp,
+        index2d=index2d, **DETECT_PARAMS)
+    mask_banded = ft.detect_traversable_regions_banded(
+        'frame.png', str(tmp_path), non_obst_banded, band_rows=band_rows,
+        **DETECT_PARAMS)
+    assert mask.any()
+    np.testing.assert_array_equal(mask_banded, mask)
+
+@pytest.mark.parametrize('band_rows', (8, 16, 25))
+@pytest.mark.parametrize('connectivity', [1, 2])
+def test_components_across_bands(band_rows, connectivity):
+    mask = np.zeros((64, 48), dtype=np.uint8)
+    # U-образная компонента: ветви соединены только в нижней полосе, каждая
+    # часть в полосе меньше min_size, вся компонента - больше
+    mask[2:60, 4:8] = 255
+    mask[2:60, 16:20] = 255
+    mask[56:60, 4:20] = 255
+    # Диагональная цепочка: при 8-связности одна компонента через границы
+    for i in range(40):
+        mask[10+i, 26+i//2] = 255
+    # Небольшие компоненты и пустоты
+    mask[30:33, 40:43] = 255
+    mask[20:40, 36:46] = 255
+    mask[28:31, 39:42] = 0
+
+    for min_size in (10, 60, 200, 300):
+        expected = ft.remove_small_components(mask.copy(), min_size,
+                                              connectivity)
+        banded = ft.remove_small_components_banded(mask.copy(), min_size,
+                                                   connectivity, band_rows)
+        np.testing.assert_array_equal(banded, expected)
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    expected = ft.clean_mask(mask.copy(), kernel, 60, connectivity)
+    banded = ft.clean_mask_banded(mask.copy(), kernel, 60, connectivity,
+                                  band_rows)
+    np.testing.assert_array_equal(banded, expected)
+
+def test_random_masks():
+    rng = np.random.RandomState(0)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9))
+    for _ in range(5):
+        mask = ((rng.random_sample((120, 90)) < 0.45)*255).astype(np.uint8)
+        for band_rows in (10, 33):
+            expected = ft.clean_mask(mask.copy(), kernel, 50)
+            banded = ft.clean_mask_banded(mask.copy(), kernel, 50,
+                                          band_rows=band_rows)
+            np.testing.assert_array_equal(banded, expected)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Эквивалентность пакетной обработки стопки карт (N, H, W) (*_batch) и
+обработки карт по одной.
+"""
+import numpy as np
+import pytest
+import sys
+import os
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import find_traversable as ft
+import imgs2disp
+
+DATA_DIR = os.path.join(REPO_DIR, 'data')
+KITTI_FRAMES = ('um_000000.png', 'umm_000000.png', 'uu_000000.png')
+
+DETECT_PARAMS = dict(v_disp_threshold=3, line_width=20, morph_disk_radius=9,
+                     small_obj_size=500, connectivity=1)
+
+
+def to_float(disp):
+    """Карта с фиксированной точкой -> float32 с NaN (как read_disp)"""
+    disp_float = disp.astype(np.float32)/ft.DISP_SCALE
+    disp_float[disp == ft.INVALID_DISP] = np.nan
+    return disp_float
+
+@pytest.fixture(scope='module')
+def disps():
+    """
+    Стопка карт: кадры KITTI, шум (линия земли не находится) и карта, в
+    которой валидны только верхние строки
+    """
+    imgLdirpath = os.path.join(DATA_DIR, 'data_road', 'training', 'image_2')
+    imgRdirpath = os.path.join(DATA_DIR, 'data_road_right', 'training',
+                               'image_3')
+    if not all(os.path.isfile(os.path.join(dirpath, frame))
+               for frame in KITTI_FRAMES
+               for dirpath in (imgLdirpath, imgRdirpath)):
+        pytest.skip("KITTI frames are not available")
+
+    sgbm_obj = imgs2disp.create_sgbm()
+    frames = [imgs2disp.stereo_disp(sgbm_obj, *imgs2disp.read_stereo_pair(
+                  frame, imgLdirpath, frame, imgRdirpath))
+              for frame in KITTI_FRAMES]
+    shape = frames[0].shape
+
+    rng = np.random.RandomState(0)
+    noise = rng.randint(0, ft.MAX_DISP*ft.DISP_SCALE, size=shape)
+    top = np.full(shape, ft.INVALID_DISP, dtype=np.uint16)
+    top[:10] = rng.randint(0, 1000, size=(10, shape[1]))
+
+    return np.stack(frames + [noise.astype(np.uint16), top])
+
+@pytest.fixture(params=['fixed_point', 'float'])
+def stack(request, disps):
+    return disps if request.param == 'fixed_point' else to_float(disps)
+
+def test_uv_disp(stack):
+    (u_disps, v_disps, disp_bins, index2ds) = ft.compute_uv_disp_batch(stack)
+    for (i, disp) in enumerate(stack):
+        (u_disp, v_disp, bins, index2d) = ft.compute_uv_disp(disp)
+        np.testing.assert_array_equal(u_disps[i], u_disp)
+        np.testing.assert_array_equal(v_disps[i], v_disp)
+        np.testing.assert_array_equal(disp_bins[i], bins)
+        np.testing.assert_array_equal(index2ds[i], index2d)
+        assert index2ds[i].dtype == index2d.dtype
+
+def test_split_and_detect(stack, tmp_path):
+    (obst_disps, non_obst_disps, v_disps, index2ds) = ft.split_disp_batch(
+        stack, return_v_disp=True)
+    masks = ft.detect_traversable_regions_batch(
+        None, None, non_obst_disps, v_disps=v_disps, index2ds=index2ds,
+        **DETECT_PARAMS)
+
+    found = []
+    for (i, disp) in enumerate(stack):
+        (obst, non_obst, v_disp, index2d) = ft.split_disp(
+            disp, return_v_disp=True)
+        np.testing.assert_array_equal(obst_disps[i], obst)
+        np.testing.assert_array_equal(non_obst_disps[i], non_obst)
+        np.testing.assert_array_equal(v_disps[i], v_disp)
+        np.testing.assert_array_equal(index2ds[i], index2d)
+
+        mask = ft.detect_traversable_regions(
+            f"{i}.png", str(tmp_path), non_obst, v_disp=v_disp,
+            index2d=index2d, **DETECT_PARAMS)
+        np.testing.assert_array_equal(masks[i], mask)
+        found.append(mask.any())
+
+    # Кадры KITTI размечены, для шума линия земли не найдена
+    assert found[:len(KITTI_FRAMES)] == [True]*len(KITTI_FRAMES)
+    assert not found[len(KITTI_FRAMES)]
+
+def test_detect_computes_v_disp(stack, tmp_path):
+    (_, non_obst_disps) = ft.split_disp_batch(stack)
+    masks = ft.detect_traversable_regions_batch(
+        [f"{i}.png" for i in range(len(stack))], str(tmp_path),
+        non_obst_disps, **DETECT_PARAMS)
+    for (i, non_obst) in enumerate(non_obst_disps):
+        mask = ft.detect_traversable_regions(f"{i}.png", str(tmp_path),
+                                             non_obst, **DETECT_PARAMS)
+        np.testing.assert_array_equal(masks[i], mask)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Инкрементальная сборка build.py на кадрах KITTI-ROAD из data: этапы
+disp, mask и overlay (этапы devkit_road не запускаются).
+"""
+import pytest
+import glob
+import sys
+import os
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import build
+
+DATA_DIR = os.path.join(REPO_DIR, 'data')
+IMG_L_DIR = os.path.join(DATA_DIR, 'data_road', 'training', 'image_2')
+IMG_R_DIR = os.path.join(DATA_DIR, 'data_road_right', 'training', 'image_3')
+CALIB_DIR = os.path.join(DATA_DIR, 'data_road', 'training', 'calib')
+GT_DIR = os.path.join(DATA_DIR, 'data_road', 'training', 'gt_image_2')
+
+pytestmark = pytest.mark.skipif(
+    not glob.glob(os.path.join(IMG_R_DIR, '*.png')),
+    reason="KITTI frames are not available")
+
+
+def run_build(outdirpath, **stage_args):
+    """Сборка этапов disp, mask и overlay; кол. пересчитанных файлов"""
+    stages = build.pipeline_stages(IMG_L_DIR, IMG_R_DIR, CALIB_DIR, GT_DIR,
+                                   str(outdirpath), **stage_args)[:3]
+    manifest = build.Manifest(os.path.join(str(outdirpath),
+                                           build.MANIFEST_FILENAME))
+    return build.build(stages, manifest, [sys.executable])
+
+def test_unwritten_outputs_are_not_recorded(tmp_path):
+    frames = len(glob.glob(os.path.join(IMG_L_DIR, '*.png')))
+    rebuilt = run_build(tmp_path)
+    assert rebuilt == {'disp': frames, 'mask': frames, 'overlay': frames}
+
+    # При 64 интервалах линия земли не находится и маски не записываются:
+    # прежние маски не должны приниматься за пересчитанные
+    with pytest.raises(RuntimeError, match="outputs missing"):
+        run_build(tmp_path, detect_args=['--disp-bins', '64'])
+    assert not glob.glob(str(tmp_path / 'sgbm_tr_regs_persp' / '*.png'))
+    with pytest.raises(RuntimeError, match="outputs missing"):
+        run_build(tmp_path, detect_args=['--disp-bins', '64'])
+
+    # Маски совпадают с прежними, поэтому наложения не пересчитываются
+    rebuilt = run_build(tmp_path)
+    assert rebuilt == {'disp': 0, 'mask': frames, 'overlay': 0}
+
+@pytest.mark.parametrize('stage_args', [
+    {'detect_args': ['--sequence']},
+    {'detect_args': ['--output', 'runs']},
+    {'detect_args': ['--seq']},
+    {'disp_args': ['--watch']},
+    {'overlay_args': ['extra.png']},
+])
+def test_rejects_frame_selection_options(tmp_path, stage_args):
+    with pytest.raises(ValueError):
+        build.pipeline_stages(IMG_L_DIR, IMG_R_DIR, CALIB_DIR, GT_DIR,
+                              str(tmp_path), **stage_args)
+
+def test_changed_args_rerun_affected_stages(tmp_path):
+    frames = len(glob.glob(os.path.join(IMG_L_DIR, '*.png')))
+    run_build(tmp_path)
+    assert run_build(tmp_path) == {'disp': 0, 'mask': 0, 'overlay': 0}
+
+    # Аргументы этапа наложения
+    rebuilt = run_build(tmp_path, overlay_args=['--prefetch', '0'])
+    assert rebuilt == {'disp': 0, 'mask': 0, 'overlay': frames}
+
+    # Карты диспаритета пересчитываются с тем же результатом
+    rebuilt = run_build(tmp_path, disp_args=['--write-threads=0'],
+                        overlay_args=['--prefetch', '0'])
+    assert rebuilt == {'disp': frames, 'mask': 0, 'overlay': 0}
+
+    # Маски: наложения пересчитываются только для изменившихся масок
+    maskdirpath = tmp_path / 'sgbm_tr_regs_persp'
+    digests = {path: build.file_digest(path)
+               for path in glob.glob(str(maskdirpath / '*.png'))}
+    rebuilt = run_build(tmp_path, disp_args=['--write-threads=0'],
+                        detect_args=['--calib', CALIB_DIR],
+                        overlay_args=['--prefetch', '0'])
+    changed = sum(build.file_digest(path) != digest
+                  for (path, digest) in digests.items())
+    assert rebuilt == {'disp': 0, 'mask': frames, 'overlay': changed}
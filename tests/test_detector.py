@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Эквивалентность TraversableDetector.process и последовательного вызова
+split_disp и detect_traversable_regions с теми же параметрами.
+"""
+import numpy as np
+import pytest
+import sys
+import os
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import find_traversable as ft
+import imgs2disp
+
+DATA_DIR = os.path.join(REPO_DIR, 'data')
+KITTI_FRAMES = ('um_000000.png', 'umm_000000.png', 'uu_000000.png')
+
+DETECT_PARAMS = dict(v_disp_threshold=3, line_width=20, morph_disk_radius=9,
+                     small_obj_size=500, connectivity=1)
+SPLIT_PARAMS = dict(u_disp_threshold=3, morph_disk_radius=9,
+                    small_obj_size=500, connectivity=1)
+DETECTOR_PARAMS = dict(SPLIT_PARAMS, **DETECT_PARAMS)
+
+VARIANTS = {
+    'default': {},
+    'quantized': dict(num_disp_bins=224),
+    'row_range': dict(row_range=(150, 370)),
+    'quantized_row_range': dict(num_disp_bins=96, max_disp=64,
+                                row_range=(180, 375)),
+}
+
+
+def to_float(disp):
+    """Карта с фиксированной точкой -> float32 с NaN (как read_disp)"""
+    disp_float = disp.astype(np.float32)/ft.DISP_SCALE
+    disp_float[disp == ft.INVALID_DISP] = np.nan
+    return disp_float
+
+@pytest.fixture(scope='module')
+def kitti_disps():
+    """Карты диспаритета SGBM кадров KITTI (uint16 с фиксированной точкой)"""
+    imgLdirpath = os.path.join(DATA_DIR, 'data_road', 'training', 'image_2')
+    imgRdirpath = os.path.join(DATA_DIR, 'data_road_right', 'training',
+                               'image_3')
+    if not all(os.path.isfile(os.path.join(dirpath, frame))
+               for frame in KITTI_FRAMES
+               for dirpath in (imgLdirpath, imgRdirpath)):
+        pytest.skip("KITTI frames are not available")
+
+    sgbm_obj = imgs2disp.create_sgbm()
+    return [imgs2disp.stereo_disp(sgbm_obj, *imgs2disp.read_stereo_pair(
+                frame, imgLdirpath, frame, imgRdirpath))
+            for frame in KITTI_FRAMES]
+
+def reference_mask(disp, tmp_path, **params):
+    """Маска по split_disp и detect_traversable_regions"""
+    (_, non_obst, v_disp, index2d) = ft.split_disp(
+        disp, return_v_disp=True, **SPLIT_PARAMS, **params)
+    return ft.detect_traversable_regions(
+        'frame.png', str(tmp_path), non_obst, v_disp=v_disp,
+        index2d=index2d, **DETECT_PARAMS, **params)
+
+@pytest.mark.parametrize('variant', sorted(VARIANTS))
+@pytest.mark.parametrize('fixed_point', [True, False])
+def test_process_matches_functions(kitti_disps, fixed_point, variant,
+                                   tmp_path):
+    params = VARIANTS[variant]
+    disps = [disp if fixed_point else to_float(disp) for disp in kitti_disps]
+    detector = ft.TraversableDetector(disps[0].shape, **DETECTOR_PARAMS,
+                                      **params)
+
+    # Буфер результата и внутренние буферы переиспользуются между кадрами
+    out = np.full(disps[0].shape, 7, dtype=np.uint8)
+    for disp in disps:
+        mask = detector.process(disp, out=out)
+        assert mask is out
+        expected = reference_mask(disp, tmp_path, **params)
+        assert expected.any()
+        np.testing.assert_array_equal(mask, expected)
+        assert detector.line is not None
+
+    # Повторная обработка первого кадра без out
+    np.testing.assert_array_equal(
+        detector.process(disps[0]), reference_mask(disps[0], tmp_path,
+                                                   **params))
+
+@pytest.mark.parametrize('fixed_point', [True, False])
+def test_process_without_ground_line(kitti_disps, fixed_point, tmp_path):
+    shape = kitti_disps[0].shape
+    rng = np.random.RandomState(0)
+    noise = rng.randint(0, ft.MAX_DISP*ft.DISP_SCALE,
+                        size=shape).astype(np.uint16)
+    disps = [kitti_disps[0], noise]
+    if not fixed_point:
+        disps = [to_float(disp) for disp in disps]
+
+    detector = ft.TraversableDetector(shape, **DETECTOR_PARAMS)
+    out = np.empty(shape, dtype=np.uint8)
+    assert detector.process(disps[0], out=out).any()
+
+    # Маска предыдущего кадра не должна остаться в out
+    mask = detector.process(disps[1], out=out)
+    assert detector.line is None
+    assert detector.ground_disp_range() is None
+    assert not mask.any()
+    np.testing.assert_array_equal(mask, reference_mask(disps[1], tmp_path))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Эквивалентность обработки карт диспаритета uint16 с фиксированной точкой
+(DISP_SCALE, INVALID_DISP) и карт float32 с NaN: разбиение на бины,
+u- и v-диспаритет, карты препятствий и маски регионов.
+"""
+import numpy as np
+import pytest
+import cv2
+import sys
+import os
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import find_traversable as ft
+import imgs2disp
+
+DATA_DIR = os.path.join(REPO_DIR, 'data')
+KITTI_FRAMES = ('um_000000.png', 'umm_000000.png', 'uu_000000.png')
+
+DETECT_PARAMS = dict(v_disp_threshold=3, line_width=20, morph_disk_radius=9,
+                     small_obj_size=500, connectivity=1)
+
+# Квантование: без него, по умолчанию для последовательностей и с шагом,
+# не являющимся степенью двойки
+QUANTIZATION = [dict(), dict(num_disp_bins=ft.SEQUENCE_DISP_BINS),
+                dict(num_disp_bins=100, max_disp=70)]
+
+
+def to_float(disp):
+    """Карта с фиксированной точкой -> float32 с NaN (как read_disp)"""
+    disp_float = disp.astype(np.float32)/ft.DISP_SCALE
+    disp_float[disp == ft.INVALID_DISP] = np.nan
+    return disp_float
+
+@pytest.fixture(scope='module', params=KITTI_FRAMES)
+def kitti_disp(request):
+    """Карта диспаритета SGBM кадра KITTI (uint16 с фиксированной точкой)"""
+    frame = request.param
+    imgLdirpath = os.path.join(DATA_DIR, 'data_road', 'training', 'image_2')
+    imgRdirpath = os.path.join(DATA_DIR, 'data_road_right', 'training',
+                               'image_3')
+    if not (os.path.isfile(os.path.join(imgLdirpath, frame))
+            and os.path.isfile(os.path.join(imgRdirpath, frame))):
+        pytest.skip("KITTI frame is not available")
+
+    pair = imgs2disp.read_stereo_pair(frame, imgLdirpath, frame, imgRdirpath)
+    return imgs2disp.stereo_disp(imgs2disp.create_sgbm(), *pair)
+
+def all_codes():
+    """Все коды диапазона [0, 2*MAX_DISP) и невалидные пиксели"""
+    codes = np.arange(2*ft.MAX_DISP*ft.DISP_SCALE, dtype=np.uint16)
+    codes = np.append(codes, [ft.INVALID_DISP]*64).astype(np.uint16)
+    return codes.reshape((-1, 64))
+
+def assert_same_uv_disp(disp, **quantization):
+    (u_fixed, v_fixed, bins_fixed, index2d_fixed) = ft.compute_uv_disp(
+        disp, **quantization)
+    (u_float, v_float, bins_float, index2d_float) = ft.compute_uv_disp(
+        to_float(disp), **quantization)
+
+    np.testing.assert_array_equal(u_fixed, u_float)
+    np.testing.assert_array_equal(v_fixed, v_float)
+    np.testing.assert_array_equal(bins_fixed, bins_float)
+    # Ось диспаритета с фиксированной точкой - в единицах 1/DISP_SCALE
+    np.testing.assert_array_equal(index2d_fixed/ft.DISP_SCALE, index2d_float)
+
+def test_read_disp(kitti_disp, tmp_path):
+    cv2.imwrite(str(tmp_path / 'disp.png'), kitti_disp)
+    disp_fixed = ft.read_disp('disp.png', str(tmp_path), fixed_point=True)
+    disp_float = ft.read_disp('disp.png', str(tmp_path))
+
+    assert disp_fixed.dtype == np.uint16
+    np.testing.assert_array_equal(disp_fixed, kitti_disp)
+    assert disp_float.dtype == np.float32
+    np.testing.assert_array_equal(disp_float, to_float(kitti_disp))
+    np.testing.assert_array_equal(ft.valid_disp_mask(disp_fixed),
+                                  ft.valid_disp_mask(disp_float))
+
+@pytest.mark.parametrize('quantization', QUANTIZATION)
+def test_uv_disp(kitti_disp, quantization):
+    assert_same_uv_disp(kitti_disp, **quantization)
+
+@pytest.mark.parametrize('quantization', QUANTIZATION)
+def test_uv_disp_all_codes(quantization):
+    # Границы бинов квантования для всех кодов с фиксированной точкой
+    assert_same_uv_disp(all_codes(), **quantization)
+
+@pytest.mark.parametrize('row_range', [None, (150, 370)])
+@pytest.mark.parametrize('quantization', QUANTIZATION)
+def test_split_and_detect(kitti_disp, quantization, row_range, tmp_path):
+    results = []
+    for disp in (kitti_disp, to_float(kitti_disp)):
+        (obst, non_obst, v_disp, index2d) = ft.split_disp(
+            disp, return_v_disp=True, row_range=row_range, **quantization)
+        mask = ft.detect_traversable_regions(
+            'frame.png', str(tmp_path), non_obst, v_disp=v_disp,
+            index2d=index2d, row_range=row_range, **DETECT_PARAMS,
+            **quantization)
+        results.append((obst, non_obst, v_disp, index2d, mask))
+    ((obst, non_obst, v_disp, index2d, mask),
+     (obst_float, non_obst_float, v_disp_float, index2d_float,
+      mask_float)) = results
+
+    assert obst.dtype == non_obst.dtype == np.uint16
+    np.testing.assert_array_equal(to_float(obst), obst_float)
+    np.testing.assert_array_equal(to_float(non_obst), non_obst_float)
+    np.testing.assert_array_equal(v_disp, v_disp_float)
+    np.testing.assert_array_equal(index2d/ft.DISP_SCALE, index2d_float)
+
+    assert mask.any()
+    np.testing.assert_array_equal(mask, mask_float)
+
+    # v-диспаритет вычисляется заново по карте не-препятствий
+    mask = ft.detect_traversable_regions(
+        'frame.png', str(tmp_path), non_obst, row_range=row_range,
+        **DETECT_PARAMS, **quantization)
+    mask_float = ft.detect_traversable_regions(
+        'frame.png', str(tmp_path), non_obst_float, row_range=row_range,
+        **DETECT_PARAMS, **quantization)
+    np.testing.assert_array_equal(mask, mask_float)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Запись и чтение файлов свободного пространства *.fsp: восстановление
+представлений и масок, ошибки для усеченных и поврежденных файлов.
+"""
+import numpy as np
+import pytest
+import struct
+import zlib
+import sys
+import os
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import freespace
+
+
+def random_mask(seed, shape=(48, 64)):
+    """
+    Случайная маска (0/255) с пустыми и полностью заполненными столбцами и
+    интервалами, касающимися верхнего и нижнего краев
+    """
+    rng = np.random.RandomState(seed)
+    mask = (rng.random_sample(shape) < 0.5).astype(np.uint8)*255
+    mask[:, 0] = 0
+    mask[:, 1] = 255
+    mask[:3, 2] = 255
+    mask[-3:, 3] = 255
+    return mask
+
+def road_mask(shape=(375, 1242)):
+    """Маска в духе маски дороги: свободный низ кадра с препятствиями"""
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[200:] = 255
+    mask[250:300, 400:480] = 0
+    mask[320:, 900:] = 0
+    return mask
+
+MASKS = [random_mask(0), random_mask(1, (1, 5)), road_mask(),
+         np.zeros((10, 7), dtype=np.uint8),
+         np.full((10, 7), 255, dtype=np.uint8)]
+
+
+@pytest.mark.parametrize('index', range(len(MASKS)))
+@pytest.mark.parametrize('mode', freespace.FREESPACE_MODES)
+def test_round_trip(tmp_path, mode, index):
+    mask = MASKS[index]
+    filename = str(tmp_path / ('mask' + freespace.FREESPACE_END))
+    freespace.write_freespace(filename, mask, mode)
+
+    (read_mode, shape, data) = freespace.read_freespace(filename)
+    assert read_mode == mode
+    assert shape == mask.shape
+    if mode == 'runs':
+        (counts, runs) = freespace.mask_to_runs(mask)
+        for (read, expected) in zip(data, (counts, runs)):
+            assert read.dtype == np.uint16
+            np.testing.assert_array_equal(read, expected)
+        expected_mask = mask
+    else:
+        boundary = freespace.mask_to_boundary(mask)
+        assert data.dtype == np.uint16
+        np.testing.assert_array_equal(data, boundary)
+        expected_mask = freespace.boundary_to_mask(mask.shape, boundary)
+
+    read_mask = freespace.read_freespace_mask(filename)
+    assert read_mask.dtype == np.uint8
+    np.testing.assert_array_equal(read_mask, expected_mask)
+
+    # Заголовок и данные воспроизводятся повторным кодированием
+    with open(filename, 'rb') as f:
+        buffer = f.read()
+    assert buffer == freespace.encode_freespace(read_mask, mode)
+    (magic, mode_index, m, n, size) = \
+        freespace.FREESPACE_HEADER.unpack_from(buffer)
+    assert magic == freespace.FREESPACE_MAGIC
+    assert freespace.FREESPACE_MODES[mode_index] == mode
+    assert (m, n) == mask.shape
+    assert size == len(buffer) - freespace.FREESPACE_HEADER.size
+
+def test_boundary_of_bottom_run():
+    mask = np.zeros((6, 3), dtype=np.uint8)
+    mask[1:2, 0] = 255
+    mask[3:, 0] = 255
+    mask[:, 1] = 255
+    np.testing.assert_array_equal(freespace.mask_to_boundary(mask),
+                                  [3, 0, 6])
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        freespace.encode_freespace(MASKS[0], 'stixels')
+
+def pack(values, mode, shape):
+    """Файл *.fsp с произвольными значениями uint16"""
+    data = zlib.compress(np.asarray(values, dtype='<u2').tobytes())
+    header = freespace.FREESPACE_HEADER.pack(
+        freespace.FREESPACE_MAGIC, freespace.FREESPACE_MODES.index(mode),
+        shape[0], shape[1], len(data))
+    return header + data
+
+@pytest.mark.parametrize('mode', freespace.FREESPACE_MODES)
+def test_truncated(tmp_path, mode):
+    buffer = freespace.encode_freespace(MASKS[0], mode)
+    filename = str(tmp_path / ('mask' + freespace.FREESPACE_END))
+    for size in (0, 3, freespace.FREESPACE_HEADER.size,
+                 freespace.FREESPACE_HEADER.size + 5, len(buffer) - 1):
+        with open(filename, 'wb') as f:
+            f.write(buffer[:size])
+        with pytest.raises(ValueError):
+            freespace.read_freespace(filename)
+        with pytest.raises(ValueError):
+            freespace.read_freespace_mask(filename)
+
+@pytest.mark.parametrize('buffer', [
+    # Неверная сигнатура и представление
+    b'PNG1' + freespace.encode_freespace(MASKS[0])[4:],
+    struct.pack('<4sBHHI', freespace.FREESPACE_MAGIC, 7, 4, 2, 0),
+    # Поврежденные сжатые данные
+    freespace.FREESPACE_HEADER.pack(freespace.FREESPACE_MAGIC, 0, 4, 2, 8)
+    + b'\x00'*8,
+    # Нечетный размер данных
+    freespace.FREESPACE_HEADER.pack(freespace.FREESPACE_MAGIC, 1, 4, 2,
+                                    len(zlib.compress(b'\x00'*3)))
+    + zlib.compress(b'\x00'*3),
+    # Кол. интервалов не совпадает с данными
+    pack([1, 1, 0, 2], 'runs', (4, 2)),
+    pack([1], 'runs', (4, 2)),
+    # Интервалы и граница за пределами маски
+    pack([1, 0, 2, 5], 'runs', (4, 2)),
+    pack([1, 0, 3, 3], 'runs', (4, 2)),
+    pack([0, 5], 'boundary', (4, 2)),
+    pack([0, 1, 2], 'boundary', (4, 2)),
+], ids=['magic', 'mode', 'zlib', 'odd_size', 'run_counts', 'missing_runs',
+        'run_past_bottom', 'empty_run', 'boundary_past_bottom',
+        'boundary_size'])
+def test_corrupt(buffer):
+    with pytest.raises(ValueError):
+        freespace.decode_freespace(buffer)
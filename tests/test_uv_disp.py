@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Эквивалентность векторизованного u-диспаритета (compute_u_disp) и
+исходной реализации с обходом столбцов и словарями индексов.
+"""
+import numpy as np
+import pytest
+import sys
+import os
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+import find_traversable as ft
+import imgs2disp
+
+DATA_DIR = os.path.join(REPO_DIR, 'data')
+KITTI_FRAMES = ('um_000000.png', 'umm_000000.png', 'uu_000000.png')
+
+
+def reference_u_disp(disp):
+    """
+    Исходная реализация compute_u_disp (по столбцам, словари индексов);
+    невалидные пиксели - NaN или INVALID_DISP
+    """
+    mask_valid = ft.valid_disp_mask(disp)
+    d_unique = np.unique(disp[mask_valid])
+    d2index_dict = dict(zip(d_unique, range(d_unique.size)))
+    index2d_dict = dict(zip(range(d_unique.size), d_unique))
+
+    m = d_unique.size
+    n = disp.shape[1]
+    u_disp = np.zeros((m, n))
+
+    for u in range(n):
+        unique, counts = np.unique(disp[:, u][mask_valid[:, u]],
+                                   return_counts=True)
+        u_disp[[d2index_dict[d] for d in unique], u] = counts
+
+    return (u_disp, index2d_dict)
+
+def assert_equivalent(disp):
+    (u_disp, index2d) = ft.compute_u_disp(disp)
+    (ref_u_disp, ref_index2d_dict) = reference_u_disp(disp)
+
+    np.testing.assert_array_equal(u_disp, ref_u_disp)
+    assert len(index2d) == len(ref_index2d_dict)
+    for (m, d) in ref_index2d_dict.items():
+        assert index2d[m] == d
+
+def to_float(disp):
+    """Карта с фиксированной точкой -> float32 с NaN (как read_disp)"""
+    disp_float = disp.astype(np.float32)/ft.DISP_SCALE
+    disp_float[disp == ft.INVALID_DISP] = np.nan
+    return disp_float
+
+def random_disp(seed, shape=(60, 80), invalid_ratio=0.2):
+    """Случайная карта с фиксированной точкой с невалидными пикселями"""
+    rng = np.random.RandomState(seed)
+    disp = rng.randint(0, ft.MAX_DISP*ft.DISP_SCALE, size=shape)
+    disp = disp.astype(np.uint16)
+    disp[rng.random_sample(shape) < invalid_ratio] = ft.INVALID_DISP
+    return disp
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_fixed_point(seed):
+    assert_equivalent(random_disp(seed))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_float(seed):
+    assert_equivalent(to_float(random_disp(seed)))
+
+def test_few_values_and_invalid_columns():
+    # Повторяющиеся значения и полностью невалидные столбцы
+    disp = random_disp(0) % 8
+    disp[:, ::7] = ft.INVALID_DISP
+    assert_equivalent(disp)
+    assert_equivalent(to_float(disp))
+
+@pytest.mark.parametrize('frame', KITTI_FRAMES)
+def test_kitti(frame):
+    imgLfilename = os.path.join(DATA_DIR, 'data_road', 'training',
+                                'image_2', frame)
+    imgRfilename = os.path.join(DATA_DIR, 'data_road_right', 'training',
+                                'image_3', frame)
+    if not (os.path.isfile(imgLfilename) and os.path.isfile(imgRfilename)):
+        pytest.skip("KITTI frame is not available")
+
+    pair = imgs2disp.read_stereo_pair(frame, os.path.dirname(imgLfilename),
+                                      frame, os.path.dirname(imgRfilename))
+    disp = imgs2disp.stereo_disp(imgs2disp.create_sgbm(), *pair)
+    assert (disp == ft.INVALID_DISP).any()
+
+    assert_equivalent(disp)
+    assert_equivalent(to_float(disp))